@@ -0,0 +1,119 @@
+"""
+Client for the optional env-config agent, see agent_server.py.
+
+This module is imported on hot paths (e.g. entry.py) so should only import what it needs.
+"""
+
+import os
+from os import environ
+from pathlib import Path
+
+from . import utils
+
+
+log = utils.Log(__name__)
+
+
+def socket_fpath() -> Path:
+    """
+    One agent per user.  Its socket is in the user's runtime directory when there is one, otherwise
+    a directory in the shared temp directory that only the user can access.
+    """
+    if runtime_dpath := environ.get('XDG_RUNTIME_DIR'):
+        return Path(runtime_dpath) / 'env-config' / 'agent.sock'
+    return utils.TMP_DPATH / f'agent-{os.getuid()}' / 'agent.sock'
+
+
+SOCKET_FPATH = socket_fpath()
+
+
+def disabled() -> bool:
+    return environ.get('ENV_CONFIG_AGENT', '').lower() in ('0', 'false', 'no', 'off')
+
+
+def cwd() -> str | None:
+    try:
+        return str(Path.cwd())
+    except OSError:
+        # The current directory was deleted
+        return None
+
+
+class AgentClient:
+    """
+    Sends requests to the agent.  When the agent isn't running, or doesn't respond, methods return
+    None so the caller can fall back to doing the work in-process.
+    """
+
+    # Resolving can wait on 1Pass which can wait on the user to unlock it
+    timeout: float = 120
+
+    def __init__(self, socket_fpath: Path | None = None):
+        self.socket_fpath: Path = socket_fpath or SOCKET_FPATH
+
+    def request(self, payload: dict, timeout: float | None = None) -> dict | None:
+        # Requests include the user's environment and responses are exported into their shell so
+        # only talk to an agent started by the user.
+        if not utils.is_private(self.socket_fpath):
+            if self.socket_fpath.exists():
+                log.warning('Ignoring agent socket not private to the user: %s', self.socket_fpath)
+            return None
+
+        # Imported here so they're only imported when the agent is running
+        import json
+        import socket
+
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(timeout or self.timeout)
+                sock.connect(str(self.socket_fpath))
+                sock.sendall(json.dumps(payload).encode() + b'\n')
+                with sock.makefile('rb') as fo:
+                    line = fo.readline()
+        except OSError:
+            log.info('Agent not available at %s', self.socket_fpath)
+            return None
+
+        if not line:
+            return None
+
+        response = json.loads(line)
+        if 'error' in response:
+            log.info('Agent error: %s', response['error'])
+            return None
+
+        return response
+
+    def ping(self) -> dict | None:
+        return self.request({'op': 'ping'}, timeout=2)
+
+    def resolve(self, config_fpath: Path, names: list[str], **options) -> dict | None:
+        """
+        Return the agent's response: `env_vars` with the resolved values or `errors` with env name
+        to error message.
+        """
+        payload = {
+            'op': 'resolve',
+            'config': str(config_fpath.resolve()),
+            'names': list(names),
+            # Config values can depend on the caller's environment and current directory
+            'env': dict(environ),
+            'cwd': cwd(),
+            'options': options,
+        }
+        # Give the agent a chance to report its own timeout before giving up on it
+        timeout = options.get('timeout')
+        return self.request(payload, timeout=timeout + 5 if timeout else None)
+
+    def aws_creds(self, profile: str) -> str | None:
+        """Return credential_process JSON for the AWS profile"""
+        payload = {
+            'op': 'aws_creds',
+            'profile': profile,
+            # AWS config, session duration and refresh settings come from the caller's environment
+            # and current directory
+            'env': dict(environ),
+            'cwd': cwd(),
+        }
+        response = self.request(payload)
+        return response['creds'] if response else None
@@ -0,0 +1,192 @@
+"""
+Optional per-user agent that keeps parsed configs, resolved secrets, and AWS session credentials in
+memory so env-config and env-config-aws don't need to redo that work on every invocation.
+
+Requests and responses are a single line of JSON over a Unix socket.  See agent.AgentClient.
+"""
+
+from collections import defaultdict
+import contextvars
+import json
+import logging
+import os
+from pathlib import Path
+import socketserver
+import threading
+
+from . import aws, config, utils
+from .agent import SOCKET_FPATH
+from .cache import MemorySecretCache
+from .core import ConfigIndex, EnvConfig, ResolveError, UserError
+from .model import Config
+
+
+log = logging.getLogger(__name__)
+
+
+class Agent:
+    def __init__(self, ttl: int = 0):
+        # Cache TTL for configs that don't set a default
+        self.ttl: int = ttl
+
+        # config path -> (mtime_ns, size, config, index)
+        self.configs: dict[Path, tuple] = {}
+        # Configs are shared by requests, which render templates with their own environment
+        self.config_lock = threading.Lock()
+
+        self.secrets: dict = {}
+
+        # (op_ref_base, mfa_serial) -> SessCreds
+        self.creds: dict[tuple, aws.SessCreds] = {}
+        self.creds_locks: dict[tuple, threading.Lock] = defaultdict(threading.Lock)
+        # Keys whose credentials are being renewed ahead of expiration
+        self.renewing: set[tuple] = set()
+
+    def config(self, config_fpath: Path) -> tuple[Config, ConfigIndex]:
+        """
+        Return the parsed config and its index, reloading them if the file changed.  Call with
+        config_lock.
+        """
+        stat = config_fpath.stat()
+        mtime_ns, size, conf, index = self.configs.get(config_fpath, (None,) * 4)
+        if (mtime_ns, size) != (stat.st_mtime_ns, stat.st_size):
+            log.info('Loading config %s', config_fpath)
+            conf = config.load(config_fpath)
+            index = ConfigIndex.build(conf)
+            self.configs[config_fpath] = (stat.st_mtime_ns, stat.st_size, conf, index)
+        return conf, index
+
+    def handle(self, request: dict) -> dict:
+        match request.get('op'):
+            case 'ping':
+                return {'pid': os.getpid(), 'configs': len(self.configs)}
+            case 'resolve':
+                return self.resolve(request)
+            case 'aws_creds':
+                return self.aws_creds(request)
+            case op:
+                return {'error': f'Unknown request: {op}'}
+
+    def resolve(self, request: dict) -> dict:
+        options = request['options']
+        cache = None
+        if options.get('cache', True):
+            cache = MemorySecretCache(
+                self.secrets,
+                refresh=options.get('refresh', False),
+                # Secrets read with one client's 1Pass account and credentials aren't given to
+                # another
+                identity=utils.op_identity(request['env']),
+            )
+
+        with self.config_lock:
+            conf, index = self.config(Path(request['config']))
+
+        envconf = EnvConfig(
+            conf,
+            concurrency=options.get('concurrency'),
+            batch=options.get('batch', False),
+            timeout=options.get('timeout'),
+            cache=cache,
+            cache_ttl=options.get('cache_ttl'),
+            default_cache_ttl=self.ttl,
+            index=index,
+            env=request['env'],
+            cwd=request.get('cwd'),
+        )
+        env_vars = envconf.select(request['names'])
+        if (only := options.get('only')) is not None:
+            env_vars = {name: value for name, value in env_vars.items() if name in only}
+        ttls = envconf.cache_ttls(request['names']) if cache else {}
+
+        # Resolving can be slow, don't hold up other requests while doing it.
+        try:
+            return {'env_vars': envconf.resolve_values(env_vars, ttls)}
+        except ResolveError as e:
+            return {'errors': {name: str(error) for name, error in e.errors.items()}}
+
+    def aws_creds(self, request: dict) -> dict:
+        with utils.for_caller(request.get('env'), request.get('cwd')):
+            return self.caller_aws_creds(request['profile'])
+
+    def caller_aws_creds(self, profile_name: str) -> dict:
+        """aws_creds() with the client's settings, see utils.for_caller()"""
+        profile = aws.profile_config(profile_name)
+        key = (profile.op_ref_base, profile.mfa_serial)
+
+        # Only one request at a time generates credentials for the same profile
+        with self.creds_locks[key]:
+            creds = self.creds.get(key)
+            threshold = utils.utc_now_in(seconds=aws.refresh_threshold())
+            if creds is None or creds.expiration <= threshold:
+                # Uses credentials cached on disk when they're still valid.  Requests are logged by
+                # env-config-aws so only credential generation is logged here.
+                creds = aws.renew_sess_creds(
+                    *key,
+                    duration=aws.session_duration(profile),
+                    profile=profile.profile,
+                )
+                self.creds[key] = creds
+            elif creds.needs_renewal(aws.refresh_ahead()) and key not in self.renewing:
+                self.renewing.add(key)
+                args = (key, aws.session_duration(profile), profile.profile)
+                # With the caller's context, e.g. for its refresh settings and 1Pass account
+                context = contextvars.copy_context()
+                threading.Thread(
+                    target=context.run,
+                    args=(self.renew_creds, *args),
+                    daemon=True,
+                ).start()
+
+        return {'creds': creds.cli_json()}
+
+    def renew_creds(self, key: tuple, duration: int, profile: str):
+        """Replace credentials ahead of their expiration while the current ones are still served"""
+        try:
+            self.creds[key] = aws.renew_sess_creds(
+                *key,
+                ahead=True,
+                duration=duration,
+                profile=profile,
+            )
+        except Exception:
+            log.exception('Unable to renew credentials')
+        finally:
+            self.renewing.discard(key)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    server: 'AgentServer'
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            response = self.server.agent.handle(request)
+        except Exception as e:
+            log.exception('Error handling agent request')
+            response = {'error': str(e)}
+
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class AgentServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, agent: Agent, socket_fpath: Path | None = None):
+        self.agent = agent
+        self.socket_fpath: Path = socket_fpath or SOCKET_FPATH
+        if not utils.private_dir(self.socket_fpath.parent):
+            raise UserError(f'{self.socket_fpath.parent} is owned by another user')
+        # Left over from an agent that didn't shutdown cleanly
+        self.socket_fpath.unlink(missing_ok=True)
+
+        # Only the user that started the agent can connect to it
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(str(self.socket_fpath), RequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    def server_close(self):
+        super().server_close()
+        self.socket_fpath.unlink(missing_ok=True)
@@ -1,47 +1,212 @@
-import configparser
-from dataclasses import dataclass
 import datetime as dt
-import json
-import logging
-from os import environ
+import hashlib
 from pathlib import Path
+import time
+from typing import TYPE_CHECKING, NamedTuple
 
-import boto3
-import serde
-from serde.msgpack import from_msgpack, to_msgpack
+import msgpack
 
-from . import utils
+from . import timings, utils
 
 
-log = logging.getLogger(__name__)
-
-AWS_CONFIG_FPATH = Path('~/.aws/config').expanduser()
+if TYPE_CHECKING:
+    import configparser
 
+log = utils.Log(__name__)
 
-@dataclass
-class ProfileConfig:
+AWS_CONFIG_FPATH = Path('~/.aws/config').expanduser()
+PROFILE_INDEX_DPATH = utils.TMP_DPATH / 'aws-configs'
+# Bump when the index format changes so old indexes are ignored
+PROFILE_INDEX_VERSION = 1
+
+# Seconds temporary session credentials are valid for, by default and the limits STS allows
+SESSION_DURATION = 3600
+SESSION_DURATION_MIN = 900
+SESSION_DURATION_MAX = 129600
+
+# Cached credentials that expire within this many seconds are regenerated before being used
+REFRESH_THRESHOLD_ENVVAR = 'ENV_CONFIG_AWS_REFRESH_THRESHOLD'
+REFRESH_THRESHOLD_DEFAULT = 300
+
+# Once cached credentials are this far into their lifetime, they are still used but renewed in the
+# background.  0 or 1 (or more) disables renewing ahead of expiration.
+REFRESH_AHEAD_ENVVAR = 'ENV_CONFIG_AWS_REFRESH_AHEAD'
+REFRESH_AHEAD_DEFAULT = 0.75
+# A background renewal that hasn't finished in this many seconds is assumed to have failed
+RENEW_TIMEOUT = 120
+# Seconds to wait on another process generating the same credentials.  1Pass may be waiting on the
+# user to unlock it.
+LOCK_TIMEOUT = 120
+# Seconds reading the keys from 1Pass can take, including retries.  Less than LOCK_TIMEOUT so
+# processes waiting on the lock get the result, or their turn, before giving up on it.
+OP_AUTH_TIMEOUT = 60
+
+
+# NOTE: NamedTuple, not dataclass, is used for the classes below b/c importing dataclasses is
+# relatively slow and this module is on the env-config-aws cached credentials path.  See entry.py.
+
+
+class ProfileConfig(NamedTuple):
     profile: str
     op_ref_base: str
     mfa_serial: str
+    # From envconfig_duration, see session_duration()
+    duration: int | None = None
 
 
-def profile_config(profile, *, config_fpath=None) -> ProfileConfig:
-    """Parse AWS config file for given profile's information"""
+# NOTE: settings below come from the caller's environment and current directory, see
+# utils.for_caller(), so the agent uses its client's.  This process's by default.
+
+
+def aws_config_fpath(config_fpath=None) -> Path:
+    caller = utils.current_caller()
+    env_config_file = caller.environ().get('AWS_CONFIG_FILE', config_fpath)
+    return caller.path(env_config_file) if env_config_file else AWS_CONFIG_FPATH
 
-    env_config_file = environ.get('AWS_CONFIG_FILE', config_fpath)
-    aws_config_fpath = Path(env_config_file) if env_config_file else AWS_CONFIG_FPATH
+
+def read_config(config_fpath=None) -> 'configparser.ConfigParser':
+    import configparser
 
     config = configparser.ConfigParser()
-    config.read(aws_config_fpath)
+    config.read(aws_config_fpath(config_fpath))
+    return config
+
+
+def parse_profile(profile: str, profile_conf: 'configparser.SectionProxy') -> ProfileConfig:
+    return ProfileConfig(
+        profile,
+        profile_conf['envconfig_1pass'],
+        profile_conf['mfa_serial'],
+        profile_conf.getint('envconfig_duration'),
+    )
+
+
+class ProfileIndex:
+    """
+    The env-config profiles of an AWS config file, saved in msgpack format, so looking up a profile
+    doesn't need to parse the whole INI file.  Keyed by the config's path, mtime, and size.
+    """
+
+    def __init__(self, config_fpath: Path, dpath: Path | None = None):
+        self.config_fpath: Path = config_fpath.absolute()
+        dpath = dpath or PROFILE_INDEX_DPATH
+        fname = hashlib.sha256(str(self.config_fpath).encode()).hexdigest()
+        self.fpath: Path = dpath / f'{fname}.msgpack'
+
+    def key(self) -> list:
+        stat = self.config_fpath.stat()
+        return [PROFILE_INDEX_VERSION, str(self.config_fpath), stat.st_mtime_ns, stat.st_size]
+
+    def read(self) -> dict[str, ProfileConfig] | None:
+        if not utils.is_private(self.fpath):
+            if self.fpath.exists():
+                log.warning('Ignoring AWS profile index not private to the user: %s', self.fpath)
+            return None
+
+        try:
+            key, profiles = msgpack.unpackb(self.fpath.read_bytes())
+            if key != self.key():
+                return None
+        except Exception:
+            # Doesn't exist yet, config file missing, or not readable
+            return None
+
+        return {profile: ProfileConfig(*fields) for profile, fields in profiles.items()}
 
-    profile_conf = config[f'profile {profile}']
-    op_prefix = profile_conf['envconfig_1pass']
+    def build(self) -> dict[str, ProfileConfig]:
+        """Parse the config file and save the index of its env-config profiles"""
+        import configparser
 
-    return ProfileConfig(profile, op_prefix, profile_conf['mfa_serial'])
+        # Before parsing so a change made while parsing isn't hidden by the index
+        try:
+            key = self.key()
+        except FileNotFoundError:
+            key = None
+
+        config = configparser.ConfigParser()
+        config.read(self.config_fpath)
+
+        profiles = {}
+        for section in config.sections():
+            profile = section.removeprefix('profile ')
+            if profile == section or 'envconfig_1pass' not in config[section]:
+                continue
+            try:
+                profiles[profile] = parse_profile(profile, config[section])
+            except (KeyError, ValueError):
+                # Missing or invalid settings, profile_config() will report the error
+                log.info('Not indexing AWS profile %s', profile)
+
+        if key is None:
+            return profiles
+        if not utils.private_dir(self.fpath.parent):
+            log.warning('Not indexing AWS profiles, %s is owned by another user', self.fpath.parent)
+            return profiles
+
+        data = {profile: list(conf) for profile, conf in profiles.items()}
+        utils.atomic_write(self.fpath, msgpack.packb([key, data]))
+
+        return profiles
+
+    def profiles(self) -> dict[str, ProfileConfig]:
+        profiles = self.read()
+        return self.build() if profiles is None else profiles
+
+
+def profile_config(profile, *, config_fpath=None) -> ProfileConfig:
+    """Return the given profile's information from the AWS config file"""
+    fpath = aws_config_fpath(config_fpath)
+    if conf := ProfileIndex(fpath).profiles().get(profile):
+        return conf
+
+    # Not an env-config profile, parse it directly so the error is the same as it's always been
+    config = read_config(fpath)
+    return parse_profile(profile, config[f'profile {profile}'])
 
 
-@dataclass
-class AWSAuth:
+def env_config_profiles(*, config_fpath=None) -> list[str]:
+    """Return names of AWS config profiles that get their credentials from env-config"""
+    return list(ProfileIndex(aws_config_fpath(config_fpath)).profiles())
+
+
+def env_config_duration(profile: str) -> int | None:
+    """
+    Return the session duration configured for the AWS profile in env-config.yaml.  The config is
+    found the same way env-config finds it.
+    """
+    # Imported here b/c they are slow and only needed when generating credentials
+    from . import config
+    from .core import UserError
+
+    caller = utils.current_caller()
+    start_at = caller.environ().get('ENV_CONFIG_CONFIG')
+    try:
+        conf = config.load(caller.path(start_at) if start_at else Path(caller.cwd or Path.cwd()))
+        aws_conf = conf.view(caller.env).get('aws') or {}
+        duration = (aws_conf.get('profile') or {}).get(profile, aws_conf.get('duration'))
+        return None if duration is None else int(duration)
+    except UserError:
+        return None
+    except Exception:
+        # E.g. a malformed env-config.yaml in the current directory.  Credentials are still needed
+        # so use the default duration.
+        log.warning('Unable to read session duration for %s', profile, exc_info=True)
+        return None
+
+
+def session_duration(profile: ProfileConfig) -> int:
+    """
+    Return how many seconds the profile's session credentials should be valid for.  Comes from the
+    AWS config's envconfig_duration, env-config.yaml, or the default, limited to what STS allows.
+    """
+    duration = int(profile.duration or env_config_duration(profile.profile) or SESSION_DURATION)
+    limited = min(max(duration, SESSION_DURATION_MIN), SESSION_DURATION_MAX)
+    if limited != duration:
+        log.info('Session duration %s for %s limited to %s', duration, profile.profile, limited)
+    return limited
+
+
+class AWSAuth(NamedTuple):
     """Permanent credentials needed to generate a temporary session"""
 
     access_key_id: str
@@ -51,31 +216,67 @@ class AWSAuth:
 
 
 def op_auth(op_ref_base: str, mfa_serial: str = ''):
-    op_ref_base = op_ref_base.rstrip('/')
-    op_access_key = f'{op_ref_base}/access-key-id'
-    op_secret_key = f'{op_ref_base}/secret-access-key'
+    """
+    Read the AWS keys, and the MFA code when needed, from the 1Pass item at `op_ref_base`.  The
+    item is fetched once and the fields are taken from it, within OP_AUTH_TIMEOUT seconds.
+    """
+    access_key_ref = utils.op_ref_split(f'{op_ref_base.rstrip("/")}/access-key-id')
+    with utils.call_limits(OP_AUTH_TIMEOUT):
+        item = utils.op_item_get(access_key_ref)
 
     mfa_code = None
     if mfa_serial:
-        op_mfa_ref = f'{op_ref_base}/Security/one-time password?attribute=otp'
-        mfa_code = utils.op_read(op_mfa_ref)
+        mfa_ref = access_key_ref._replace(
+            section='Security',
+            field='one-time password',
+            attribute='otp',
+        )
+        mfa_code = utils.op_item_field(item, mfa_ref)
 
     return AWSAuth(
-        utils.op_read(op_access_key),
-        utils.op_read(op_secret_key),
+        utils.op_item_field(item, access_key_ref),
+        utils.op_item_field(item, access_key_ref._replace(field='secret-access-key')),
         mfa_serial,
         mfa_code,
     )
 
 
-@serde.serde
-class SessCreds:
+class SessCreds(NamedTuple):
     """Temporary session credentials"""
 
     access_key_id: str
     secret_key: str
     session_token: str
     expiration: dt.datetime
+    # Not known for credentials cached by older versions
+    issued_at: dt.datetime | None = None
+
+    def to_msgpack(self) -> bytes:
+        fields = {
+            'access_key_id': self.access_key_id,
+            'secret_key': self.secret_key,
+            'session_token': self.session_token,
+            'expiration': self.expiration.isoformat(),
+        }
+        if self.issued_at:
+            fields['issued_at'] = self.issued_at.isoformat()
+        return msgpack.packb(fields)
+
+    @classmethod
+    def from_msgpack(cls, data: bytes) -> 'SessCreds':
+        fields = msgpack.unpackb(data)
+        fields['expiration'] = dt.datetime.fromisoformat(fields['expiration'])
+        if issued_at := fields.get('issued_at'):
+            fields['issued_at'] = dt.datetime.fromisoformat(issued_at)
+        return cls(**fields)
+
+    def needs_renewal(self, fraction: float) -> bool:
+        """True when the credentials are at least `fraction` of the way through their lifetime"""
+        if not 0 < fraction < 1:
+            return False
+
+        issued_at = self.issued_at or self.expiration - dt.timedelta(seconds=SESSION_DURATION)
+        return utils.utc_now() >= issued_at + (self.expiration - issued_at) * fraction
 
     def to_env_dict(self):
         return {
@@ -86,6 +287,8 @@ class SessCreds:
         }
 
     def cli_json(self):
+        import json
+
         return json.dumps(
             {
                 'Version': 1,
@@ -97,16 +300,18 @@ class SessCreds:
         )
 
 
-def sts_session(auth: AWSAuth) -> SessCreds:
+def sts_session(auth: AWSAuth, duration: int = SESSION_DURATION) -> SessCreds:
+    # Imported here b/c it's slow and not needed when cached credentials are used
+    with timings.span('import boto3'):
+        import boto3
+
     session = boto3.Session(
         aws_access_key_id=auth.access_key_id,
         aws_secret_access_key=auth.secret_key,
     )
     sts_client = session.client('sts')
     response = sts_client.get_session_token(
-        # TODO: we should be able to change this but I'm not sure where that should live?  A custom
-        # value in the AWS config profile?  env-config.yaml?
-        DurationSeconds=3600,
+        DurationSeconds=duration,
         SerialNumber=auth.mfa_serial,
         TokenCode=auth.mfa_code,
     )
@@ -116,34 +321,325 @@ def sts_session(auth: AWSAuth) -> SessCreds:
         creds['SecretAccessKey'],
         creds['SessionToken'],
         creds['Expiration'],
+        creds['Expiration'] - dt.timedelta(seconds=duration),
     )
 
 
-def op_sess_creds(op_ref_base: str, mfa_serial: str = '', _cache_dpath: Path | None = None):
+def sess_creds_cache(
+    op_ref_base: str,
+    mfa_serial: str = '',
+    cache_dpath: Path | None = None,
+) -> utils.EncryptedTempFile:
+    return utils.EncryptedTempFile(op_ref_base + mfa_serial, dpath=cache_dpath, namespace='aws')
+
+
+def cached_sess_creds(enc_tmp: utils.EncryptedTempFile) -> SessCreds | None:
+    """Return cached session credentials if they exist and aren't about to expire"""
+    threshold = refresh_threshold()
+    try:
+        # Credentials that expire soon aren't decrypted
+        data = enc_tmp.read(fresh_for=threshold)
+        creds = None if data is None else SessCreds.from_msgpack(data)
+    except Exception:
+        log.exception('Error getting encrypted cached credentials')
+        return None
+
+    if creds is None:
+        log.info('No cached credentials existed or they expire soon.')
+        return None
+
+    # Expiration isn't known before decrypting credentials cached by older versions
+    # Hits aren't logged here so logging isn't imported on the cached credentials path.  Callers
+    # log the event, see log_event().
+    if creds.expiration > utils.utc_now_in(seconds=threshold):
+        return creds
+
+    log.info('Cached credentials existed but have expired or will soon')
+    return None
+
+
+def refresh_threshold() -> int:
+    """Return seconds before expiration that credentials are regenerated before being used"""
+    try:
+        env = utils.current_caller().environ()
+        return int(env.get(REFRESH_THRESHOLD_ENVVAR, REFRESH_THRESHOLD_DEFAULT))
+    except ValueError:
+        log.info('Invalid %s, using %s', REFRESH_THRESHOLD_ENVVAR, REFRESH_THRESHOLD_DEFAULT)
+        return REFRESH_THRESHOLD_DEFAULT
+
+
+def refresh_ahead() -> float:
+    """Return how far into their lifetime credentials are renewed in the background"""
+    try:
+        env = utils.current_caller().environ()
+        return float(env.get(REFRESH_AHEAD_ENVVAR, REFRESH_AHEAD_DEFAULT))
+    except ValueError:
+        log.info('Invalid %s, using %s', REFRESH_AHEAD_ENVVAR, REFRESH_AHEAD_DEFAULT)
+        return REFRESH_AHEAD_DEFAULT
+
+
+def log_event(event: str, profile: str, start: float | None = None, **fields):
+    """
+    Log a structured event used by `env-config-aws stats`.  When `start` (from perf_counter) is
+    given, the time since then is included.
+    """
+    if start is not None:
+        fields['duration_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    if utils.logs_deferred:
+        # Not worth importing logging for, e.g. on the cached credentials path
+        utils.write_log(
+            'aws',
+            'log_event',
+            f'{event} {profile}',
+            event=event,
+            profile=profile,
+            **fields,
+        )
+        return
+    log.info('%s %s', event, profile, extra={'event': event, 'profile': profile, **fields})
+
+
+def renew_marker(enc_tmp: utils.EncryptedTempFile) -> Path:
+    return enc_tmp.fpath.with_suffix('.renewing')
+
+
+def renew_in_background(
+    op_ref_base: str,
+    mfa_serial: str = '',
+    cache_dpath: Path | None = None,
+    duration: int | None = None,
+    profile: str = '',
+):
+    """
+    Start a detached process that renews the cached session credentials.  The caller doesn't wait
+    for it.  Only one renewal per cache entry is started at a time.  Without a `duration`, the
+    process finds it with session_duration().
+    """
+    marker = renew_marker(sess_creds_cache(op_ref_base, mfa_serial, cache_dpath))
+    try:
+        if time.time() - marker.stat().st_mtime < RENEW_TIMEOUT:
+            log.info('Background renewal already in progress')
+            return
+    except FileNotFoundError:
+        pass
+    marker.touch()
+
+    # Imported here b/c they are only needed when renewing and this is on the hot path
+    import subprocess
+    import sys
+
+    args = [
+        sys.executable,
+        '-m',
+        'env_config.aws',
+        op_ref_base,
+        mfa_serial,
+        str(duration or 0),
+        profile,
+    ]
+    if cache_dpath:
+        args.append(str(cache_dpath))
+
+    log_event('refresh_ahead', profile)
+    subprocess.Popen(
+        args,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def background_renewal(
+    op_ref_base: str,
+    mfa_serial: str,
+    duration: int,
+    profile: str,
+    cache_dpath: Path | None = None,
+):
+    """The process renew_in_background() starts.  Removes the marker it left once done."""
+    try:
+        renew_sess_creds(
+            op_ref_base,
+            mfa_serial,
+            cache_dpath,
+            ahead=True,
+            duration=session_duration(ProfileConfig(profile, op_ref_base, mfa_serial, duration)),
+            profile=profile,
+        )
+    finally:
+        # Only here, a renewal in the foreground would remove the marker of one in progress
+        renew_marker(sess_creds_cache(op_ref_base, mfa_serial, cache_dpath)).unlink(missing_ok=True)
+
+
+def renew_sess_creds(
+    op_ref_base: str,
+    mfa_serial: str = '',
+    cache_dpath: Path | None = None,
+    ahead: bool = False,
+    duration: int = SESSION_DURATION,
+    profile: str = '',
+) -> SessCreds:
+    """
+    Generate new session credentials and cache them.
+
+    Only one process at a time generates credentials for the same cache.  Others wait for it and
+    then use the credentials it cached.  With `ahead`, cached credentials are only used if they no
+    longer need renewing ahead of expiration.
+    """
+    enc_tmp = sess_creds_cache(op_ref_base, mfa_serial, cache_dpath)
+    with enc_tmp.lock(timeout=LOCK_TIMEOUT):
+        # Another process may have renewed them while this one waited for the lock
+        creds = cached_sess_creds(enc_tmp)
+        if creds and not (ahead and creds.needs_renewal(refresh_ahead())):
+            return creds
+
+        start = time.perf_counter()
+        with timings.span('op_auth'):
+            perm_auth = op_auth(op_ref_base, mfa_serial)
+        with timings.span('sts_session'):
+            sess_auth = sts_session(perm_auth, duration)
+
+        log.info('Saving credential cache to %s', enc_tmp.store.fpath)
+        enc_tmp.save(sess_auth.to_msgpack(), sess_auth.expiration.timestamp())
+        log_event('generate', profile, start, ahead=ahead)
+
+    return sess_auth
+
+
+def op_sess_creds(
+    op_ref_base: str,
+    mfa_serial: str = '',
+    _cache_dpath: Path | None = None,
+    duration: int = SESSION_DURATION,
+    profile: str = '',
+):
     """
     Given a 1Pass item reference, return session credentials.  Cache session credentials
-    in encrypted file to avoid the delay of 1Pass lookup + session gen.
+    encrypted in the cache store to avoid the delay of 1Pass lookup + session gen.
+
+    `profile` is only used for logging.
+    """
+    start = time.perf_counter()
+    enc_tmp = sess_creds_cache(op_ref_base, mfa_serial, _cache_dpath)
+    if creds := cached_sess_creds(enc_tmp):
+        if creds.needs_renewal(refresh_ahead()):
+            renew_in_background(op_ref_base, mfa_serial, _cache_dpath, duration, profile)
+        log_event('creds', profile, start, cache='hit')
+        return creds
+
+    creds = renew_sess_creds(
+        op_ref_base,
+        mfa_serial,
+        _cache_dpath,
+        duration=duration,
+        profile=profile,
+    )
+    log_event('creds', profile, start, cache='miss')
+    return creds
+
+
+class PrewarmResult(NamedTuple):
+    profile: str
+    seconds: float
+    creds: SessCreds | None = None
+    error: Exception | None = None
+
+
+def prewarm(profiles: list[ProfileConfig], concurrency: int = 4) -> list[PrewarmResult]:
     """
-    enc_tmp = utils.EncryptedTempFile(op_ref_base + mfa_serial, dpath=_cache_dpath)
-    if enc_tmp.exists():
+    Get session credentials for the profiles, concurrently, so they are cached before they're
+    needed.  Results are in the same order as the profiles.
+    """
+    # Imported here b/c it's not needed on the cached credentials path
+    from concurrent.futures import ThreadPoolExecutor
+
+    def fetch(config: ProfileConfig) -> PrewarmResult:
+        start = time.perf_counter()
         try:
-            creds: SessCreds = from_msgpack(SessCreds, enc_tmp.read())
-
-            # If the creds expire within the next five minutes, regenerate them
-            if creds.expiration > utils.utc_now_in(minutes=5):
-                log.info('Using cached credentials from %s', enc_tmp.fpath)
-                return creds
-            else:
-                log.info('Cached credentials existed but have expired or will soon')
-        except Exception:
-            log.exception('Error getting encrypted cached credentials')
-    else:
-        log.info('No cached credentials existed.')
+            duration = session_duration(config)
+            creds = op_sess_creds(
+                config.op_ref_base,
+                config.mfa_serial,
+                duration=duration,
+                profile=config.profile,
+            )
+        except Exception as e:
+            log.exception('Unable to prewarm %s', config.profile)
+            return PrewarmResult(config.profile, time.perf_counter() - start, error=e)
+        return PrewarmResult(config.profile, time.perf_counter() - start, creds)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(fetch, profiles))
+
+
+class CredsStats(NamedTuple):
+    requests: int
+    # Served from the cache or the agent
+    hits: int
+    # Credentials generated with 1Pass + STS, including `ahead` of expiration in the background
+    generated: int
+    ahead: int
+    p50_ms: float | None
+    p95_ms: float | None
+
+    @property
+    def hit_rate(self) -> float | None:
+        return self.hits / self.requests if self.requests else None
+
+
+def percentile(sorted_values: list[float], pct: int) -> float | None:
+    """Nearest-rank percentile"""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-pct * len(sorted_values) // 100))
+    return sorted_values[rank - 1]
+
+
+def creds_stats(records) -> dict[str, CredsStats]:
+    """Summarize the logged credential events per profile"""
+    durations: dict[str, list[float]] = {}
+    counts: dict[str, dict[str, int]] = {}
+
+    for record in records:
+        event = record.get('event')
+        profile = record.get('profile')
+        if event not in ('creds', 'generate') or not profile:
+            continue
+
+        if profile not in counts:
+            counts[profile] = dict.fromkeys(('requests', 'hits', 'generated', 'ahead'), 0)
+        profile_counts = counts[profile]
+        if event == 'creds':
+            profile_counts['requests'] += 1
+            profile_counts['hits'] += record.get('cache') in ('hit', 'agent')
+            if 'duration_ms' in record:
+                durations.setdefault(profile, []).append(record['duration_ms'])
+        else:
+            profile_counts['generated'] += 1
+            profile_counts['ahead'] += bool(record.get('ahead'))
+
+    stats = {}
+    for profile in sorted(counts):
+        profile_durations = sorted(durations.get(profile, []))
+        stats[profile] = CredsStats(
+            **counts[profile],
+            p50_ms=percentile(profile_durations, 50),
+            p95_ms=percentile(profile_durations, 95),
+        )
+    return stats
 
-    perm_auth = op_auth(op_ref_base, mfa_serial)
-    sess_auth = sts_session(perm_auth)
 
-    log.info('Saving credential cache to %s', enc_tmp.fpath)
-    enc_tmp.save(to_msgpack(sess_auth))
+if __name__ == '__main__':
+    # Background renewal started by renew_in_background()
+    import sys
 
-    return sess_auth
+    utils.init_logs()
+    op_ref_base, mfa_serial, duration, profile, *cache_dpath = sys.argv[1:]
+    background_renewal(
+        op_ref_base,
+        mfa_serial,
+        int(duration),
+        profile,
+        Path(cache_dpath[0]) if cache_dpath else None,
+    )
@@ -0,0 +1,105 @@
+import logging
+from pathlib import Path
+import time
+
+import msgpack
+
+from . import utils
+
+
+log = logging.getLogger(__name__)
+
+
+class SecretCache:
+    """
+    Encrypted, time limited cache of resolved values (e.g. 1Pass secrets) so switching to a profile
+    that was used recently doesn't need to resolve them again.  Values are kept in the same
+    utils.CacheStore as the AWS session credentials.
+
+    Same caveat as EncryptedTempFile: NOT ROBUST against determined attacker!
+    """
+
+    namespace = 'secret'
+
+    def __init__(self, dpath: Path | None = None, refresh: bool = False):
+        self.store: utils.CacheStore = utils.CacheStore(dpath)
+        # Where older versions saved each value to its own file
+        self.legacy_dpath: Path = self.store.dpath / 'secrets'
+        # Ignore cached values but still save newly resolved ones
+        self.refresh: bool = refresh
+
+    def enc_file(self, key: str) -> utils.EncryptedTempFile:
+        return utils.EncryptedTempFile(
+            key,
+            dpath=self.legacy_dpath,
+            store=self.store,
+            namespace=self.namespace,
+        )
+
+    def get(self, key: str) -> str | None:
+        if self.refresh:
+            return None
+
+        enc_tmp = self.enc_file(key)
+        try:
+            data = enc_tmp.read()
+            entry = None if data is None else msgpack.unpackb(data)
+        except Exception:
+            log.info('Unable to read cached value for %s', enc_tmp.store_key)
+            return None
+
+        # Values cached by older versions haven't been checked for expiry yet
+        if entry is None or entry['expires_at'] <= time.time():
+            return None
+
+        return entry['value']
+
+    def set(self, key: str, value: str, ttl: int) -> None:
+        if ttl <= 0:
+            return
+
+        entry = {'value': value, 'expires_at': time.time() + ttl}
+        self.enc_file(key).save(msgpack.packb(entry), entry['expires_at'])
+
+    def clear(self) -> int:
+        """Delete all cached values and return how many there were"""
+        count = self.store.clear(f'{self.namespace}:')
+        for fpath in self.legacy_dpath.glob('*.bin'):
+            fpath.unlink(missing_ok=True)
+            count += 1
+        return count
+
+
+class MemorySecretCache:
+    """
+    In-memory equivalent of SecretCache used by the agent.  Instances can share a store so each
+    request can have its own `refresh` setting.  Values are kept per `identity`, e.g. the 1Pass
+    account and credentials they were read with, so clients only get what they could resolve.
+    """
+
+    def __init__(self, store: dict | None = None, refresh: bool = False, identity: str = ''):
+        # (identity, key) -> (value, expires_at)
+        self.store: dict[tuple[str, str], tuple[str, float]] = {} if store is None else store
+        self.refresh: bool = refresh
+        self.identity: str = identity
+
+    def get(self, key: str) -> str | None:
+        entry = None if self.refresh else self.store.get((self.identity, key))
+        if entry is None:
+            return None
+
+        value, expires_at = entry
+        if expires_at <= time.time():
+            self.store.pop((self.identity, key), None)
+            return None
+
+        return value
+
+    def set(self, key: str, value: str, ttl: int) -> None:
+        if ttl > 0:
+            self.store[(self.identity, key)] = (value, time.time() + ttl)
+
+    def clear(self) -> int:
+        count = len(self.store)
+        self.store.clear()
+        return count
@@ -1,12 +1,14 @@
 import logging
+import os
 from os import environ
 from pathlib import Path
 import sys
 
 import click
 
-from . import aws, config, utils
-from .core import BashEnvConfig, FishEnvConfig, UserError
+from . import agent, aws, config, hook, timings, utils
+from .cache import SecretCache
+from .core import BashEnvConfig, EnvConfig, FishEnvConfig, ShellEnvConfig, UserError
 
 
 ENVVAR_PREFIX = 'ENV_CONFIG'
@@ -18,16 +20,6 @@ def print_err(*args, **kwargs):
     print(*args, file=sys.stderr, flush=True, **kwargs)
 
 
-def init_logs():
-    utils.TMP_DPATH.mkdir(exist_ok=True)
-    logging.basicConfig(
-        filename=utils.TMP_DPATH / 'env-config.log',
-        level=logging.INFO,
-        encoding='utf-8',
-        format='%(asctime)s %(module)s %(funcName)s %(message)s',
-    )
-
-
 @click.command()
 @click.argument('profiles', nargs=-1)
 @click.option('--shell', type=click.Choice(('fish', 'bash')), required=True)
@@ -44,6 +36,14 @@ def init_logs():
     is_flag=True,
     help='Only add new vars to environment.  Do not delete existing first.',
 )
+@click.option(
+    '--switch',
+    '-s',
+    'is_switch',
+    is_flag=True,
+    help='Only unset and set vars that differ from the active profiles.  Unchanged vars are not'
+    ' resolved again.',
+)
 @click.option(
     '--debug',
     '-d',
@@ -65,6 +65,54 @@ def init_logs():
     is_flag=True,
     help='List profile and group names in config',
 )
+@click.option(
+    '--concurrency',
+    '-j',
+    type=click.IntRange(min=1),
+    default=EnvConfig.default_concurrency,
+    show_default=True,
+    help='Max number of values (e.g. 1Pass secrets) to resolve at the same time',
+)
+@click.option(
+    '--batch/--no-batch',
+    default=False,
+    help='Resolve 1Pass secrets with one `op inject` call per account instead of one call each',
+)
+@click.option(
+    '--timeout',
+    type=click.FloatRange(min=0, min_open=True),
+    default=EnvConfig.default_timeout,
+    show_default=True,
+    help='Max seconds to spend resolving values.  ENV_CONFIG_CALL_TIMEOUT limits each `op` call.',
+)
+@click.option(
+    '--cache-ttl',
+    type=click.IntRange(min=0),
+    help="Seconds to cache resolved secrets.  Overrides the config's `cache.ttl` default.",
+)
+@click.option(
+    '--cache/--no-cache',
+    'use_cache',
+    default=True,
+    help="Don't read or save cached secrets",
+)
+@click.option(
+    '--refresh',
+    is_flag=True,
+    help='Ignore cached secrets but cache the newly resolved values',
+)
+@click.option(
+    '--agent/--no-agent',
+    'use_agent',
+    default=True,
+    help='Resolve secrets with the env-config agent, when it is running',
+)
+@click.option(
+    '--timings',
+    'show_timings',
+    is_flag=True,
+    help='Print how long each phase (loading config, resolving secrets, etc.) took to stderr',
+)
 @click.pass_context
 def env_config(
     ctx: click.Context,
@@ -72,21 +120,44 @@ def env_config(
     profiles: list[str],
     config_fpath: Path | None,
     is_update: bool,
+    is_switch: bool,
     is_debug: bool,
     is_clear: bool,
     list_profiles: bool,
+    concurrency: int,
+    batch: bool,
+    timeout: float,
+    cache_ttl: int | None,
+    use_cache: bool,
+    refresh: bool,
+    use_agent: bool,
+    show_timings: bool,
 ):
+    if show_timings:
+        timings.enable()
+
     try:
         start_at = config_fpath or Path.cwd()
-        conf = config.load(start_at)
+        config_fpath = config.find(start_at)
+        conf = config.load(config_fpath)
 
-        envconf = FishEnvConfig(conf) if shell == 'fish' else BashEnvConfig(conf)
+        envconf_cls = FishEnvConfig if shell == 'fish' else BashEnvConfig
+        envconf = envconf_cls(
+            conf,
+            concurrency=concurrency,
+            batch=batch,
+            timeout=timeout,
+            cache=SecretCache(refresh=refresh) if use_cache else None,
+            cache_ttl=cache_ttl,
+            agent=agent.AgentClient() if use_agent and not agent.disabled() else None,
+            config_fpath=config_fpath,
+        )
 
         if list_profiles:
             print('Profiles:\n    ', end='')
-            print('\n    '.join(conf.profile))
+            print('\n    '.join(conf.profiles))
             print('Groups:\n    ', end='')
-            print('\n    '.join(conf.group))
+            print('\n    '.join(conf.groups))
             return
 
         is_show = False
@@ -97,6 +168,10 @@ def env_config(
                 print_err('No env-config profiles currently in use.')
                 return
 
+        if is_switch and not is_update and not is_show and not is_clear:
+            switch(envconf, profiles, is_debug)
+            return
+
         if not is_update and not is_show:
             present_vars = sorted(envconf.present_env_vars())
             print_err('Clearing:')
@@ -125,6 +200,274 @@ def env_config(
         ctx.fail(str(e))
 
 
+def switch(envconf: ShellEnvConfig, profiles: list[str], is_debug: bool):
+    to_unset, to_set, unchanged = envconf.switch_plan(profiles)
+
+    print_err('Clearing:')
+    print_err('    ', ', '.join(to_unset) if to_unset else 'No configured vars need to be cleared.')
+    print_err('Profiles active:', ' '.join(profiles))
+    print_err('Setting:')
+    selected = envconf.select(profiles)
+    for var in to_set:
+        print_err(f'    {var}:', selected[var])
+    if unchanged:
+        print_err('Unchanged:')
+        print_err('    ', ', '.join(unchanged))
+
+    if not is_debug:
+        envconf.switch(profiles)
+
+
+@click.command(
+    context_settings={'ignore_unknown_options': True, 'allow_interspersed_args': False},
+)
+@click.option(
+    '--config',
+    'config_fpath',
+    type=click.Path(dir_okay=False, path_type=Path),
+    help='Default looks for env-config.yaml in CWD & parents',
+)
+@click.option(
+    '--concurrency',
+    '-j',
+    type=click.IntRange(min=1),
+    default=EnvConfig.default_concurrency,
+    show_default=True,
+    help='Max number of values (e.g. 1Pass secrets) to resolve at the same time',
+)
+@click.option(
+    '--batch/--no-batch',
+    default=False,
+    help='Resolve 1Pass secrets with one `op inject` call per account instead of one call each',
+)
+@click.option(
+    '--timeout',
+    type=click.FloatRange(min=0, min_open=True),
+    default=EnvConfig.default_timeout,
+    show_default=True,
+    help='Max seconds to spend resolving values.  ENV_CONFIG_CALL_TIMEOUT limits each `op` call.',
+)
+@click.option(
+    '--cache/--no-cache',
+    'use_cache',
+    default=True,
+    help="Don't read or save cached secrets",
+)
+@click.option(
+    '--agent/--no-agent',
+    'use_agent',
+    default=True,
+    help='Resolve secrets with the env-config agent, when it is running',
+)
+@click.argument('args', nargs=-1, type=click.UNPROCESSED)
+@click.pass_context
+def env_config_exec(
+    ctx: click.Context,
+    config_fpath: Path | None,
+    concurrency: int,
+    batch: bool,
+    timeout: float,
+    use_cache: bool,
+    use_agent: bool,
+    args: tuple[str, ...],
+):
+    """
+    Run a command with the vars of the given profiles added to the environment:
+
+        env-config exec PROFILES... -- COMMAND [ARGS]...
+
+    The command replaces env-config's process, no shell is involved.
+    """
+    if '--' not in args:
+        ctx.fail('Separate profiles and the command with --, e.g. env-config exec tng -- make test')
+    sep_at = args.index('--')
+    profiles, command = list(args[:sep_at]), list(args[sep_at + 1 :])
+    if not profiles or not command:
+        ctx.fail('Both profiles and a command are required')
+
+    try:
+        config_fpath = config.find(config_fpath or Path.cwd())
+        envconf = EnvConfig(
+            config.load(config_fpath),
+            concurrency=concurrency,
+            batch=batch,
+            timeout=timeout,
+            cache=SecretCache() if use_cache else None,
+            agent=agent.AgentClient() if use_agent and not agent.disabled() else None,
+            config_fpath=config_fpath,
+        )
+        # A typo shouldn't run the command without the vars it needs
+        if unknown := [name for name in profiles if name not in envconf.index.positions]:
+            raise UserError(f'Unknown profiles or groups: {", ".join(unknown)}')
+        env_vars = envconf.resolve(profiles)
+    except UserError as e:
+        ctx.fail(str(e))
+
+    env = environ | {name: str(value) for name, value in env_vars.items()}
+    try:
+        os.execvpe(command[0], command, env)
+    except OSError as e:
+        # Same exit codes as shells use for a command that can't be found or run
+        print_err(f'env-config exec: {command[0]}: {e.strerror}')
+        ctx.exit(127 if isinstance(e, FileNotFoundError) else 126)
+
+
+@click.group(invoke_without_command=True)
+@click.option('--shell', type=click.Choice(('fish', 'bash')))
+@click.pass_context
+def env_config_hook(ctx: click.Context, shell: str | None):
+    """
+    Activate the `hook.profiles` of the current directory's config and clear what was activated
+    for the previous directory's config.  Run by the shell integration before every prompt.  Only
+    configs allowed with `env-config hook allow` are activated.
+    """
+    if ctx.invoked_subcommand is not None:
+        return
+    if shell is None:
+        ctx.fail('Missing option --shell')
+
+    try:
+        cwd = str(Path.cwd())
+    except OSError:
+        # The current directory was deleted
+        return
+
+    envconf_cls = FishEnvConfig if shell == 'fish' else BashEnvConfig
+    active_fpath = environ.get(hook.ENVVAR, '')
+
+    if (cached := hook.read_cache(cwd)) is not None:
+        config_fpath, profiles = cached
+    else:
+        config_fpath, stamps = hook.find(cwd)
+        profiles = []
+        if config_fpath:
+            # Before checking so allowing the config while checking isn't missed
+            stamps[hook.allow_fpath()] = hook.stamp(hook.allow_fpath())
+            try:
+                profiles = envconf_cls(config.load(Path(config_fpath))).hook_profiles()
+            except Exception as e:
+                print_err(f'env-config hook: unable to load {config_fpath}: {e}')
+            if profiles and not hook.is_allowed(config_fpath):
+                print_hook_not_allowed(config_fpath)
+                profiles = []
+        hook.save_cache(cwd, config_fpath, profiles, stamps)
+
+    target_fpath = hook.target(config_fpath, profiles)
+    # Checked again, the config could have changed since the cached lookup
+    if target_fpath and not hook.is_allowed(target_fpath):
+        print_hook_not_allowed(target_fpath)
+        target_fpath = ''
+    if active_fpath == target_fpath:
+        return
+
+    try:
+        if active_fpath and Path(active_fpath).exists():
+            envconf_cls(config.load(Path(active_fpath))).clear_present_env_vars()
+            print_err('env-config hook: cleared profiles for', active_fpath)
+
+        if target_fpath:
+            envconf = envconf_cls(
+                config.load(Path(target_fpath)),
+                cache=SecretCache(),
+                agent=agent.AgentClient() if not agent.disabled() else None,
+                config_fpath=Path(target_fpath),
+            )
+            envconf.clear_present_env_vars()
+            envconf.set(profiles)
+            print_err('env-config hook: profiles active:', ' '.join(profiles))
+    except UserError as e:
+        # Still record the config below so the failure isn't repeated at every prompt
+        print_err(f'env-config hook: {e}')
+
+    print(envconf_cls.source_header)
+    if target_fpath:
+        print(envconf_cls.export_cmd(hook.ENVVAR, target_fpath))
+    else:
+        print(envconf_cls.unset_cmd(hook.ENVVAR))
+
+
+def print_hook_not_allowed(config_fpath: str):
+    print_err(
+        f'env-config hook: {config_fpath} is not allowed, review it and run `env-config hook allow`'
+        ' to activate its profiles',
+    )
+
+
+@env_config_hook.command('allow')
+@click.argument('path', type=click.Path(exists=True, path_type=Path), required=False)
+@click.pass_context
+def hook_allow(ctx: click.Context, path: Path | None):
+    """
+    Allow the hook to activate the profiles of the config for PATH, a directory (default: CWD) or
+    .yaml file.  A config needs allowing again after it changes.
+    """
+    try:
+        config_fpath = config.find((path or Path.cwd()).absolute())
+        real_fpath = hook.allow(str(config_fpath))
+    except UserError as e:
+        ctx.fail(str(e))
+    except OSError as e:
+        print_err(f'env-config hook: unable to allow {path or Path.cwd()}: {e}')
+        ctx.exit(1)
+
+    print_err('env-config hook: allowed', real_fpath)
+
+
+@click.group()
+def env_config_cache():
+    """Manage cached secrets and AWS credentials"""
+
+
+@env_config_cache.command('clear')
+def cache_clear():
+    """Delete all cached secrets"""
+    count = SecretCache().clear()
+    print_err(f'Deleted {count} cached secret(s).')
+
+
+@env_config_cache.command('gc')
+def cache_gc():
+    """Delete expired cache entries and files left by older versions"""
+    count = utils.CacheStore().gc()
+    print_err(f'Deleted {count} expired or evicted cache entries and old file(s).')
+
+
+@click.command()
+@click.option(
+    '--ttl',
+    type=click.IntRange(min=0),
+    default=900,
+    show_default=True,
+    help="Seconds to keep resolved secrets in memory for configs that don't set `cache.ttl`",
+)
+@click.option('--status', is_flag=True, help='Show if the agent is running and exit')
+@click.pass_context
+def env_config_agent(ctx: click.Context, ttl: int, status: bool):
+    """
+    Run the env-config agent in the foreground.  While running, env-config and env-config-aws use
+    it to avoid parsing configs and resolving secrets on every invocation.
+    """
+    if status:
+        if info := agent.AgentClient().ping():
+            print_err(f'Agent running, pid: {info["pid"]}, configs loaded: {info["configs"]}')
+            return
+        print_err('Agent not running')
+        ctx.exit(1)
+
+    # Imported here b/c only needed when running the agent
+    from .agent_server import Agent, AgentServer
+
+    utils.init_logs()
+    server = AgentServer(Agent(ttl))
+    print_err('Agent listening on', server.socket_fpath)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
 @click.command()
 @click.argument('shell', type=click.Choice(('fish', 'bash')))
 def env_config_shell(shell):
@@ -136,12 +479,121 @@ def env_config_shell(shell):
 @click.command()
 @click.argument('aws_profile')
 def env_config_aws(aws_profile: str):
-    init_logs()
+    utils.init_logs()
 
     config = aws.profile_config(aws_profile)
-    sess_creds = aws.op_sess_creds(config.op_ref_base, config.mfa_serial)
+    sess_creds = aws.op_sess_creds(
+        config.op_ref_base,
+        config.mfa_serial,
+        duration=aws.session_duration(config),
+        profile=config.profile,
+    )
     print(sess_creds.cli_json())
 
 
+@click.command()
+@click.argument('profiles', nargs=-1)
+@click.option(
+    '-j',
+    '--concurrency',
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help='Max profiles to fetch credentials for at the same time',
+)
+@click.pass_context
+def env_config_aws_prewarm(ctx: click.Context, profiles: list[str], concurrency: int):
+    """
+    Cache session credentials for the given AWS profiles, or all profiles using env-config-aws, so
+    they are ready before they're needed (e.g. before a multi-account terraform run).
+    """
+    utils.init_logs()
+
+    profiles = profiles or aws.env_config_profiles()
+    if not profiles:
+        ctx.fail('No AWS profiles with envconfig_1pass found')
+
+    try:
+        configs = [aws.profile_config(profile) for profile in profiles]
+    except KeyError as e:
+        ctx.fail(f'AWS profile not found or missing settings: {e}')
+
+    results = aws.prewarm(configs, concurrency)
+
+    width = max(len(result.profile) for result in results)
+    for result in results:
+        if result.creds:
+            expires = result.creds.expiration.astimezone().strftime('%Y-%m-%d %H:%M:%S %Z')
+            status = f'expires {expires}'
+        else:
+            status = f'error: {result.error}'
+        print(f'{result.profile:<{width}}  {result.seconds:6.2f}s  {status}')
+
+    failed = sum(1 for result in results if result.error)
+    print(f'{len(results) - failed} of {len(results)} profiles ready')
+    if failed:
+        ctx.exit(1)
+
+
+@click.command()
+def env_config_aws_stats():
+    """
+    Summarize env-config-aws usage per profile from the logs: how often cached credentials were
+    used, how often credentials were generated, and how long requests took.
+    """
+    stats = aws.creds_stats(utils.read_logs())
+    if not stats:
+        print('No env-config-aws requests logged')
+        return
+
+    def ms(value: float | None) -> str:
+        return '-' if value is None else f'{value:.1f}ms'
+
+    width = max(len('Profile'), *(len(profile) for profile in stats))
+    print(
+        f'{"Profile":<{width}}  {"Requests":>8}  {"Hit rate":>8}  {"Generated":>9}  {"Ahead":>5}'
+        f'  {"p50":>9}  {"p95":>9}',
+    )
+    for profile, profile_stats in stats.items():
+        hit_rate = '-' if profile_stats.hit_rate is None else f'{profile_stats.hit_rate:.1%}'
+        print(
+            f'{profile:<{width}}  {profile_stats.requests:>8}  {hit_rate:>8}'
+            f'  {profile_stats.generated:>9}  {profile_stats.ahead:>5}'
+            f'  {ms(profile_stats.p50_ms):>9}  {ms(profile_stats.p95_ms):>9}',
+        )
+
+
+# Subcommands are dispatched by name so that profile names can still be the first argument to
+# env-config.  config.load() refuses profiles and groups with these names, keep
+# config.RESERVED_NAMES in sync.
+subcommands = {
+    'agent': env_config_agent,
+    'cache': env_config_cache,
+    'exec': env_config_exec,
+    'hook': env_config_hook,
+}
+
+
 def main():
+    args = sys.argv[1:]
+    if args and args[0] in subcommands:
+        subcommand = subcommands[args[0]]
+        return subcommand(args[1:], f'env-config {args[0]}', auto_envvar_prefix=ENVVAR_PREFIX)
+
     env_config(auto_envvar_prefix=ENVVAR_PREFIX)
+
+
+# Same as `subcommands` but for env-config-aws.  Keep entry.AWS_SUBCOMMANDS in sync.
+aws_subcommands = {
+    'prewarm': env_config_aws_prewarm,
+    'stats': env_config_aws_stats,
+}
+
+
+def aws_main():
+    args = sys.argv[1:]
+    if args and args[0] in aws_subcommands:
+        subcommand = aws_subcommands[args[0]]
+        return subcommand(args[1:], f'env-config-aws {args[0]}')
+
+    env_config_aws()
@@ -1,10 +1,22 @@
-from os import environ
+import hashlib
+import logging
 from pathlib import Path
 
 import dynamic_yaml
-from dynamic_yaml.yaml_wrappers import YamlDict
+from dynamic_yaml.yaml_wrappers import DynamicYamlObject, YamlDict
+import msgpack
 
-from . import core
+from . import core, model, timings, utils
+
+
+log = logging.getLogger(__name__)
+
+COMPILED_DPATH = utils.TMP_DPATH / 'configs'
+# Bump when the compiled format changes so old compiled configs are ignored
+COMPILED_VERSION = 2
+# `env-config` subcommands, see cli.subcommands.  A profile or group with one of these names could
+# never be activated, `env-config <name>` would run the subcommand instead.
+RESERVED_NAMES = frozenset(('agent', 'cache', 'exec', 'hook'))
 
 
 def find_upwards(d: Path, filename: str):
@@ -19,7 +31,140 @@ def find_upwards(d: Path, filename: str):
     return None
 
 
-def load(start_at: Path):
+class EnvAccess:
+    """Stand-in for `env` while compiling that records if a template used it"""
+
+    def __init__(self):
+        self.used = False
+
+    def __getattr__(self, name):
+        self.used = True
+        return ''
+
+    def __getitem__(self, name):
+        self.used = True
+        return ''
+
+
+def compile_value(obj: DynamicYamlObject, env_access: EnvAccess):
+    """
+    Return plain data (dicts, lists, scalars) for the given dynamic yaml object with templates
+    pre-rendered.  Templates that depend on `env`, fail to render, or render to something that
+    looks like another template are left as-is to be evaluated when the config is used.
+    """
+    collection = obj._collection
+    keys = collection.keys() if isinstance(obj, YamlDict) else range(len(collection))
+
+    data = {} if isinstance(obj, YamlDict) else []
+    for key in keys:
+        raw = collection[key]
+        if isinstance(raw, DynamicYamlObject):
+            value = compile_value(raw, env_access)
+        elif isinstance(raw, str) and '{' in raw:
+            env_access.used = False
+            try:
+                rendered = obj[key]
+            except Exception:
+                rendered = None
+            is_static = isinstance(rendered, str) and '{' not in rendered and '}' not in rendered
+            value = rendered if is_static and not env_access.used else raw
+        else:
+            value = raw
+
+        if isinstance(data, dict):
+            data[key] = value
+        else:
+            data.append(value)
+
+    return data
+
+
+class CompiledConfig:
+    """
+    Cache of a config file's parsed and pre-rendered content so most invocations don't need to
+    parse the YAML.  Stored in msgpack format and keyed by the config's path, mtime, size, and
+    content hash.
+    """
+
+    def __init__(self, config_fpath: Path, dpath: Path | None = None):
+        self.config_fpath: Path = config_fpath.resolve()
+        dpath = dpath or COMPILED_DPATH
+        fname = hashlib.sha256(str(self.config_fpath).encode()).hexdigest()
+        self.fpath: Path = dpath / f'{fname}.msgpack'
+
+    def key(self, content: bytes) -> list:
+        stat = self.config_fpath.stat()
+        return [
+            COMPILED_VERSION,
+            str(self.config_fpath),
+            stat.st_mtime_ns,
+            stat.st_size,
+            hashlib.sha256(content).hexdigest(),
+        ]
+
+    def read(self, content: bytes) -> tuple[dict, dict] | None:
+        """Return the compiled data and group profiles, see parse()"""
+        if not utils.is_private(self.fpath):
+            if self.fpath.exists():
+                log.warning('Ignoring compiled config not private to the user: %s', self.fpath)
+            return None
+
+        try:
+            key, data, group_profiles = msgpack.unpackb(
+                self.fpath.read_bytes(),
+                strict_map_key=False,
+            )
+        except Exception:
+            log.info('Unable to read compiled config %s', self.fpath)
+            return None
+
+        return (data, group_profiles) if key == self.key(content) else None
+
+    def save(self, content: bytes, data: dict, group_profiles: dict) -> None:
+        try:
+            packed = msgpack.packb([self.key(content), data, group_profiles])
+        except TypeError:
+            # Some YAML types (e.g. dates) can't be stored.  Just parse the config every time.
+            log.info('Unable to compile config %s', self.config_fpath)
+            return
+
+        if not utils.private_dir(self.fpath.parent):
+            log.warning('Not compiling config, %s is owned by another user', self.fpath.parent)
+            return
+        utils.atomic_write(self.fpath, packed)
+
+
+def parse(config_fpath: Path, compiled_dpath: Path | None = None) -> tuple[dict, dict]:
+    """
+    Return the config file's content as plain data with templates that don't depend on `env`
+    pre-rendered, and its groups' profiles, see model.group_closure().  Groups including themselves
+    raise a UserError.  Uses the compiled config when it's current.
+    """
+    content = config_fpath.read_bytes()
+    compiled = CompiledConfig(config_fpath, compiled_dpath)
+
+    if (compiled_data := compiled.read(content)) is not None:
+        return compiled_data
+
+    config = dynamic_yaml.load(content)
+
+    env_access = EnvAccess()
+    config._collection['env'] = env_access
+    data = compile_value(config, env_access)
+    del config._collection['env']
+    data.pop('env', None)
+
+    try:
+        group_profiles = model.group_closure(data.get('group') or {}, data.get('profile') or {})
+    except model.GroupCycleError as e:
+        raise core.UserError(f'{config_fpath}: {e}') from None
+
+    compiled.save(content, data, group_profiles)
+    return data, group_profiles
+
+
+def find(start_at: Path) -> Path:
+    """Return the config file for the given directory (searching upwards) or .yaml file"""
     if start_at.is_dir():
         config_fpath = find_upwards(start_at, 'env-config.yaml')
     elif start_at.suffix == '.yaml':
@@ -30,11 +175,19 @@ def load(start_at: Path):
     if config_fpath is None:
         raise core.UserError(f'No env-config.yaml in {start_at} or parents')
 
-    with config_fpath.open() as fo:
-        config = dynamic_yaml.load(fo)
+    return config_fpath
+
+
+def load(start_at: Path, compiled_dpath: Path | None = None) -> model.Config:
+    with timings.span('config.load'):
+        config_fpath = find(start_at)
+        conf = model.Config.build(*parse(config_fpath, compiled_dpath))
 
-    config._collection['env'] = YamlDict(environ)
-    config._collection.setdefault('group', {})
-    config._collection.setdefault('profile', YamlDict())
+    if reserved := RESERVED_NAMES & (conf.profiles.keys() | conf.groups.keys()):
+        names = ', '.join(sorted(reserved))
+        raise core.UserError(
+            f"{config_fpath}: profiles and groups can't be named {names}, those are env-config"
+            ' subcommands',
+        )
 
-    return config
+    return conf
@@ -1,10 +1,19 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from functools import cached_property
+import importlib
+import json
 import logging
 from os import environ
+from pathlib import Path
 import shlex
+import sys
+from typing import NamedTuple
 
-from dynamic_yaml.yaml_wrappers import YamlDict
-
-from . import utils
+from . import timings, utils
+from .agent import AgentClient
+from .cache import SecretCache
+from .model import Config, Section
 
 
 log = logging.getLogger(__name__)
@@ -14,12 +23,54 @@ class UserError(RuntimeError):
     pass
 
 
+class ResolveError(UserError):
+    """One or more config values could not be resolved"""
+
+    def __init__(self, errors: dict[str, Exception]):
+        self.errors = errors
+        lines = [f'    {name}: {error}' for name, error in errors.items()]
+        super().__init__('\n'.join(['Unable to resolve:', *lines]))
+
+
 class Resolver:
+    """
+    Resolves config values with a URI scheme, e.g. `op://`, to their actual value.  Subclasses
+    implement `convert(value)` and are registered by scheme, see ResolverRegistry.
+    """
+
     scheme: str
+    # False when the resolved value shouldn't be kept in the secret cache, e.g. it depends on the
+    # environment or current directory
+    cacheable: bool = True
+
+    @staticmethod
+    def convert(val: str) -> str:
+        raise NotImplementedError
 
     @classmethod
-    def use(cls, val: str) -> bool:
-        return val and val.startswith(cls.scheme)
+    def batch_key(cls, val: str) -> str | None:
+        """
+        Values with the same key can be resolved together with a single `convert_batch()` call.
+        None means the resolver doesn't support batching.
+        """
+        return None
+
+    @classmethod
+    def convert_batch(cls, vals: list[str]) -> list[str]:
+        return [cls.convert(val) for val in vals]
+
+    @classmethod
+    def group_key(cls, val: str) -> tuple | None:
+        """
+        Values with the same key are parts of the same thing (e.g. fields of a 1Pass item) and,
+        when not batching, are resolved together with a single `convert_group()` call.  None means
+        the value is resolved on its own.
+        """
+        return None
+
+    @classmethod
+    def convert_group(cls, vals: list[str]) -> list[str]:
+        return [cls.convert(val) for val in vals]
 
 
 class OPResolver(Resolver):
@@ -29,108 +80,549 @@ class OPResolver(Resolver):
     def convert(uri: str) -> bool:
         return utils.op_read(uri)
 
+    @classmethod
+    def batch_key(cls, uri: str) -> str:
+        # `op` can only work with one account at a time
+        account, _ = utils.op_ref_parse(uri)
+        return account or ''
+
+    @staticmethod
+    def convert_batch(uris: list[str]) -> list[str]:
+        parsed = [utils.op_ref_parse(uri) for uri in uris]
+        account = parsed[0][0]
+        return utils.op_inject([uri for _, uri in parsed], account)
+
+    @staticmethod
+    def group_key(uri: str) -> tuple | None:
+        try:
+            ref = utils.op_ref_split(uri)
+        except ValueError:
+            return None
+        # Names are matched case insensitively by `op`
+        return (ref.account or '', ref.vault.casefold(), ref.item.casefold())
+
+    @staticmethod
+    def convert_group(uris: list[str]) -> list[str]:
+        return utils.op_read_item(uris)
+
+
+# Scheme -> resolver as `module:ClassName`.  Imported when a value with the scheme is resolved.
+BUILTIN_RESOLVERS = {
+    'op': 'env_config.core:OPResolver',
+    'file': 'env_config.resolvers:FileResolver',
+    'env': 'env_config.resolvers:EnvResolver',
+    'cmd': 'env_config.resolvers:CmdResolver',
+}
+# Packages can provide resolvers for other schemes with entry points in this group, named by scheme
+RESOLVERS_ENTRY_POINT = 'env_config.resolvers'
+# Resolvers found in entry points, see ResolverRegistry.plugin_refs_cached()
+PLUGINS_FPATH = utils.TMP_DPATH / 'resolvers' / 'entry-points.json'
+
+
+class ResolverRegistry:
+    """
+    Finds the resolver for a value by its URI scheme, e.g. `op` for `op://vault/item/field`.
+
+    Resolvers are only imported when a value with their scheme is resolved so backends, and their
+    dependencies, that a config doesn't use don't slow down startup.  Entry points are only looked
+    up for schemes without a built-in resolver and are cached until installed packages change.
+    """
+
+    def __init__(
+        self,
+        refs: dict[str, str] | None = None,
+        entry_points: bool = True,
+        plugins_fpath: Path | None = None,
+    ):
+        self.refs: dict[str, str] = dict(BUILTIN_RESOLVERS if refs is None else refs)
+        # Scheme -> resolver, imported when first needed
+        self.loaded: dict[str, type[Resolver]] = {}
+        # Scheme -> resolver ref from entry points, looked up on first use
+        self.plugin_refs: dict[str, str] | None = None if entry_points else {}
+        self.plugins_fpath: Path = plugins_fpath or PLUGINS_FPATH
+
+    def scheme(self, value) -> str | None:
+        """
+        Return the value's scheme when it's a reference, i.e. a resolver is registered for the
+        scheme, built-in or from an entry point.  Other values, e.g. `https://` URLs, are literal.
+        """
+        if not isinstance(value, str):
+            return None
+        scheme, sep, _ = value.partition('://')
+        if not sep or not scheme[:1].isalpha():
+            return None
+        if not all(char.isalnum() or char in '+.-' for char in scheme):
+            return None
+        if scheme not in self.refs and self.plugin_ref(scheme) is None:
+            return None
+        return scheme
+
+    def find(self, value) -> type[Resolver] | None:
+        """Return the resolver for the value or None if the value isn't a reference to resolve"""
+        scheme = self.scheme(value)
+        if scheme is None:
+            return None
+
+        if scheme not in self.loaded:
+            ref = self.refs.get(scheme) or self.plugin_ref(scheme)
+            self.loaded[scheme] = self.load(scheme, ref)
+        return self.loaded[scheme]
+
+    def plugin_ref(self, scheme: str) -> str | None:
+        if self.plugin_refs is None:
+            self.plugin_refs = self.plugin_refs_cached()
+        return self.plugin_refs.get(scheme)
+
+    @staticmethod
+    def packages_key() -> list:
+        """
+        Changes when packages are installed, upgraded, or removed.  Each adds or removes files in
+        a directory of sys.path, changing its mtime.
+        """
+        key: list = [sys.executable]
+        for path in sys.path:
+            try:
+                key.append([path, Path(path).stat().st_mtime_ns])
+            except OSError:
+                key.append([path, None])
+        return key
+
+    @staticmethod
+    def plugin_refs_scan() -> dict[str, str]:
+        # Only imported when needed, importlib.metadata is relatively slow to import and scan
+        from importlib.metadata import entry_points
+
+        group = entry_points(group=RESOLVERS_ENTRY_POINT)
+        return {entry_point.name: entry_point.value for entry_point in group}
+
+    def plugin_refs_cached(self) -> dict[str, str]:
+        """
+        Return scheme -> resolver ref from entry points.  Finding them scans every installed
+        package, which is slow and needed for every value with a scheme that isn't built-in (e.g.
+        `https://`), so the result is cached until packages change.
+        """
+        key = self.packages_key()
+        fpath = self.plugins_fpath
+        if utils.is_private(fpath):
+            try:
+                cached = json.loads(fpath.read_text())
+                if cached['key'] == key:
+                    return cached['refs']
+            except (OSError, ValueError, KeyError, TypeError):
+                log.info('Unable to read cached resolver entry points %s', fpath)
+
+        refs = self.plugin_refs_scan()
+        try:
+            if utils.private_dir(fpath.parent):
+                utils.atomic_write(fpath, json.dumps({'key': key, 'refs': refs}).encode())
+        except OSError:
+            log.info('Unable to cache resolver entry points in %s', fpath)
+        return refs
+
+    @staticmethod
+    def load(scheme: str, ref: str) -> type[Resolver]:
+        module_name, _, attr_path = ref.partition(':')
+        try:
+            obj = importlib.import_module(module_name)
+            for attr in attr_path.split('.'):
+                obj = getattr(obj, attr)
+        except (ImportError, AttributeError) as e:
+            raise UserError(f'Unable to load the resolver for {scheme}:// ({ref}): {e}') from e
+
+        if not (isinstance(obj, type) and issubclass(obj, Resolver)):
+            raise UserError(f'The resolver for {scheme}:// ({ref}) is not a Resolver subclass')
+        return obj
+
+
+class ConfigIndex(NamedTuple):
+    """
+    Lookups for selecting profiles and finding configured vars without scanning every profile and
+    group of a (potentially very large) config.  Built once per loaded config.
+    """
+
+    # profile name -> var names it configures, in config order
+    profile_vars: dict[str, tuple[str, ...]]
+    # group name -> profile names it includes, directly or through nested groups
+    group_profiles: dict[str, tuple[str, ...]]
+    # var name -> names of profiles that configure it
+    var_profiles: dict[str, tuple[str, ...]]
+    # profile/group name -> position in the config so selections keep the config's order
+    positions: dict[str, int]
+
+    @classmethod
+    def build(cls, config: Config) -> 'ConfigIndex':
+        # Only names are needed so nothing is rendered
+        profiles = config.profiles
+        groups = {name: group.members for name, group in config.groups.items()}
+
+        profile_vars = {name: tuple(profile.values) for name, profile in profiles.items()}
+        var_profiles: dict[str, list[str]] = {}
+        for prof_name, var_names in profile_vars.items():
+            for var_name in var_names:
+                var_profiles.setdefault(var_name, []).append(prof_name)
+
+        return cls(
+            profile_vars=profile_vars,
+            group_profiles=config.group_profiles,
+            var_profiles={name: tuple(prof_names) for name, prof_names in var_profiles.items()},
+            positions={
+                **{name: pos for pos, name in enumerate(groups)},
+                **{name: pos for pos, name in enumerate(profiles)},
+            },
+        )
+
+    def profile_names(self, names: list[str]) -> list[str]:
+        """Return the given names that are profiles, in config order"""
+        found = {name for name in names if name in self.profile_vars}
+        return sorted(found, key=self.positions.__getitem__)
+
+    def group_profile_names(self, names: list[str]) -> list[str]:
+        """Return profiles included in the given groups, in config order of the groups"""
+        groups = sorted(
+            {name for name in names if name in self.group_profiles},
+            key=self.positions.__getitem__,
+        )
+        return list(dict.fromkeys(prof for group in groups for prof in self.group_profiles[group]))
 
-class EnvConfig:
-    resolvers = (OPResolver,)
 
-    def __init__(self, config: YamlDict):
-        self.config: YamlDict = config
+class EnvConfig:
+    resolvers = ResolverRegistry()
+    default_concurrency = 8
+    # Seconds resolving can take overall, individual calls are limited by utils.call_timeout()
+    default_timeout: float = 120
+
+    def __init__(
+        self,
+        config: Config,
+        concurrency: int | None = None,
+        batch: bool = False,
+        cache: SecretCache | None = None,
+        cache_ttl: int | None = None,
+        default_cache_ttl: int = 0,
+        agent: AgentClient | None = None,
+        config_fpath: Path | None = None,
+        index: ConfigIndex | None = None,
+        timeout: float | None = None,
+        env: dict[str, str] | None = None,
+        cwd: str | None = None,
+    ):
+        self.config: Config = config
+        # Environment for `{env.*}` templates and resolvers, e.g. env://, and current directory for
+        # resolvers, e.g. file://.  This process's by default.
+        self.env: dict[str, str] | None = env
+        self.cwd: str | None = cwd
+        if index is not None:
+            self.index = index
+        self.concurrency: int = concurrency or self.default_concurrency
+        self.timeout: float = timeout or self.default_timeout
+        self.batch: bool = batch
+        self.cache: SecretCache | None = cache
+        # Overrides the config's default cache TTL when given
+        self.cache_ttl: int | None = cache_ttl
+        # Used when the config doesn't set a default cache TTL, e.g. the agent's
+        self.default_cache_ttl: int = default_cache_ttl
+        # The agent needs to know which config to use
+        self.agent: AgentClient | None = agent
+        self.config_fpath: Path | None = config_fpath
         self.stderr = []
         self.stdout = []
 
-    def select_profiles(self, prof_names: list[str] | None = None) -> dict[str, dict]:
+    @cached_property
+    def index(self) -> ConfigIndex:
+        return ConfigIndex.build(self.config)
+
+    @cached_property
+    def values(self) -> Section:
+        """The config rendered for `self.env`, templates are rendered once as they're accessed"""
+        return self.config.view(self.env)
+
+    def select_profiles(self, prof_names: list[str] | None = None) -> dict[str, Section]:
         """Return configs that represent env var name to value mappings"""
-        prof_names = set(prof_names)
+        profiles = self.values.profile
         return {
-            prof_name: config
-            for prof_name, config in self.config.profile.items()
-            if prof_name in prof_names
+            prof_name: profiles[prof_name] for prof_name in self.index.profile_names(prof_names)
         }
 
     def present_env_vars(self) -> set[str]:
         """Return all env var names used in any config active in current environment"""
-        return {
-            var_name
-            for var_map in self.config.profile.values()
-            for var_name in var_map
-            if var_name in environ
-        }
+        return self.index.var_profiles.keys() & environ.keys()
 
-    def select_groups(self, group_names: list[str]) -> dict[str, dict]:
+    def select_groups(self, group_names: list[str]) -> dict[str, Section]:
         """Select profiles included in the given groups"""
-        group_names = set(group_names)
+        profiles = self.values.profile
         return {
-            # For each profile name included, use its name and config
-            included_prof_name: self.config.profile[included_prof_name]
-            # Get configs requested that represent other included figs
-            for group_name, includes in self.config.group.items()
-            if group_name in group_names
-            # Includes is a list of profile names to include, flatten it
-            for included_prof_name in includes
+            prof_name: profiles[prof_name]
+            for prof_name in self.index.group_profile_names(group_names)
         }
 
     def select(cls, selected_names: list[str]) -> dict[str, str]:
         """
         Return all env name to value mappings in given selection names after resolving includes.
         """
-        merged = cls.select_groups(selected_names) | cls.select_profiles(selected_names)
+        with timings.span('select'):
+            merged = cls.select_groups(selected_names) | cls.select_profiles(selected_names)
+            # Accessing the values renders their templates
+            return {
+                env_name: env_value
+                for env_map in merged.values()
+                for env_name, env_value in env_map.items()
+            }
+
+    def cache_ttls(self, selected_names: list[str]) -> dict[str, int]:
+        """
+        Return env var name to how long, in seconds, its resolved value can be cached.  Comes from
+        the profile the var was selected from, `self.cache_ttl`, the config's default, or
+        `self.default_cache_ttl`.
+        """
+        cache_conf = self.values.get('cache') or {}
+        default_ttl = self.cache_ttl
+        if default_ttl is None:
+            default_ttl = cache_conf.get('ttl', self.default_cache_ttl)
+        profile_ttls = cache_conf.get('profile') or {}
+
+        # Same profiles, in the same order, as select() without rendering their values
+        index = self.index
+        prof_names = dict.fromkeys(
+            index.group_profile_names(selected_names) + index.profile_names(selected_names),
+        )
         return {
-            env_name: env_value
-            for env_map in merged.values()
-            for env_name, env_value in env_map.items()
+            env_name: profile_ttls.get(prof_name, default_ttl)
+            for prof_name in prof_names
+            for env_name in index.profile_vars[prof_name]
         }
 
-    def resolve(self, selected_names: list[str]):
+    def hook_profiles(self) -> list[str]:
+        """Profile and group names `env-config hook` activates in the config's directory"""
+        hook_conf = self.values.get('hook') or {}
+        profiles = hook_conf.get('profiles') or []
+        return profiles.split() if isinstance(profiles, str) else [str(name) for name in profiles]
+
+    def resolve(self, selected_names: list[str], only: set[str] | None = None):
         """
         Return all env name to value mappings in given selected names after resolving includes and
         any "special" config values that need processing/resolving.
+
+        Values are resolved concurrently, up to `self.concurrency` at a time.  Order of the returned
+        mapping matches the selection order regardless of which values finish first.  All errors
+        are collected and raised together as a ResolveError.
+
+        When `self.batch` is set, values a resolver can handle together (e.g. 1Pass references for
+        the same account) are resolved with one call per batch.  Otherwise, values that are parts of
+        the same thing (e.g. fields of the same 1Pass item) are resolved with one call per group.
+
+        Resolving is limited to `self.timeout` seconds overall.  `op` calls are retried on
+        throttling and transient errors and their concurrency shrinks while `op` is throttling, see
+        utils.op_run().
+
+        When `self.cache` is set, values with a cache TTL are read from and saved to the cache,
+        unless their resolver isn't `cacheable`.
+
+        When `self.agent` is set and an agent is running, the agent does the resolving.
+
+        When `only` is given, only those env names are returned.
         """
+        if self.agent and self.config_fpath:
+            with timings.span('agent.resolve'):
+                response = self.agent.resolve(
+                    self.config_fpath,
+                    selected_names,
+                    only=sorted(only) if only is not None else None,
+                    concurrency=self.concurrency,
+                    batch=self.batch,
+                    timeout=self.timeout,
+                    cache=self.cache is not None,
+                    cache_ttl=self.cache_ttl,
+                    refresh=bool(self.cache and self.cache.refresh),
+                )
+            if response and response.get('errors'):
+                errors = response['errors']
+                raise ResolveError({name: RuntimeError(msg) for name, msg in errors.items()})
+            if response:
+                return response['env_vars']
+
         env_vars: dict[str, str] = self.select(selected_names)
+        if only is not None:
+            env_vars = {name: value for name, value in env_vars.items() if name in only}
+        ttls = self.cache_ttls(selected_names) if self.cache else {}
+        return self.resolve_values(env_vars, ttls)
 
-        for name in env_vars:
-            value = env_vars[name]
-            for resolver in self.resolvers:
-                if resolver.use(value):
-                    env_vars[name] = resolver.convert(value)
+    def resolve_values(self, env_vars: dict[str, str], ttls: dict[str, int]) -> dict[str, str]:
+        """
+        Return the given env name to value mapping with values resolved.  `ttls` is env name to
+        cache TTL, see `cache_ttls()`.
+        """
+        env_vars = dict(env_vars)
+        ttls = dict(ttls)
+
+        # (resolver, batch key) -> {env name: value}
+        batches: dict[tuple, dict[str, str]] = {}
+        for name, value in env_vars.items():
+            resolver = self.resolvers.find(value)
+            if resolver is None:
+                continue
+            if not resolver.cacheable:
+                ttls.pop(name, None)
+            if ttls.get(name) and (cached := self.cache.get(value)) is not None:
+                env_vars[name] = cached
+                continue
+            key = resolver.batch_key(value) if self.batch else resolver.group_key(value)
+            # Without a key, every value is its own batch
+            batch_id = (resolver, name) if key is None else (resolver, key)
+            batches.setdefault(batch_id, {})[name] = value
+
+        if not batches:
+            return env_vars
+
+        workers = min(self.concurrency, len(batches))
+        with (
+            utils.call_limits(self.timeout, self.concurrency),
+            utils.for_caller(self.env, self.cwd),
+            ThreadPoolExecutor(max_workers=workers) as executor,
+        ):
+            # Each thread gets a copy of the context so the limits apply to its calls
+            futures = {
+                batch_id: executor.submit(
+                    contextvars.copy_context().run,
+                    self._resolve_batch,
+                    batch_id[0],
+                    batch,
+                    self.batch,
+                )
+                for batch_id, batch in batches.items()
+            }
+
+        errors = {}
+        for batch_id, future in futures.items():
+            for name, result in future.result().items():
+                if isinstance(result, Exception):
+                    errors[name] = result
+                    continue
+
+                if ttls.get(name):
+                    self.cache.set(batches[batch_id][name], result, ttls[name])
+                env_vars[name] = result
+
+        if errors:
+            raise ResolveError({name: errors[name] for name in env_vars if name in errors})
 
         return env_vars
 
+    @staticmethod
+    def _resolve_batch(resolver: type[Resolver], batch: dict[str, str], batched: bool) -> dict:
+        """Return env name to resolved value or, if it couldn't be resolved, the exception"""
+        if len(batch) > 1:
+            kind = 'batch' if batched else 'group'
+            convert = resolver.convert_batch if batched else resolver.convert_group
+            try:
+                with timings.span(f'{resolver.__name__} {kind} of {len(batch)}'):
+                    values = convert(list(batch.values()))
+                return dict(zip(batch, values, strict=True))
+            except Exception:
+                # A batch fails as a whole.  Resolve individually so we can report exactly which
+                # values are the problem.
+                log.info('%s resolve failed, falling back to individual resolution', kind.title())
+
+        results = {}
+        for name, value in batch.items():
+            try:
+                with timings.span(f'{resolver.__name__} {name}'):
+                    results[name] = resolver.convert(value)
+            except Exception as e:
+                results[name] = e
+        return results
+
+
+class ShellEnvConfig(EnvConfig):
+    """Outputs shell commands to be sourced by the shell's env-config function"""
+
+    source_header: str
+
+    @staticmethod
+    def unset_cmd(var: str) -> str:
+        raise NotImplementedError
+
+    @staticmethod
+    def export_cmd(var: str, value: str) -> str:
+        raise NotImplementedError
 
-class FishEnvConfig(EnvConfig):
     def clear_present_env_vars(self):
         var_names = sorted(self.present_env_vars())
         if not var_names:
             return
 
-        print('# FISH SOURCE')
+        print(self.source_header)
         for var_name in var_names:
-            print('set', '-eg', shlex.quote(var_name))
+            print(self.unset_cmd(var_name))
 
-        print('set', '-eg', '_ENV_CONFIG_PROFILES')
+        print(self.unset_cmd('_ENV_CONFIG_PROFILES'))
 
     def set(self, selected_names: list[str]):
-        print('# FISH SOURCE')
-        print('set', '-gx', '_ENV_CONFIG_PROFILES', shlex.quote(' '.join(selected_names)))
-        for var, value in self.resolve(selected_names).items():
-            # Fish puts sourced variables in their own local scope by default so use -g to get them
-            # to the scope of the sourcing shell and -x to export them.
-            print('set', '-gx', shlex.quote(var), shlex.quote(value))
+        # Resolve before printing anything so a failure doesn't leave partial output to be sourced
+        env_vars = self.resolve(selected_names)
+        print(self.source_header)
+        print(self.export_cmd('_ENV_CONFIG_PROFILES', ' '.join(selected_names)))
+        for var, value in env_vars.items():
+            print(self.export_cmd(var, value))
+
+    def switch_plan(self, selected_names: list[str]) -> tuple[list[str], list[str], list[str]]:
+        """
+        Compare the active profiles and current environment to the given selection and return
+        var names to unset, set, and leave unchanged.  Vars are unchanged when they are present
+        and their config value is the same in the active profiles and the new selection.
+        """
+        active_names = environ.get('_ENV_CONFIG_PROFILES', '').split()
+        active = self.select(active_names)
+        selected = self.select(selected_names)
+
+        to_unset = sorted(self.present_env_vars() - selected.keys())
+        to_set = []
+        unchanged = []
+        for name, value in selected.items():
+            if name in environ and name in active and active[name] == value:
+                unchanged.append(name)
+            else:
+                to_set.append(name)
+
+        return to_unset, to_set, unchanged
+
+    def switch(self, selected_names: list[str]):
+        """
+        Switch from the active profiles to the given selection by only unsetting and setting vars
+        that change.  Unchanged vars aren't resolved.
+        """
+        to_unset, to_set, _ = self.switch_plan(selected_names)
+        # Resolve before printing anything so a failure doesn't leave partial output to be sourced
+        env_vars = self.resolve(selected_names, only=set(to_set)) if to_set else {}
 
+        print(self.source_header)
+        for var_name in to_unset:
+            print(self.unset_cmd(var_name))
+        print(self.export_cmd('_ENV_CONFIG_PROFILES', ' '.join(selected_names)))
+        for var, value in env_vars.items():
+            print(self.export_cmd(var, value))
 
-class BashEnvConfig(EnvConfig):
-    def clear_present_env_vars(self):
-        var_names = sorted(self.present_env_vars())
-        if not var_names:
-            return
 
-        print('# BASH SOURCE')
-        for var_name in var_names:
-            print('unset', shlex.quote(var_name))
+class FishEnvConfig(ShellEnvConfig):
+    source_header = '# FISH SOURCE'
 
-        print('unset', '_ENV_CONFIG_PROFILES')
+    @staticmethod
+    def unset_cmd(var: str) -> str:
+        return f'set -eg {shlex.quote(var)}'
 
-    def set(self, selected_names: list[str]):
-        print('# BASH SOURCE')
-        print('export', '_ENV_CONFIG_PROFILES=' + shlex.quote(' '.join(selected_names)))
-        for var, value in self.resolve(selected_names).items():
-            print('export', shlex.quote(var) + '=' + shlex.quote(value))
+    @staticmethod
+    def export_cmd(var: str, value: str) -> str:
+        # Fish puts sourced variables in their own local scope by default so use -g to get them
+        # to the scope of the sourcing shell and -x to export them.
+        return f'set -gx {shlex.quote(var)} {shlex.quote(value)}'
+
+
+class BashEnvConfig(ShellEnvConfig):
+    source_header = '# BASH SOURCE'
+
+    @staticmethod
+    def unset_cmd(var: str) -> str:
+        return f'unset {shlex.quote(var)}'
+
+    @staticmethod
+    def export_cmd(var: str, value: str) -> str:
+        return f'export {shlex.quote(var)}={shlex.quote(value)}'
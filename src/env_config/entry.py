@@ -0,0 +1,66 @@
+"""
+Lean entry points for hot paths.
+
+These are called often enough (e.g. env-config-aws as an AWS credential_process, `env-config hook`
+before every shell prompt) that Python's import time matters.  Each entry point only imports the
+modules its hot path needs.  Everything else, including click, is left to the full CLI in `cli.py`.
+"""
+
+import sys
+import time
+
+from . import hook, timings
+
+
+# Handled by the full CLI, see cli.aws_subcommands
+AWS_SUBCOMMANDS = ('prewarm', 'stats')
+
+
+def env_config():
+    # Nearly every `env-config hook` has nothing to do
+    if sys.argv[1:] == ['hook'] and hook.unchanged():
+        return
+
+    from .cli import main
+
+    main()
+
+
+def env_config_aws():
+    start = time.perf_counter()
+    args = sys.argv[1:]
+
+    from . import agent, aws, utils
+
+    # Cached credentials for `env-config-aws <profile>` can be printed without the full CLI
+    if len(args) == 1 and not args[0].startswith('-') and args[0] not in AWS_SUBCOMMANDS:
+        utils.defer_logs()
+
+        if not agent.disabled():
+            with timings.span('agent.aws_creds'):
+                creds_json = agent.AgentClient().aws_creds(args[0])
+            if creds_json:
+                print(creds_json)
+                aws.log_event('creds', args[0], start, cache='agent')
+                return
+
+        with timings.span('profile_config'):
+            config = aws.profile_config(args[0])
+        enc_tmp = aws.sess_creds_cache(config.op_ref_base, config.mfa_serial)
+        if creds := aws.cached_sess_creds(enc_tmp):
+            print(creds.cli_json())
+            if creds.needs_renewal(aws.refresh_ahead()):
+                aws.renew_in_background(
+                    config.op_ref_base,
+                    config.mfa_serial,
+                    # The rest of session_duration() loads env-config.yaml, which is left to the
+                    # background process so it doesn't slow down, or break, this one.
+                    duration=config.duration,
+                    profile=config.profile,
+                )
+            aws.log_event('creds', config.profile, start, cache='hit')
+            return
+
+    from .cli import aws_main
+
+    aws_main()
@@ -0,0 +1,207 @@
+"""
+Fast path for `env-config hook`, which the shell integration runs before every prompt to activate
+a directory's `hook.profiles` when entering it and clear them when leaving.
+
+Nearly every prompt has nothing to do, so only `os` and `sys` are imported here.  Which config a
+directory uses, and the config's hook profiles, are cached per directory along with the mtimes of
+everything the lookup depended on.  When those haven't changed and the hook already activated that
+config, there's nothing to do after a few stat() calls.  Otherwise the full CLI looks up the config
+and refreshes the cache, see `cli.env_config_hook`.
+
+Like direnv, a config's hook profiles are only activated once the user allowed it with `env-config
+hook allow`.  Otherwise cloning a repo and `cd`-ing into it could run its `cmd://` values.  The
+allow list keys each config by its real path and content hash so a changed config needs allowing
+again.  It's stamped along with the lookup, allowing a config makes the cache stale.
+"""
+
+import os
+import sys
+
+
+CONFIG_FNAME = 'env-config.yaml'
+# Config path whose hook profiles were activated by the hook.  Set in the shell by the hook itself.
+ENVVAR = '_ENV_CONFIG_HOOK_CONFIG'
+# Bump when the cache format changes so old caches are ignored
+CACHE_VERSION = '1'
+
+
+def cache_dpath() -> str:
+    # Same location as utils.TMP_DPATH, without importing tempfile which is slow to import.  The
+    # temp directory is shared so each user gets their own directory.
+    environ = os.environ
+    tmp_dpath = environ.get('TMPDIR') or environ.get('TEMP') or environ.get('TMP') or '/tmp'
+    return os.path.join(tmp_dpath, 'env-config', f'hook-{os.getuid()}')
+
+
+def allow_fpath() -> str:
+    # Unlike the cache, kept with the user's data.  The temp directory is shared and cleaned up.
+    data_dpath = os.environ.get('XDG_DATA_HOME') or os.path.expanduser('~/.local/share')
+    return os.path.join(data_dpath, 'env-config', 'hook-allow')
+
+
+def cache_fpath(dpath: str) -> str:
+    # Escaping keeps the file name unique for the directory without importing hashlib
+    return os.path.join(cache_dpath(), dpath.replace('%', '%25').replace('/', '%2F'))
+
+
+def stamp(path: str) -> str:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return '-'
+    return f'{stat.st_mtime_ns}:{stat.st_size}'
+
+
+def find(dpath: str) -> tuple[str, dict[str, str]]:
+    """
+    Return the config file for the directory, searching upwards like config.find_upwards(), or ''
+    if there isn't one.  Also returns the stamps of the directories searched and the config file.
+    A directory's mtime changes when a config is added or removed, so the stamps are enough to tell
+    if the result is still current.  Stamps are taken before checking for a config so a change
+    while searching isn't missed.
+    """
+    stamps = {}
+    # Like find_upwards(), the root directory isn't searched
+    while (parent := os.path.dirname(dpath)) != dpath:
+        stamps[dpath] = stamp(dpath)
+        config_fpath = os.path.join(dpath, CONFIG_FNAME)
+        config_stamp = stamp(config_fpath)
+        if config_stamp != '-':
+            stamps[config_fpath] = config_stamp
+            return config_fpath, stamps
+        dpath = parent
+    return '', stamps
+
+
+def is_private(stat: os.stat_result) -> bool:
+    """
+    Like utils.is_private(), owned by the current user and no one else can write to it.  The cached
+    config is loaded and its profiles activated so the cache is only used when this is true.
+    """
+    return stat.st_uid == os.getuid() and not stat.st_mode & 0o022
+
+
+def read_cache(dpath: str) -> tuple[str, list[str]] | None:
+    """Return the cached config path and hook profiles for the directory, if still current"""
+    fpath = cache_fpath(dpath)
+    try:
+        if not is_private(os.lstat(os.path.dirname(fpath))):
+            return None
+        with open(fpath, encoding='utf-8') as fo:
+            if not is_private(os.fstat(fo.fileno())):
+                return None
+            version, config_fpath, profiles, *stamp_lines = fo.read().splitlines()
+    except (OSError, ValueError):
+        return None
+
+    if version != CACHE_VERSION:
+        return None
+    stamped = set()
+    for line in stamp_lines:
+        recorded, _, path = line.partition(' ')
+        if stamp(path) != recorded:
+            return None
+        stamped.add(path)
+
+    # The lookup depends on at least the directory itself and the config it found
+    if dpath not in stamped or (config_fpath and config_fpath not in stamped):
+        return None
+
+    return config_fpath, profiles.split()
+
+
+def save_cache(dpath: str, config_fpath: str, profiles: list[str], stamps: dict[str, str]):
+    lines = [CACHE_VERSION, config_fpath, ' '.join(profiles)]
+    lines.extend(f'{path_stamp} {path}' for path, path_stamp in stamps.items())
+
+    fpath = cache_fpath(dpath)
+    tmp_fpath = f'{fpath}.{os.getpid()}'
+    try:
+        os.makedirs(os.path.dirname(fpath), mode=0o700, exist_ok=True)
+        if not is_private(os.lstat(os.path.dirname(fpath))):
+            print(f'env-config hook: {os.path.dirname(fpath)} is not private', file=sys.stderr)
+            return
+        fd = os.open(tmp_fpath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, 'w', encoding='utf-8') as fo:
+            fo.write('\n'.join(lines) + '\n')
+        os.replace(tmp_fpath, fpath)
+    except OSError as e:
+        # E.g. the directory's path is too long for a file name.  The hook still works, just
+        # without the fast path.
+        print(f'env-config hook: unable to cache lookup: {e}', file=sys.stderr)
+
+
+def allow_entry(config_fpath: str) -> tuple[str, str]:
+    """Return the config's real path and content hash, as kept in the allow list"""
+    # Imported here b/c only needed when the hook looks up or activates a config
+    import hashlib
+
+    real_fpath = os.path.realpath(config_fpath)
+    with open(real_fpath, 'rb') as fo:
+        return real_fpath, hashlib.sha256(fo.read()).hexdigest()
+
+
+def read_allowed() -> dict[str, str]:
+    """Return config real path to content hash for the allowed configs"""
+    fpath = allow_fpath()
+    try:
+        with open(fpath, encoding='utf-8') as fo:
+            private = is_private(os.fstat(fo.fileno()))
+            if not private or not is_private(os.lstat(os.path.dirname(fpath))):
+                print(f'env-config hook: ignoring {fpath}, it is not private', file=sys.stderr)
+                return {}
+            lines = fo.read().splitlines()
+    except FileNotFoundError:
+        return {}
+
+    allowed = {}
+    for line in lines:
+        content_hash, _, real_fpath = line.partition(' ')
+        allowed[real_fpath] = content_hash
+    return allowed
+
+
+def is_allowed(config_fpath: str) -> bool:
+    """True when the config, as it is now, was allowed"""
+    try:
+        real_fpath, content_hash = allow_entry(config_fpath)
+        return read_allowed().get(real_fpath) == content_hash
+    except OSError:
+        return False
+
+
+def allow(config_fpath: str) -> str:
+    """Add the config, as it is now, to the allow list and return its real path"""
+    real_fpath, content_hash = allow_entry(config_fpath)
+    allowed = read_allowed() | {real_fpath: content_hash}
+    lines = [f'{entry_hash} {entry_fpath}' for entry_fpath, entry_hash in sorted(allowed.items())]
+
+    fpath = allow_fpath()
+    os.makedirs(os.path.dirname(fpath), mode=0o700, exist_ok=True)
+    if not is_private(os.lstat(os.path.dirname(fpath))):
+        raise PermissionError(f'{os.path.dirname(fpath)} is not private')
+    tmp_fpath = f'{fpath}.{os.getpid()}'
+    fd = os.open(tmp_fpath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(fd, 'w', encoding='utf-8') as fo:
+        fo.write('\n'.join(lines) + '\n')
+    os.replace(tmp_fpath, fpath)
+    return real_fpath
+
+
+def target(config_fpath: str, profiles: list[str]) -> str:
+    """Value of ENVVAR once the hook has done what the directory needs"""
+    return config_fpath if profiles else ''
+
+
+def unchanged() -> bool:
+    """True when the current directory's hook profiles are already active (or there are none)"""
+    try:
+        cwd = os.getcwd()
+    except OSError:
+        return False
+
+    cached = read_cache(cwd)
+    if cached is None:
+        return False
+
+    return os.environ.get(ENVVAR, '') == target(*cached)
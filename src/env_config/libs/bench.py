@@ -0,0 +1,341 @@
+"""
+Benchmarks for env-config's hot paths.
+
+Run with `mise run bench` or `python -m env_config.libs.bench`.  Results are written as JSON so
+runs (e.g. from two branches) can be compared with `--compare`.
+"""
+
+import base64
+from collections.abc import Callable
+import json
+from os import environ
+from pathlib import Path
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+
+import click
+from cryptography.fernet import Fernet
+
+from env_config import aws, config, core, utils
+
+
+# Stands in for the 1Password cli.  `read` outputs the last segment of the reference, `inject`
+# replaces each template reference with the last segment of the reference, `item get` outputs an
+# item with fields field-0 to field-39 whose values are their labels.
+FAKE_OP = r"""#!/bin/sh
+sleep "${FAKE_OP_LATENCY:-0}"
+if [ "$1" = "--account" ]; then
+    shift 2
+fi
+case "$1" in
+    read)
+        printf '%s' "${3##*/}"
+        ;;
+    inject)
+        sed -E 's/\{\{ op:\/\/[^}]*\/([^}/]*) \}\}/\1/g'
+        ;;
+    item)
+        printf '{"fields": ['
+        i=0
+        while [ "$i" -lt 40 ]; do
+            [ "$i" -gt 0 ] && printf ','
+            printf '{"id": "f%s", "label": "field-%s", "value": "field-%s"}' "$i" "$i" "$i"
+            i=$((i + 1))
+        done
+        printf ']}'
+        ;;
+    *)
+        echo "fake op: unsupported command $1" >&2
+        exit 1
+        ;;
+esac
+"""
+
+
+def write_config(fpath: Path, profiles: int, vars_per_profile: int, groups: int) -> Path:
+    """Write a generated env-config.yaml with the given number of profiles and groups"""
+    lines = ['var:']
+    lines.extend(f'  vault{i}: op://vault-{i}' for i in range(vars_per_profile))
+    lines.append('profile:')
+    for prof_num in range(profiles):
+        lines.append(f'  prof-{prof_num}:')
+        for var_num in range(vars_per_profile):
+            # A mix of plain values, templates, 1Pass references, and env dependent values.
+            name = f'PROF_{prof_num}_VAR_{var_num}'
+            match var_num % 4:
+                case 0:
+                    value = f'plain-{prof_num}-{var_num}'
+                case 1:
+                    value = f'{{var.vault{var_num}}}/item-{prof_num}/field-{var_num}'
+                case 2:
+                    value = f'op://vault/item-{prof_num}/field-{var_num}'
+                case _:
+                    value = f'{{env.HOME}}/{prof_num}'
+            lines.append(f'    {name}: {value!r}')
+        # Some vars shared across profiles
+        lines.append(f'    SHARED_VAR: {prof_num!r}')
+
+    lines.append('group:')
+    for group_num in range(groups):
+        lines.append(f'  group-{group_num}:')
+        lines.extend(f'    - prof-{prof_num}' for prof_num in range(group_num, profiles, groups))
+
+    fpath.write_text('\n'.join(lines) + '\n')
+    return fpath
+
+
+def write_fake_op(dpath: Path) -> Path:
+    fpath = dpath / 'op'
+    fpath.write_text(FAKE_OP)
+    fpath.chmod(0o755)
+    return fpath
+
+
+def timeit(func: Callable, iterations: int, setup: Callable | None = None) -> dict:
+    """Run func `iterations` times and return timing stats in milliseconds"""
+    times = []
+    for _ in range(iterations):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+
+    return {
+        'iterations': iterations,
+        'min_ms': min(times),
+        'median_ms': statistics.median(times),
+        'mean_ms': statistics.mean(times),
+        'max_ms': max(times),
+    }
+
+
+class Suite:
+    def __init__(
+        self,
+        work_dpath: Path,
+        iterations: int,
+        profiles: int,
+        op_latency: float,
+    ):
+        self.work_dpath = work_dpath
+        self.iterations = iterations
+        self.profiles = profiles
+        self.op_latency = op_latency
+        self.results: dict[str, dict] = {}
+
+    def record(self, name: str, func: Callable, setup: Callable | None = None, iterations=None):
+        self.results[name] = timeit(func, iterations or self.iterations, setup)
+        print(f'{name:<40} {self.results[name]["median_ms"]:>10.3f} ms', file=sys.stderr)
+
+    def bench_load(self):
+        compiled_dpath = self.work_dpath / 'compiled'
+
+        def clear_compiled():
+            shutil.rmtree(compiled_dpath, ignore_errors=True)
+
+        sizes = {'small': (5, 5, 2), 'large': (self.profiles, 10, max(self.profiles // 20, 1))}
+        for size, (profiles, vars_per_profile, groups) in sizes.items():
+            fpath = self.work_dpath / f'{size}.yaml'
+            write_config(fpath, profiles, vars_per_profile, groups)
+
+            def load(fpath=fpath):
+                return config.load(fpath, compiled_dpath)
+
+            self.record(f'config.load.{size}.parse', load, setup=clear_compiled)
+            load()
+            self.record(f'config.load.{size}.compiled', load)
+
+    def bench_select(self):
+        fpath = self.work_dpath / 'large.yaml'
+        groups = max(self.profiles // 20, 1)
+        write_config(fpath, self.profiles, 10, groups)
+        conf = config.load(fpath, self.work_dpath / 'compiled')
+        envconf = core.EnvConfig(conf)
+        index = envconf.index
+
+        prof_names = [f'prof-{i}' for i in range(0, self.profiles, 10)]
+        group_names = [f'group-{i}' for i in range(groups)]
+        present = {f'PROF_{i}_VAR_0': 'x' for i in range(0, self.profiles, 5)}
+
+        # Rendered values are kept by the EnvConfig, so use a new one like each invocation does
+        self.record(
+            'EnvConfig.select',
+            lambda: core.EnvConfig(conf, index=index).select(prof_names),
+        )
+        self.record('EnvConfig.select_groups', lambda: envconf.select_groups(group_names))
+        with mock.patch.dict(core.environ, present):
+            self.record('EnvConfig.present_env_vars', envconf.present_env_vars)
+
+    def bench_resolve(self):
+        bin_dpath = self.work_dpath / 'bin'
+        bin_dpath.mkdir(exist_ok=True)
+        write_fake_op(bin_dpath)
+
+        fpath = write_config(self.work_dpath / 'resolve.yaml', 4, 40, 1)
+        conf = config.load(fpath, self.work_dpath / 'compiled')
+        env = {
+            'PATH': f'{bin_dpath}:{environ["PATH"]}',
+            'FAKE_OP_LATENCY': str(self.op_latency),
+        }
+
+        # Resolving is slow, no need for as many iterations
+        iterations = max(self.iterations // 10, 1)
+        with mock.patch.dict(environ, env):
+            for name, kwargs in (
+                ('serial', {'concurrency': 1}),
+                ('concurrent', {}),
+                ('batch', {'batch': True}),
+            ):
+                envconf = core.EnvConfig(conf, **kwargs)
+                self.record(
+                    f'EnvConfig.resolve.{name}',
+                    lambda envconf=envconf: envconf.resolve(['prof-0']),
+                    iterations=iterations,
+                )
+
+    def bench_aws(self):
+        cache_dpath = self.work_dpath / 'aws-cache'
+        cache_dpath.mkdir(exist_ok=True)
+        creds = aws.SessCreds('key-id', 'sec-key', 'sess-token', utils.utc_now_in(hours=1))
+        auth = aws.AWSAuth('key-id', 'secret', 'arn:mfa', '123456')
+
+        def sess_creds():
+            return aws.op_sess_creds('op://vault/aws', 'arn:mfa', _cache_dpath=cache_dpath)
+
+        def clear_cache():
+            shutil.rmtree(cache_dpath)
+            cache_dpath.mkdir()
+
+        with (
+            mock.patch.object(aws, 'op_auth', return_value=auth),
+            mock.patch.object(aws, 'sts_session', return_value=creds),
+        ):
+            self.record('aws.op_sess_creds.miss', sess_creds, setup=clear_cache)
+            sess_creds()
+            self.record('aws.op_sess_creds.hit', sess_creds)
+
+    def bench_encryption(self):
+        # Legacy Fernet files vs the current AES-GCM entries in the cache store
+        dpath = self.work_dpath / 'encryption'
+        dpath.mkdir(exist_ok=True)
+        enc_tmp = utils.EncryptedTempFile('bench', dpath=dpath, enc_key='bench')
+        creds = aws.SessCreds('key-id', 'sec-key', 'x' * 1000, utils.utc_now_in(hours=1))
+        data = creds.to_msgpack()
+        fernet = Fernet(base64.urlsafe_b64encode(enc_tmp.key))
+
+        def save_fernet():
+            utils.atomic_write(enc_tmp.fpath, fernet.encrypt(data))
+
+        self.record('EncryptedTempFile.fernet.save', save_fernet)
+        self.record('EncryptedTempFile.fernet.read', enc_tmp.read)
+
+        expires_at = creds.expiration.timestamp()
+        self.record('EncryptedTempFile.aesgcm.save', lambda: enc_tmp.save(data, expires_at))
+        self.record('EncryptedTempFile.aesgcm.read', enc_tmp.read)
+
+    def run(self) -> dict:
+        self.bench_load()
+        self.bench_select()
+        self.bench_resolve()
+        self.bench_aws()
+        self.bench_encryption()
+        return self.results
+
+
+def git_rev() -> str | None:
+    result = subprocess.run(
+        ('git', 'rev-parse', '--short', 'HEAD'),
+        capture_output=True,
+        text=True,
+        cwd=Path(__file__).parent,
+    )
+    return result.stdout.strip() or None
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Print how results compare to the baseline and return names that regressed"""
+    regressed = []
+    print(f'{"benchmark":<40} {"baseline":>10} {"current":>10} {"change":>8}', file=sys.stderr)
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]['median_ms']
+        after = stats['median_ms']
+        change = (after - before) / before * 100 if before else 0
+        flag = ''
+        if change > threshold:
+            regressed.append(name)
+            flag = ' !'
+        print(f'{name:<40} {before:>10.3f} {after:>10.3f} {change:>7.1f}%{flag}', file=sys.stderr)
+    return regressed
+
+
+@click.command()
+@click.option('--output', type=click.Path(dir_okay=False, path_type=Path), help='Write JSON here')
+@click.option(
+    '--compare',
+    'compare_fpath',
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    help='JSON results from a previous run to compare against',
+)
+@click.option(
+    '--threshold',
+    default=20.0,
+    show_default=True,
+    help='Percent slower than the comparison results that counts as a regression',
+)
+@click.option('--iterations', default=50, show_default=True)
+@click.option('--profiles', default=1000, show_default=True, help='Profiles in the large config')
+@click.option(
+    '--op-latency',
+    default=0.05,
+    show_default=True,
+    help='Seconds the fake `op` takes per call',
+)
+@click.pass_context
+def main(
+    ctx: click.Context,
+    output: Path | None,
+    compare_fpath: Path | None,
+    threshold: float,
+    iterations: int,
+    profiles: int,
+    op_latency: float,
+):
+    """Benchmark config loading, selection, resolution and the AWS credential cache"""
+    with tempfile.TemporaryDirectory(prefix='env-config-bench-') as work_dpath:
+        suite = Suite(Path(work_dpath), iterations, profiles, op_latency)
+        results = suite.run()
+
+    report = {
+        'meta': {
+            'timestamp': utils.utc_now().isoformat(timespec='seconds'),
+            'git_rev': git_rev(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'iterations': iterations,
+            'profiles': profiles,
+            'op_latency': op_latency,
+        },
+        'results': results,
+    }
+
+    if output:
+        output.write_text(json.dumps(report, indent=2) + '\n')
+        print('Results written to', output, file=sys.stderr)
+
+    if compare_fpath:
+        baseline = json.loads(compare_fpath.read_text())['results']
+        if regressed := compare(results, baseline, threshold):
+            ctx.fail(f'Regressed: {", ".join(regressed)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""
+Compact, read-only model of a loaded config.
+
+Strings are checked for templates once, when the model is built, instead of on every access.
+Profiles and groups are frozen objects so the config can be indexed without rendering anything.
+Templates are only rendered when a view of the config for an environment accesses them and each is
+rendered at most once per view.  A `{var.*}` used by many values, or by other vars, is only
+rendered once.
+
+Rendering matches dynamic_yaml: a template is rendered with str.format_map() against the top level
+of the config, once (i.e. not recursively), with `env` being the environment.
+"""
+
+from collections.abc import Container, Iterator, Mapping
+from os import environ
+import re
+from typing import NamedTuple
+
+
+# Like dynamic_yaml, any string with a `{` followed by a `}` is a template
+TEMPLATE_RE = re.compile(r'\{.*\}', re.DOTALL)
+
+
+class Template(NamedTuple):
+    raw: str
+
+
+class Profile(NamedTuple):
+    name: str
+    # Env var name -> value, templates aren't rendered
+    values: dict[str, object]
+
+
+class Group(NamedTuple):
+    name: str
+    # Profile and group names, as configured
+    members: tuple[str, ...]
+
+
+class GroupCycleError(ValueError):
+    pass
+
+
+def group_closure(groups: dict, profiles: Container[str]) -> dict[str, tuple[str, ...]]:
+    """
+    Return group name to all profile names it includes.  Groups can include other groups, which
+    are flattened so selecting a group doesn't depend on how deep the nesting is.  Profiles take
+    precedence when a profile and group have the same name.
+    """
+    closure: dict[str, tuple[str, ...]] = {}
+
+    def flatten(group_name: str, path: list[str]) -> tuple[str, ...]:
+        if group_name in closure:
+            return closure[group_name]
+        if group_name in path:
+            cycle = ' -> '.join([*path[path.index(group_name) :], group_name])
+            raise GroupCycleError(f'Group includes itself: {cycle}')
+
+        included = {}
+        for name in groups[group_name] or ():
+            if name not in profiles and name in groups:
+                included.update(dict.fromkeys(flatten(name, [*path, group_name])))
+            else:
+                included[name] = None
+
+        closure[group_name] = tuple(included)
+        return closure[group_name]
+
+    for group_name in groups:
+        flatten(group_name, [])
+
+    return {group_name: closure[group_name] for group_name in groups}
+
+
+def compile_data(data):
+    """Return the config data with template strings replaced by Templates"""
+    if isinstance(data, dict):
+        return {key: compile_data(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [compile_data(value) for value in data]
+    if isinstance(data, str) and '{' in data and TEMPLATE_RE.search(data):
+        return Template(data)
+    return data
+
+
+class Config(NamedTuple):
+    """A loaded config.  Doesn't change once built so it can be shared, e.g. by agent requests."""
+
+    profiles: dict[str, Profile]
+    groups: dict[str, Group]
+    # Group name -> profile names it includes, directly or through nested groups
+    group_profiles: dict[str, tuple[str, ...]]
+    # Top level sections, e.g. `var`, `profile`, `cache`, with templates compiled
+    data: dict
+
+    @classmethod
+    def build(cls, data: dict, group_profiles: dict | None = None) -> 'Config':
+        """
+        Build the config from its plain data.  `group_profiles` is the result of group_closure(),
+        e.g. kept with the compiled config, and is computed when not given.
+        """
+        data = compile_data(data)
+        data.pop('env', None)
+        data['profile'] = data.get('profile') or {}
+        data['group'] = data.get('group') or {}
+        if group_profiles is None:
+            group_profiles = group_closure(data['group'], data['profile'])
+        return cls(
+            profiles={
+                name: Profile(name, values or {}) for name, values in data['profile'].items()
+            },
+            groups={
+                name: Group(name, tuple(members or ())) for name, members in data['group'].items()
+            },
+            group_profiles={name: tuple(names) for name, names in group_profiles.items()},
+            data=data,
+        )
+
+    def view(self, env: Mapping[str, str] | None = None) -> 'Section':
+        """Return the config with templates rendered for `env`, the current one by default"""
+        return Section({**self.data, 'env': Env(environ if env is None else env)})
+
+
+class Env(Mapping):
+    """`env` for templates, reads the environment as needed instead of copying all of it"""
+
+    __slots__ = ('_environ',)
+
+    def __init__(self, env: Mapping[str, str]):
+        object.__setattr__(self, '_environ', env)
+
+    def __getitem__(self, name: str) -> str:
+        return self._environ[name]
+
+    def __getattr__(self, name: str) -> str:
+        try:
+            return self._environ[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is read-only')
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._environ)
+
+    def __len__(self) -> int:
+        return len(self._environ)
+
+
+class Section(Mapping):
+    """
+    Read-only mapping of a config section with its templates rendered when first accessed.  Like
+    dynamic_yaml, values can be accessed as attributes, which is how templates use other values,
+    e.g. `{var.vault}/item`.
+    """
+
+    __slots__ = ('_data', '_rendered', '_root')
+
+    def __init__(self, data: dict, root: 'Section | None' = None):
+        object.__setattr__(self, '_data', data)
+        object.__setattr__(self, '_root', self if root is None else root)
+        object.__setattr__(self, '_rendered', {})
+
+    def __getitem__(self, key):
+        try:
+            return self._rendered[key]
+        except KeyError:
+            pass
+
+        value = self._render(self._data[key])
+        self._rendered[key] = value
+        return value
+
+    def __getattr__(self, name: str):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is read-only')
+
+    def __iter__(self) -> Iterator:
+        return iter(self._data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self._data!r})'
+
+    def _render(self, value):
+        if isinstance(value, Template):
+            return value.raw.format_map(self._root)
+        if isinstance(value, dict):
+            return Section(value, self._root)
+        if isinstance(value, list):
+            return [self._render(item) for item in value]
+        return value
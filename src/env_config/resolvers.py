@@ -0,0 +1,66 @@
+"""
+Built-in resolvers for schemes other than `op://`.  Only imported when a config has a value with
+one of these schemes, see core.ResolverRegistry.
+
+They depend on the environment or current directory, which are the caller's when the agent
+resolves them (see utils.Caller), and aren't cached since what they return can change any time.
+"""
+
+from . import utils
+from .core import Resolver
+
+
+class FileResolver(Resolver):
+    """
+    `file://path` reads a file, e.g. a key written by another tool.  `~` is expanded and relative
+    paths are relative to the current directory.  Trailing newlines are removed.
+    """
+
+    scheme = 'file://'
+    cacheable = False
+
+    @staticmethod
+    def convert(uri: str) -> str:
+        fpath = utils.current_caller().path(uri.removeprefix(FileResolver.scheme))
+        return fpath.read_text().rstrip('\r\n')
+
+
+class EnvResolver(Resolver):
+    """`env://NAME` is the value of another environment variable when the secret is resolved"""
+
+    scheme = 'env://'
+    cacheable = False
+
+    @staticmethod
+    def convert(uri: str) -> str:
+        name = uri.removeprefix(EnvResolver.scheme)
+        environ = utils.current_caller().environ()
+        if name not in environ:
+            raise LookupError(f'Environment variable not set: {name}')
+        return environ[name]
+
+
+class CmdResolver(Resolver):
+    """
+    `cmd://command args` is the output of a shell command, e.g. from a different secret manager's
+    CLI.  Trailing newlines are removed and, like `op`, the command is limited to
+    utils.call_timeout().
+    """
+
+    scheme = 'cmd://'
+    cacheable = False
+
+    @staticmethod
+    def convert(uri: str) -> str:
+        command = uri.removeprefix(CmdResolver.scheme)
+        caller = utils.current_caller()
+        result = utils.sub_run(
+            'sh',
+            '-c',
+            command,
+            capture=True,
+            timeout=utils.call_timeout(),
+            base_env=caller.env,
+            cwd=caller.cwd,
+        )
+        return result.stdout.rstrip('\r\n')
@@ -12,3 +12,17 @@ env-config() {
         echo "$stdout"
     fi
 }
+
+# Opt in to activating a directory's `hook.profiles` when entering it by setting ENV_CONFIG_HOOK=1
+# before this is sourced.
+_env_config_hook() {
+    local stdout
+    stdout=$(command env-config hook)
+    if [ -n "$stdout" ]; then
+        eval "$stdout"
+    fi
+}
+
+if [ "${ENV_CONFIG_HOOK:-}" = 1 ] && [[ ";${PROMPT_COMMAND:-};" != *";_env_config_hook;"* ]]; then
+    PROMPT_COMMAND="_env_config_hook${PROMPT_COMMAND:+;$PROMPT_COMMAND}"
+fi
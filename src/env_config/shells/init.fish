@@ -12,3 +12,11 @@ function env-config
         echo -n $stdout
     end
 end
+
+# Opt in to activating a directory's `hook.profiles` when entering it by setting ENV_CONFIG_HOOK=1
+# before this is sourced.
+if test "$ENV_CONFIG_HOOK" = 1
+    function _env_config_hook --on-event fish_prompt
+        command env-config hook | source
+    end
+end
@@ -0,0 +1,267 @@
+from pathlib import Path
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from env_config import agent, agent_server, aws, config, core, utils
+from env_config.libs.testing import patch_obj
+
+
+configs = Path(__file__).parent / 'configs'
+
+
+@pytest.fixture
+def server(tmp_path: Path):
+    server = agent_server.AgentServer(agent_server.Agent(ttl=60), tmp_path / 'agent.sock')
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+@pytest.fixture
+def client(server):
+    return agent.AgentClient(server.socket_fpath)
+
+
+class TestAgentClient:
+    def test_not_running(self, tmp_path: Path):
+        client = agent.AgentClient(tmp_path / 'agent.sock')
+        assert client.ping() is None
+        assert client.resolve(configs / 'basics.yaml', ['tng']) is None
+        assert client.aws_creds('starfleet') is None
+
+    def test_stale_socket(self, tmp_path: Path):
+        fpath = tmp_path / 'agent.sock'
+        fpath.touch()
+        assert agent.AgentClient(fpath).ping() is None
+
+    def test_not_private(self, client: agent.AgentClient, server):
+        server.socket_fpath.parent.chmod(0o777)
+        assert client.ping() is None
+
+        server.socket_fpath.parent.chmod(0o700)
+        assert client.ping()
+        with mock.patch.object(utils.os, 'getuid', return_value=utils.os.getuid() + 1):
+            assert client.ping() is None
+
+    def test_socket_fpath(self):
+        with mock.patch.dict(agent.environ, {'XDG_RUNTIME_DIR': '/run/user/1701'}):
+            assert agent.socket_fpath() == Path('/run/user/1701/env-config/agent.sock')
+
+        with mock.patch.dict(agent.environ, {'XDG_RUNTIME_DIR': ''}):
+            fpath = agent.socket_fpath()
+        assert fpath == utils.TMP_DPATH / f'agent-{utils.os.getuid()}' / 'agent.sock'
+
+    @mock.patch.dict(agent.environ, {'ENV_CONFIG_AGENT': 'off'})
+    def test_disabled(self):
+        assert agent.disabled()
+
+
+class TestAgent:
+    def test_ping(self, client: agent.AgentClient, server):
+        assert client.ping() == {'pid': mock.ANY, 'configs': 0}
+        assert server.socket_fpath.stat().st_mode & 0o777 == 0o600
+        assert server.socket_fpath.parent.stat().st_mode & 0o777 == 0o700
+
+    def test_not_owned(self, tmp_path: Path):
+        with (
+            mock.patch.object(utils.os, 'getuid', return_value=utils.os.getuid() + 1),
+            pytest.raises(core.UserError, match='is owned by another user'),
+        ):
+            agent_server.AgentServer(agent_server.Agent(), tmp_path / 'agent.sock')
+
+    def test_unknown(self, client: agent.AgentClient):
+        assert client.request({'op': 'self-destruct'}) is None
+
+    @patch_obj(core.OPResolver, attribute='convert')
+    def test_resolve(self, m_convert, client: agent.AgentClient):
+        m_convert.side_effect = lambda uri: uri.rsplit('/', 1)[-1]
+
+        expected = {'SISKO': 'sisko', 'KIRA': 'kira', 'ODO': 'changeling', 'DAX': 'dax'}
+        response = client.resolve(configs / '1pass.yaml', ['ds9'])
+        assert response == {'env_vars': expected}
+        assert m_convert.call_count == 3
+
+        # Secrets are kept in memory
+        assert client.resolve(configs / '1pass.yaml', ['ds9']) == {'env_vars': expected}
+        assert m_convert.call_count == 3
+
+        # Unless the client doesn't want them cached
+        client.resolve(configs / '1pass.yaml', ['ds9'], cache=False)
+        assert m_convert.call_count == 6
+
+    @patch_obj(core.OPResolver, attribute='convert')
+    def test_resolve_cached_per_op_account(self, m_convert, client: agent.AgentClient):
+        m_convert.side_effect = lambda uri: uri.rsplit('/', 1)[-1]
+        fpath = configs / '1pass.yaml'
+
+        with mock.patch.dict(agent.environ, {'OP_ACCOUNT': 'starfleet'}):
+            client.resolve(fpath, ['ds9'])
+            client.resolve(fpath, ['ds9'])
+        assert m_convert.call_count == 3
+
+        with mock.patch.dict(agent.environ, {'OP_ACCOUNT': 'maquis'}):
+            client.resolve(fpath, ['ds9'])
+        assert m_convert.call_count == 6
+
+    @patch_obj(core.OPResolver, attribute='convert', return_value='secret')
+    def test_resolve_config_ttl(self, m_convert, client: agent.AgentClient, tmp_path: Path):
+        fpath = tmp_path / 'env-config.yaml'
+        fpath.write_text('cache:\n  ttl: 0\nprofile:\n  tng:\n    RIKER: op://private/riker/pw\n')
+
+        # The config doesn't cache, the agent's TTL is only a default
+        client.resolve(fpath, ['tng'])
+        client.resolve(fpath, ['tng'])
+        assert m_convert.call_count == 2
+
+        # The client's TTL overrides the config's
+        client.resolve(fpath, ['tng'], cache_ttl=60)
+        client.resolve(fpath, ['tng'], cache_ttl=60)
+        assert m_convert.call_count == 3
+
+    def test_resolve_uses_client_env(self, client: agent.AgentClient):
+        fpath = configs / 'vars-and-env.yaml'
+
+        with mock.patch.dict(agent.environ, {'DB_PASS': '123'}):
+            assert client.resolve(fpath, ['db']) == {'env_vars': {'password': '123/456'}}
+
+        with mock.patch.dict(agent.environ, {'DB_PASS': '789'}):
+            assert client.resolve(fpath, ['db']) == {'env_vars': {'password': '789/456'}}
+
+    def test_resolve_uses_client_env_and_cwd(self, client: agent.AgentClient, tmp_path: Path):
+        fpath = tmp_path / 'env-config.yaml'
+        fpath.write_text(
+            'profile:\n  tng:\n    PICARD: env://CLIENT_ONLY\n    RIKER: file://riker.txt\n',
+        )
+        tmp_path.joinpath('riker.txt').write_text('number one\n')
+
+        response = client.request(
+            {
+                'op': 'resolve',
+                'config': str(fpath),
+                'names': ['tng'],
+                'env': {'CLIENT_ONLY': 'captain'},
+                'cwd': str(tmp_path),
+                'options': {},
+            },
+        )
+        assert response == {'env_vars': {'PICARD': 'captain', 'RIKER': 'number one'}}
+
+    def test_resolve_sends_cwd(self, client: agent.AgentClient, monkeypatch, tmp_path: Path):
+        monkeypatch.chdir(tmp_path)
+        with patch_obj(client, 'request') as m_request:
+            client.resolve(configs / '1pass.yaml', ['ds9'])
+        assert m_request.call_args.args[0]['cwd'] == str(tmp_path)
+
+    @patch_obj(core.OPResolver, attribute='convert')
+    def test_resolve_errors(self, m_convert, client: agent.AgentClient):
+        m_convert.side_effect = RuntimeError('1Pass is locked')
+
+        ec = core.EnvConfig(
+            config.load(configs / '1pass.yaml'),
+            agent=client,
+            config_fpath=configs / '1pass.yaml',
+        )
+        with pytest.raises(core.ResolveError) as info:
+            ec.resolve(['ds9'])
+
+        assert set(info.value.errors) == {'SISKO', 'KIRA', 'DAX'}
+        assert str(info.value.errors['KIRA']) == '1Pass is locked'
+
+    def test_config_reloaded(self, client: agent.AgentClient, tmp_path: Path):
+        fpath = tmp_path / 'env-config.yaml'
+        fpath.write_text('profile:\n  tng:\n    PICARD: captain\n')
+        assert client.resolve(fpath, ['tng']) == {'env_vars': {'PICARD': 'captain'}}
+
+        fpath.write_text('profile:\n  tng:\n    PICARD: admiral of the fleet\n')
+        assert client.resolve(fpath, ['tng']) == {'env_vars': {'PICARD': 'admiral of the fleet'}}
+
+    @patch_obj(aws, 'renew_sess_creds')
+    def test_aws_creds(self, m_renew, client: agent.AgentClient):
+        creds = aws.SessCreds('key-id', 'sec-key', 'sess-token', utils.utc_now_in(minutes=30))
+        m_renew.return_value = creds
+
+        with mock.patch.dict(agent.environ, {'AWS_CONFIG_FILE': str(configs / 'aws-config')}):
+            assert client.aws_creds('starfleet') == creds.cli_json()
+            assert client.aws_creds('starfleet') == creds.cli_json()
+
+        m_renew.assert_called_once_with(
+            'op://Employee/starfleet-aws/',
+            'arn:aws:iam::123456789:mfa/engineering',
+            duration=3600,
+            profile='starfleet',
+        )
+
+    @patch_obj(aws, 'renew_sess_creds')
+    def test_aws_creds_caller_settings(self, m_renew, tmp_path: Path):
+        creds = aws.SessCreds('key-id', 'sec-key', 'sess-token', utils.utc_now_in(minutes=30))
+        m_renew.return_value = creds
+        tmp_path.joinpath('aws-config').write_text((configs / 'aws-config').read_text())
+        tmp_path.joinpath('env-config.yaml').write_text('aws:\n  duration: 7200\n')
+
+        # The agent's own environment and current directory don't have these settings
+        request = {
+            'op': 'aws_creds',
+            'profile': 'starfleet',
+            'env': {
+                'AWS_CONFIG_FILE': 'aws-config',
+                aws.REFRESH_THRESHOLD_ENVVAR: '3600',
+                aws.REFRESH_AHEAD_ENVVAR: '0',
+            },
+            'cwd': str(tmp_path),
+        }
+        agent = agent_server.Agent()
+        assert agent.handle(request) == {'creds': creds.cli_json()}
+        # Expires within the caller's threshold so is generated again
+        assert agent.handle(request) == {'creds': creds.cli_json()}
+
+        assert m_renew.call_count == 2
+        m_renew.assert_called_with(
+            'op://Employee/starfleet-aws/',
+            'arn:aws:iam::123456789:mfa/engineering',
+            duration=7200,
+            profile='starfleet',
+        )
+
+    @patch_obj(aws, 'renew_sess_creds')
+    def test_aws_creds_refresh_ahead(self, m_renew, client: agent.AgentClient, server):
+        creds = aws.SessCreds('key-id', 'sec-key', 'sess-token', utils.utc_now_in(minutes=10))
+        renewed = aws.SessCreds('new-id', 'sec-key', 'sess-token', utils.utc_now_in(minutes=60))
+        m_renew.side_effect = (creds, renewed)
+
+        with mock.patch.dict(agent.environ, {'AWS_CONFIG_FILE': str(configs / 'aws-config')}):
+            assert client.aws_creds('starfleet') == creds.cli_json()
+            # Still served while renewing in the background
+            assert client.aws_creds('starfleet') == creds.cli_json()
+
+            for _ in range(100):
+                if not server.agent.renewing:
+                    break
+                time.sleep(0.01)
+
+            assert client.aws_creds('starfleet') == renewed.cli_json()
+
+        assert m_renew.call_count == 2
+        m_renew.assert_called_with(
+            'op://Employee/starfleet-aws/',
+            'arn:aws:iam::123456789:mfa/engineering',
+            ahead=True,
+            duration=3600,
+            profile='starfleet',
+        )
+
+
+class TestEnvConfigWithAgent:
+    @patch_obj(core.OPResolver, attribute='convert', return_value='in-process')
+    def test_falls_back_without_agent(self, m_convert, tmp_path: Path):
+        ec = core.EnvConfig(
+            config.load(configs / '1pass.yaml'),
+            agent=agent.AgentClient(tmp_path / 'agent.sock'),
+            config_fpath=configs / '1pass.yaml',
+        )
+        assert ec.resolve(['tng']) == {'PICARD': 'captain', 'RIKER': 'in-process'}
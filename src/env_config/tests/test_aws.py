@@ -1,6 +1,13 @@
+from concurrent.futures import ThreadPoolExecutor
+import datetime as dt
+import json
 from pathlib import Path
+import time
 from unittest import mock
 
+import msgpack
+import pytest
+
 from env_config import aws, utils
 from env_config.libs.testing import patch_obj
 
@@ -16,40 +23,164 @@ class TestAWS:
         assert config.op_ref_base == 'op://Employee/starfleet-aws/'
         assert config.profile == 'starfleet'
 
-    @patch_obj(aws.utils, 'op_read')
-    def test_op_auth(self, m_op_read):
-        m_op_read.side_effect = ('123456', 'key-id', 'secret')
+    def test_profile_config_not_env_config(self, tmp_path: Path):
+        with mock.patch.object(aws, 'PROFILE_INDEX_DPATH', tmp_path), pytest.raises(KeyError):
+            aws.profile_config('romulan', config_fpath=configs / 'aws-config')
+
+    def test_profile_config_indexed(self, tmp_path: Path):
+        with mock.patch.object(aws, 'PROFILE_INDEX_DPATH', tmp_path):
+            config = aws.profile_config('starfleet-dev', config_fpath=configs / 'aws-config')
+
+            with mock.patch('configparser.ConfigParser') as m_parser:
+                assert aws.profile_config('starfleet-dev', config_fpath=configs / 'aws-config') == (
+                    config
+                )
+            assert not m_parser.called
+
+        assert config == aws.ProfileConfig(
+            'starfleet-dev',
+            'op://Employee/starfleet-dev-aws/',
+            'arn:aws:iam::123456789:mfa/engineering',
+            43200,
+        )
+
+    def test_session_duration(self, tmp_path: Path):
+        config_fpath = tmp_path / 'env-config.yaml'
+        yaml = 'aws:\n  duration: 7200\n  profile:\n    starfleet-prod: 99999999\n'
+        config_fpath.write_text(yaml)
+
+        def duration(profile):
+            config = aws.profile_config(profile, config_fpath=configs / 'aws-config')
+            with mock.patch.dict(utils.environ, {'ENV_CONFIG_CONFIG': str(config_fpath)}):
+                return aws.session_duration(config)
+
+        # From the AWS config
+        assert duration('starfleet-dev') == 43200
+        # Default from env-config.yaml
+        assert duration('starfleet') == 7200
+
+        # Limited to the STS max
+        config = aws.ProfileConfig('starfleet-prod', 'op://Employee/starfleet-prod-aws/', '')
+        with mock.patch.dict(utils.environ, {'ENV_CONFIG_CONFIG': str(config_fpath)}):
+            assert aws.session_duration(config) == aws.SESSION_DURATION_MAX
+
+        # No env-config.yaml
+        with mock.patch.dict(utils.environ, {'ENV_CONFIG_CONFIG': str(tmp_path / 'missing')}):
+            assert aws.session_duration(config) == aws.SESSION_DURATION
+
+        # Malformed env-config.yaml, credentials are still generated
+        config_fpath.write_text('aws: [\n')
+        with mock.patch.dict(utils.environ, {'ENV_CONFIG_CONFIG': str(config_fpath)}):
+            assert aws.session_duration(config) == aws.SESSION_DURATION
+
+    def test_env_config_profiles(self):
+        profiles = aws.env_config_profiles(config_fpath=configs / 'aws-config')
+        assert profiles == ['starfleet', 'starfleet-dev']
+
+    @patch_obj(aws, 'op_sess_creds')
+    def test_prewarm(self, m_op_sess_creds):
+        creds = aws.SessCreds('key-id', 'sec-key', 'sess-token', utils.utc_now_in(minutes=60))
+        error = RuntimeError('1Pass is locked')
+        m_op_sess_creds.side_effect = (creds, error)
+
+        profiles = [
+            aws.ProfileConfig('starfleet', 'op://Employee/starfleet-aws/', ''),
+            aws.ProfileConfig('starfleet-dev', 'op://Employee/starfleet-dev-aws/', ''),
+        ]
+        results = aws.prewarm(profiles, concurrency=1)
+
+        assert [(result.profile, result.creds, result.error) for result in results] == [
+            ('starfleet', creds, None),
+            ('starfleet-dev', None, error),
+        ]
+
+    @patch_obj(aws.utils, 'sub_run')
+    def test_op_auth(self, m_sub_run):
+        m_sub_run.return_value.stdout = json.dumps(
+            {
+                'fields': [
+                    {'id': 'a', 'label': 'access-key-id', 'value': 'key-id'},
+                    {'id': 'b', 'label': 'secret-access-key', 'value': 'secret'},
+                    {
+                        'id': 'c',
+                        'label': 'one-time password',
+                        'section': {'id': 'd', 'label': 'Security'},
+                        'totp': '123456',
+                    },
+                ],
+            },
+        )
         auth = aws.op_auth('op://Private/aws', 'arn...mfa/phaser')
         assert auth.access_key_id == 'key-id'
         assert auth.secret_key == 'secret'
         assert auth.mfa_serial == 'arn...mfa/phaser'
         assert auth.mfa_code == '123456'
 
-        assert m_op_read.mock_calls == [
-            mock.call('op://Private/aws/Security/one-time password?attribute=otp'),
-            mock.call('op://Private/aws/access-key-id'),
-            mock.call('op://Private/aws/secret-access-key'),
-        ]
+        # The item is fetched once for all fields
+        m_sub_run.assert_called_once_with(
+            'op',
+            'item',
+            'get',
+            'aws',
+            '--vault',
+            'Private',
+            '--format',
+            'json',
+            capture=True,
+            timeout=utils.CALL_TIMEOUT,
+        )
 
-    @patch_obj(aws.utils, 'op_read')
-    def test_op_auth_no_mfa(self, m_op_read):
-        m_op_read.side_effect = ('key-id', 'secret')
-        auth = aws.op_auth('op://Private/aws')
+        auth = aws.op_auth('op://Private/aws/')
         assert auth.access_key_id == 'key-id'
         assert auth.secret_key == 'secret'
         assert auth.mfa_serial == ''
         assert auth.mfa_code is None
 
-        assert m_op_read.mock_calls == [
-            mock.call('op://Private/aws/access-key-id'),
-            mock.call('op://Private/aws/secret-access-key'),
-        ]
+
+class TestProfileIndex:
+    def test_config_changed(self, tmp_path: Path):
+        config_fpath = tmp_path / 'config'
+        config_fpath.write_text((configs / 'aws-config').read_text())
+        index = aws.ProfileIndex(config_fpath, tmp_path / 'index')
+
+        assert index.read() is None
+        assert list(index.profiles()) == ['starfleet', 'starfleet-dev']
+        assert index.read() == index.profiles()
+
+        with config_fpath.open('a') as fo:
+            fo.write('\n[profile starfleet-prod]\nmfa_serial = arn\nenvconfig_1pass = op://x/y/\n')
+        assert index.read() is None
+        assert list(index.profiles()) == ['starfleet', 'starfleet-dev', 'starfleet-prod']
+
+    def test_missing_config(self, tmp_path: Path):
+        index = aws.ProfileIndex(tmp_path / 'config', tmp_path / 'index')
+        assert index.profiles() == {}
+        assert not index.fpath.exists()
+
+    def test_not_private(self, tmp_path: Path):
+        config_fpath = tmp_path / 'config'
+        config_fpath.write_text((configs / 'aws-config').read_text())
+        index = aws.ProfileIndex(config_fpath, tmp_path / 'index')
+        index.build()
+        assert index.fpath.parent.stat().st_mode & 0o777 == 0o700
+
+        # E.g. planted by another user, it's rebuilt rather than trusted
+        index.fpath.chmod(0o666)
+        assert index.read() is None
+        assert list(index.profiles()) == ['starfleet', 'starfleet-dev']
+        assert index.read() == index.profiles()
+
+        with mock.patch.object(utils.os, 'getuid', return_value=utils.os.getuid() + 1):
+            assert index.read() is None
+            assert list(index.profiles()) == ['starfleet', 'starfleet-dev']
 
 
 class TestOPSessCreds:
+    # The creds are far enough into the default session duration to be renewed ahead
+    @patch_obj(aws, 'renew_in_background')
     @patch_obj(aws, 'op_auth')
     @patch_obj(aws, 'sts_session')
-    def test_basics(self, m_sts_sess, m_op_auth, tmp_path: Path):
+    def test_basics(self, m_sts_sess, m_op_auth, m_renew, tmp_path: Path):
         m_sts_sess.return_value = creds = aws.SessCreds(
             'key-id',
             'sec-key',
@@ -84,3 +215,205 @@ class TestOPSessCreds:
         assert aws.op_sess_creds('op://env-config-test/aws', 'foo', _cache_dpath=tmp_path) == creds
 
         assert m_op_auth.call_count == 2
+
+    @patch_obj(aws, 'op_auth')
+    @patch_obj(aws, 'sts_session')
+    def test_refresh_threshold(self, m_sts_sess, m_op_auth, tmp_path: Path):
+        m_sts_sess.return_value = aws.SessCreds(
+            'key-id',
+            'sec-key',
+            'sess-token',
+            utils.utc_now_in(minutes=20),
+            utils.utc_now(),
+        )
+        aws.op_sess_creds('op://env-config-test/aws', 'foo', _cache_dpath=tmp_path, duration=1200)
+        m_sts_sess.assert_called_once_with(m_op_auth.return_value, 1200)
+
+        with mock.patch.dict(utils.environ, {aws.REFRESH_THRESHOLD_ENVVAR: str(30 * 60)}):
+            aws.op_sess_creds('op://env-config-test/aws', 'foo', _cache_dpath=tmp_path)
+        assert m_op_auth.call_count == 2
+
+    @patch_obj(aws, 'renew_in_background')
+    @patch_obj(aws, 'op_auth')
+    def test_refresh_ahead(self, m_op_auth, m_renew, tmp_path: Path):
+        creds = aws.SessCreds(
+            'key-id',
+            'sec-key',
+            'sess-token',
+            utils.utc_now_in(minutes=10),
+            utils.utc_now_in(minutes=-50),
+        )
+        enc_tmp = aws.sess_creds_cache('op://env-config-test/aws', 'foo', tmp_path)
+        enc_tmp.save(creds.to_msgpack(), creds.expiration.timestamp())
+
+        # Cached creds are returned right away and renewed in the background
+        assert aws.op_sess_creds('op://env-config-test/aws', 'foo', _cache_dpath=tmp_path) == creds
+        m_renew.assert_called_once_with('op://env-config-test/aws', 'foo', tmp_path, 3600, '')
+        assert not m_op_auth.called
+
+        with mock.patch.dict(utils.environ, {aws.REFRESH_AHEAD_ENVVAR: '0'}):
+            aws.op_sess_creds('op://env-config-test/aws', 'foo', _cache_dpath=tmp_path)
+        assert m_renew.call_count == 1
+
+
+class TestRenew:
+    @mock.patch('subprocess.Popen')
+    def test_in_background(self, m_popen, tmp_path: Path):
+        aws.renew_in_background('op://env-config-test/aws', 'foo', tmp_path, 7200, 'starfleet')
+
+        m_popen.assert_called_once()
+        args = m_popen.call_args.args[0]
+        assert args[1:] == [
+            '-m',
+            'env_config.aws',
+            'op://env-config-test/aws',
+            'foo',
+            '7200',
+            'starfleet',
+            str(tmp_path),
+        ]
+        assert m_popen.call_args.kwargs['start_new_session']
+
+        # Already in progress
+        aws.renew_in_background('op://env-config-test/aws', 'foo', tmp_path)
+        m_popen.assert_called_once()
+
+    @patch_obj(aws, 'op_auth')
+    @patch_obj(aws, 'sts_session')
+    def test_renew_sess_creds(self, m_sts_sess, m_op_auth, tmp_path: Path):
+        m_sts_sess.return_value = creds = aws.SessCreds(
+            'key-id',
+            'sec-key',
+            'sess-token',
+            utils.utc_now_in(minutes=60),
+            utils.utc_now(),
+        )
+        enc_tmp = aws.sess_creds_cache('op://env-config-test/aws', 'foo', tmp_path)
+        marker = aws.renew_marker(enc_tmp)
+        marker.touch()
+
+        assert aws.renew_sess_creds('op://env-config-test/aws', 'foo', tmp_path) == creds
+        assert aws.cached_sess_creds(enc_tmp) == creds
+        # Belongs to a background renewal that's still running
+        assert marker.exists()
+
+    @patch_obj(aws, 'renew_sess_creds')
+    def test_background_renewal(self, m_renew, tmp_path: Path):
+        enc_tmp = aws.sess_creds_cache('op://env-config-test/aws', 'foo', tmp_path)
+        marker = aws.renew_marker(enc_tmp)
+        marker.touch()
+        m_renew.side_effect = RuntimeError('1Pass is locked')
+
+        with pytest.raises(RuntimeError):
+            aws.background_renewal('op://env-config-test/aws', 'foo', 7200, 'starfleet', tmp_path)
+
+        m_renew.assert_called_once_with(
+            'op://env-config-test/aws',
+            'foo',
+            tmp_path,
+            ahead=True,
+            duration=7200,
+            profile='starfleet',
+        )
+        assert not marker.exists()
+
+    @patch_obj(aws, 'op_auth')
+    @patch_obj(aws, 'sts_session')
+    def test_single_flight(self, m_sts_sess, m_op_auth, tmp_path: Path):
+        def sts_session(auth, duration):
+            time.sleep(0.2)
+            return aws.SessCreds('key-id', 'sec-key', 'sess-token', utils.utc_now_in(minutes=60))
+
+        m_sts_sess.side_effect = sts_session
+
+        with ThreadPoolExecutor() as executor:
+            futures = [
+                executor.submit(aws.op_sess_creds, 'op://env-config-test/aws', 'foo', tmp_path)
+                for _ in range(4)
+            ]
+            results = [future.result() for future in futures]
+
+        # One caller generated the credentials, the others waited and read them from the cache
+        m_op_auth.assert_called_once()
+        assert len(set(results)) == 1
+
+
+class TestSessCreds:
+    def test_msgpack_round_trip(self):
+        creds = aws.SessCreds('key-id', 'sec-key', 'sess-token', utils.utc_now_in(minutes=6))
+        assert aws.SessCreds.from_msgpack(creds.to_msgpack()) == creds
+
+        creds = creds._replace(issued_at=utils.utc_now())
+        assert aws.SessCreds.from_msgpack(creds.to_msgpack()) == creds
+
+    def test_needs_renewal(self):
+        def creds(expires_in, issued_ago=None):
+            issued_at = None if issued_ago is None else utils.utc_now_in(minutes=-issued_ago)
+            return aws.SessCreds(
+                'id',
+                'key',
+                'token',
+                utils.utc_now_in(minutes=expires_in),
+                issued_at,
+            )
+
+        assert not creds(expires_in=30, issued_ago=30).needs_renewal(0.75)
+        assert creds(expires_in=10, issued_ago=50).needs_renewal(0.75)
+        assert creds(expires_in=30, issued_ago=30).needs_renewal(0.5)
+
+        # Lifetime assumed to be the default session duration
+        assert not creds(expires_in=30).needs_renewal(0.75)
+        assert creds(expires_in=10).needs_renewal(0.75)
+
+        # Disabled
+        assert not creds(expires_in=10, issued_ago=50).needs_renewal(0)
+        assert not creds(expires_in=10, issued_ago=50).needs_renewal(1)
+
+    def test_msgpack_compat(self):
+        # Format previously written by pyserde, cache files may still be around
+        data = msgpack.packb(
+            {
+                'access_key_id': 'key-id',
+                'secret_key': 'sec-key',
+                'session_token': 'sess-token',
+                'expiration': '2024-09-30T18:12:34+00:00',
+            },
+        )
+        creds = aws.SessCreds.from_msgpack(data)
+        assert creds.access_key_id == 'key-id'
+        assert creds.expiration == dt.datetime(2024, 9, 30, 18, 12, 34, tzinfo=dt.UTC)
+
+
+class TestCredsStats:
+    def test_percentile(self):
+        assert aws.percentile([], 50) is None
+        assert aws.percentile([5.0], 95) == 5.0
+        values = [float(num) for num in range(1, 21)]
+        assert aws.percentile(values, 50) == 10.0
+        assert aws.percentile(values, 95) == 19.0
+
+    def test_creds_stats(self):
+        records = [
+            {'event': 'creds', 'profile': 'starfleet', 'cache': 'miss', 'duration_ms': 900.0},
+            {'event': 'generate', 'profile': 'starfleet', 'ahead': False},
+            {'event': 'creds', 'profile': 'starfleet', 'cache': 'hit', 'duration_ms': 10.0},
+            {'event': 'creds', 'profile': 'starfleet', 'cache': 'agent', 'duration_ms': 2.0},
+            {'event': 'generate', 'profile': 'starfleet', 'ahead': True},
+            {'event': 'creds', 'profile': 'romulan', 'cache': 'hit'},
+            # Not credential events
+            {'msg': 'Resolved 3 env vars'},
+            {'event': 'creds', 'profile': ''},
+        ]
+
+        stats = aws.creds_stats(records)
+        assert list(stats) == ['romulan', 'starfleet']
+        assert stats['starfleet'] == aws.CredsStats(
+            requests=3,
+            hits=2,
+            generated=2,
+            ahead=1,
+            p50_ms=10.0,
+            p95_ms=900.0,
+        )
+        assert stats['starfleet'].hit_rate == 2 / 3
+        assert stats['romulan'].p50_ms is None
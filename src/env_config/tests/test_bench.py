@@ -0,0 +1,50 @@
+import json
+from pathlib import Path
+
+from click.testing import CliRunner
+
+from env_config import config
+from env_config.libs import bench
+
+
+class TestBench:
+    def test_write_config(self, tmp_path: Path):
+        fpath = bench.write_config(tmp_path / 'env-config.yaml', 10, 4, 2)
+        conf = config.load(fpath, tmp_path)
+
+        assert len(conf.profiles) == 10
+        assert conf.view().profile['prof-3'].PROF_3_VAR_1 == 'op://vault-1/item-3/field-1'
+        assert conf.groups['group-1'].members == ('prof-1', 'prof-3', 'prof-5', 'prof-7', 'prof-9')
+
+    def test_run(self, tmp_path: Path):
+        output = tmp_path / 'bench.json'
+        args = ('--iterations', '2', '--profiles', '20', '--op-latency', '0', '--output', output)
+        result = CliRunner(mix_stderr=False).invoke(bench.main, args, catch_exceptions=False)
+        assert result.exit_code == 0, result.stderr
+
+        report = json.loads(output.read_text())
+        assert report['meta']['profiles'] == 20
+        assert set(report['results']) == {
+            'config.load.small.parse',
+            'config.load.small.compiled',
+            'config.load.large.parse',
+            'config.load.large.compiled',
+            'EnvConfig.select',
+            'EnvConfig.select_groups',
+            'EnvConfig.present_env_vars',
+            'EnvConfig.resolve.serial',
+            'EnvConfig.resolve.concurrent',
+            'EnvConfig.resolve.batch',
+            'aws.op_sess_creds.miss',
+            'aws.op_sess_creds.hit',
+            'EncryptedTempFile.fernet.save',
+            'EncryptedTempFile.fernet.read',
+            'EncryptedTempFile.aesgcm.save',
+            'EncryptedTempFile.aesgcm.read',
+        }
+        assert report['results']['EnvConfig.select']['iterations'] == 2
+
+    def test_compare(self):
+        baseline = {'fast': {'median_ms': 10.0}, 'slow': {'median_ms': 10.0}}
+        results = {'fast': {'median_ms': 9.0}, 'slow': {'median_ms': 13.0}, 'new': {}}
+        assert bench.compare(results, baseline, threshold=20) == ['slow']
@@ -0,0 +1,65 @@
+from pathlib import Path
+import time
+from unittest import mock
+
+from env_config.cache import SecretCache
+
+
+class TestSecretCache:
+    def test_get_set(self, tmp_path: Path):
+        cache = SecretCache(tmp_path)
+        assert cache.get('op://private/runabout/phasers') is None
+
+        cache.set('op://private/runabout/phasers', 'stun', 60)
+        assert cache.get('op://private/runabout/phasers') == 'stun'
+        assert cache.get('op://private/runabout/shields') is None
+
+        # Cached value is not stored in plain text
+        assert b'stun' not in cache.store.fpath.read_bytes()
+        assert b'stun' not in tmp_path.joinpath(f'{cache.store.fpath.name}-wal').read_bytes()
+
+    def test_expired(self, tmp_path: Path):
+        cache = SecretCache(tmp_path)
+        cache.set('op://private/runabout/phasers', 'stun', 60)
+
+        with mock.patch.object(time, 'time', return_value=time.time() + 61):
+            assert cache.get('op://private/runabout/phasers') is None
+
+    def test_no_ttl_not_saved(self, tmp_path: Path):
+        cache = SecretCache(tmp_path)
+        cache.set('op://private/runabout/phasers', 'stun', 0)
+        assert cache.get('op://private/runabout/phasers') is None
+        assert cache.store.clear() == 0
+
+    def test_refresh(self, tmp_path: Path):
+        SecretCache(tmp_path).set('op://private/runabout/phasers', 'stun', 60)
+
+        cache = SecretCache(tmp_path, refresh=True)
+        assert cache.get('op://private/runabout/phasers') is None
+        cache.set('op://private/runabout/phasers', 'kill', 60)
+
+        assert SecretCache(tmp_path).get('op://private/runabout/phasers') == 'kill'
+
+    def test_corrupt_is_miss(self, tmp_path: Path):
+        cache = SecretCache(tmp_path)
+        cache.set('op://private/runabout/phasers', 'stun', 60)
+        enc_tmp = cache.enc_file('op://private/runabout/phasers')
+        cache.store.set(enc_tmp.store_key, b'garbage', time.time() + 60)
+
+        assert cache.get('op://private/runabout/phasers') is None
+
+    def test_clear(self, tmp_path: Path):
+        cache = SecretCache(tmp_path)
+        assert cache.clear() == 0
+
+        cache.set('op://private/runabout/phasers', 'stun', 60)
+        cache.set('op://private/runabout/shields', 'up', 60)
+        # Saved by an older version
+        cache.legacy_dpath.mkdir()
+        cache.enc_file('op://private/runabout/cloak').fpath.write_bytes(b'old')
+        # Not a secret
+        cache.store.set('aws:starfleet', b'creds', time.time() + 60)
+
+        assert cache.clear() == 3
+        assert cache.get('op://private/runabout/phasers') is None
+        assert cache.store.get('aws:starfleet')
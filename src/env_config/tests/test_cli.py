@@ -1,8 +1,17 @@
+import json
+import os
+from os import environ
 from pathlib import Path
+import re
+from unittest import mock
 
 from click.testing import CliRunner, Result
+import pytest
 
+from env_config import aws, cli, core, entry, hook, timings, utils
+from env_config.cache import SecretCache
 from env_config.cli import ENVVAR_PREFIX, env_config, env_config_shell
+from env_config.libs.testing import patch_obj
 
 
 configs = Path(__file__).parent / 'configs'
@@ -51,7 +60,8 @@ class TestEnvConfig:
             env['ENV_CONFIG_SHELL'] = shell
 
         result = invoke(config_fname, *args, env=env, exit_code=exit_code)
-        assert result.stdout.strip() == expect_stdout.strip()
+        if expect_stdout is not None:
+            assert result.stdout.strip() == expect_stdout.strip()
         if expect_stderr is not None:
             assert result.stderr.strip() == expect_stderr.strip()
 
@@ -212,3 +222,340 @@ export RIKER=number1
             shell='bash',
             expect_stdout=expect_stdout,
         )
+
+    @patch_obj(timings, 'enable')
+    def test_timings(self, m_enable):
+        self.check_invoke('basics.yaml', 'tng', '--timings', '--debug', expect_stdout='')
+        m_enable.assert_called_once_with()
+
+    @patch_obj(core.OPResolver, attribute='convert')
+    def test_resolve_errors(self, m_convert):
+        m_convert.side_effect = RuntimeError('1Pass is locked')
+
+        result = self.check_invoke(
+            '1pass.yaml',
+            'ds9',
+            exit_code=2,
+            expect_stdout='',
+        )
+        error = result.stderr.strip()
+        assert error.endswith(
+            'Unable to resolve:\n'
+            '    SISKO: 1Pass is locked\n'
+            '    KIRA: 1Pass is locked\n'
+            '    DAX: 1Pass is locked',
+        )
+
+    @patch_obj(core.EnvConfig, 'resolve')
+    def test_concurrency_from_env(self, m_resolve):
+        m_resolve.return_value = {}
+
+        self.check_invoke(
+            'basics.yaml',
+            'tng',
+            expect_stdout='# FISH SOURCE\nset -gx _ENV_CONFIG_PROFILES tng',
+            ENV_CONFIG_CONCURRENCY='3',
+        )
+        envconf = m_resolve.call_args.args[0]
+        assert envconf.concurrency == 3
+
+    @patch_obj(core.OPResolver, attribute='convert')
+    def test_no_cache(self, m_convert, tmp_path):
+        m_convert.return_value = 'secret'
+
+        with patch_obj(cli, 'SecretCache') as m_cache_cls:
+            m_cache_cls.side_effect = lambda **kwargs: SecretCache(tmp_path, **kwargs)
+
+            self.check_invoke('1pass.yaml', 'ds9', expect_stdout=None)
+            self.check_invoke('1pass.yaml', 'ds9', expect_stdout=None)
+            assert m_convert.call_count == 3
+
+            self.check_invoke('1pass.yaml', 'ds9', '--refresh', expect_stdout=None)
+            assert m_convert.call_count == 6
+
+            self.check_invoke('1pass.yaml', 'ds9', '--no-cache', expect_stdout=None)
+            assert m_convert.call_count == 9
+
+    @patch_obj(core.OPResolver, attribute='convert')
+    def test_switch(self, m_convert):
+        m_convert.side_effect = lambda uri: uri.rsplit('/', 1)[-1]
+
+        expect_stdout = """
+# FISH SOURCE
+set -eg SISKO
+set -gx _ENV_CONFIG_PROFILES tng-movies
+set -gx RIKER captain
+set -gx WORF worf
+"""
+
+        expect_stderr = """
+Clearing:
+     SISKO
+Profiles active: tng-movies
+Setting:
+    RIKER: captain
+    WORF: op://starfleet/crew/worf
+Unchanged:
+     PICARD, DATA
+"""
+        env = {
+            '_ENV_CONFIG_PROFILES': 'tng',
+            'PICARD': 'captain',
+            'RIKER': 'number1',
+            'DATA': 'data',
+            'SISKO': 'captain',
+        }
+        self.check_invoke(
+            'switch.yaml',
+            'tng-movies',
+            '--switch',
+            '--no-cache',
+            expect_stdout=expect_stdout,
+            expect_stderr=expect_stderr,
+            **env,
+        )
+        m_convert.assert_called_once_with('op://starfleet/crew/worf')
+
+        # Debug shows the plan without setting anything
+        self.check_invoke(
+            'switch.yaml',
+            'tng-movies',
+            '--switch',
+            '--debug',
+            expect_stdout='',
+            expect_stderr=expect_stderr,
+            **env,
+        )
+
+
+class TestEnvConfigExec:
+    def invoke_exec(self, *args, exit_code=0, **env) -> Result:
+        config_fpath = configs.joinpath('basics.yaml').as_posix()
+        runner = CliRunner(mix_stderr=False)
+        result = runner.invoke(cli.env_config_exec, ['--config', config_fpath, *args], env=env)
+        assert result.exit_code == exit_code, (result.stdout, result.stderr)
+        return result
+
+    @patch_obj(cli.os, 'execvpe')
+    def test_exec(self, m_execvpe):
+        self.invoke_exec('tng', '--', 'make', '-j', '4', '--', 'test', SISKO='captain')
+
+        m_execvpe.assert_called_once()
+        file, args, env = m_execvpe.call_args.args
+        assert file == 'make'
+        assert args == ['make', '-j', '4', '--', 'test']
+        assert env['PICARD'] == 'captain'
+        assert env['RIKER'] == 'number1'
+        # Merged into the current environment
+        assert env['SISKO'] == 'captain'
+        assert env['PATH'] == environ['PATH']
+
+    @patch_obj(cli.os, 'execvpe')
+    def test_usage(self, m_execvpe):
+        result = self.invoke_exec('tng', 'make', exit_code=2)
+        assert 'Separate profiles and the command with --' in result.stderr
+
+        result = self.invoke_exec('tng', '--', exit_code=2)
+        assert 'Both profiles and a command are required' in result.stderr
+
+        result = self.invoke_exec('tng', 'borg', '--', 'make', exit_code=2)
+        assert 'Unknown profiles or groups: borg' in result.stderr
+
+        assert not m_execvpe.called
+
+    def test_command_not_found(self):
+        result = self.invoke_exec('tng', '--', 'env-config-no-such-command', exit_code=127)
+        assert result.stderr == (
+            'env-config exec: env-config-no-such-command: No such file or directory\n'
+        )
+
+
+class TestEnvConfigHook:
+    @pytest.fixture
+    def project(self, tmp_path: Path, monkeypatch) -> Path:
+        monkeypatch.setenv('TMPDIR', str(tmp_path / 'tmp'))
+        monkeypatch.setenv('XDG_DATA_HOME', str(tmp_path / 'data'))
+        project = tmp_path / 'enterprise'
+        project.mkdir()
+        project.joinpath('env-config.yaml').write_text(
+            'profile:\n  tng:\n    PICARD: captain\nhook:\n  profiles: [tng]\n',
+        )
+        hook.allow(str(project / 'env-config.yaml'))
+        return project
+
+    def invoke_hook(self, **env) -> Result:
+        runner = CliRunner(mix_stderr=False)
+        result = runner.invoke(cli.env_config_hook, ['--shell', 'bash'], env=env)
+        assert result.exit_code == 0, result.stderr
+        return result
+
+    def test_enter_and_leave(self, project: Path, monkeypatch):
+        config_fpath = str(project / 'env-config.yaml')
+
+        monkeypatch.chdir(project)
+        result = self.invoke_hook()
+        assert result.stdout.splitlines() == [
+            '# BASH SOURCE',
+            'export _ENV_CONFIG_PROFILES=tng',
+            'export PICARD=captain',
+            '# BASH SOURCE',
+            f'export {hook.ENVVAR}={config_fpath}',
+        ]
+        assert result.stderr == 'env-config hook: profiles active: tng\n'
+
+        # Already active
+        assert self.invoke_hook(**{hook.ENVVAR: config_fpath}).stdout == ''
+
+        monkeypatch.chdir(project.parent)
+        env = {hook.ENVVAR: config_fpath, '_ENV_CONFIG_PROFILES': 'tng', 'PICARD': 'captain'}
+        assert self.invoke_hook(**env).stdout.splitlines() == [
+            '# BASH SOURCE',
+            'unset PICARD',
+            'unset _ENV_CONFIG_PROFILES',
+            '# BASH SOURCE',
+            f'unset {hook.ENVVAR}',
+        ]
+
+    def test_no_hook_profiles(self, project: Path, monkeypatch):
+        monkeypatch.chdir(project)
+        project.joinpath('env-config.yaml').write_text('profile:\n  tng:\n    PICARD: captain\n')
+
+        assert self.invoke_hook().stdout == ''
+        assert hook.unchanged()
+
+    def test_resolve_error_not_repeated(self, project: Path, monkeypatch):
+        project.joinpath('env-config.yaml').write_text('hook:\n  profiles: [ds9]\n')
+        hook.allow(str(project / 'env-config.yaml'))
+        monkeypatch.chdir(project)
+
+        result = self.invoke_hook()
+        assert 'env-config hook: ' in result.stderr
+        # Recorded so the next prompt doesn't fail again
+        assert result.stdout.splitlines()[-1] == (
+            f'export {hook.ENVVAR}={project / "env-config.yaml"}'
+        )
+
+    def test_not_allowed(self, project: Path, monkeypatch):
+        config_fpath = project / 'env-config.yaml'
+        config_fpath.write_text(config_fpath.read_text() + '# Changed since it was allowed\n')
+        monkeypatch.chdir(project)
+
+        result = self.invoke_hook()
+        assert result.stdout == ''
+        assert result.stderr == (
+            f'env-config hook: {config_fpath} is not allowed, review it and run'
+            ' `env-config hook allow` to activate its profiles\n'
+        )
+        # Nothing to do at the next prompt
+        assert hook.unchanged()
+
+        result = CliRunner(mix_stderr=False).invoke(cli.env_config_hook, ['allow'])
+        assert result.exit_code == 0, result.stderr
+        assert result.stderr == f'env-config hook: allowed {config_fpath}\n'
+
+        # Allowing it makes the cached lookup stale
+        assert not hook.unchanged()
+        result = self.invoke_hook()
+        assert result.stderr == 'env-config hook: profiles active: tng\n'
+
+    def test_changed_after_lookup(self, project: Path, monkeypatch):
+        config_fpath = project / 'env-config.yaml'
+        monkeypatch.chdir(project)
+
+        # The cached lookup is checked again before activating
+        config_fpath.write_text(config_fpath.read_text() + '# Changed since it was allowed\n')
+        with patch_obj(hook, 'read_cache', return_value=(str(config_fpath), ['tng'])):
+            result = self.invoke_hook()
+        assert result.stdout == ''
+        assert 'is not allowed' in result.stderr
+
+    def test_allow_missing(self, tmp_path: Path):
+        result = CliRunner(mix_stderr=False).invoke(cli.env_config_hook, ['allow', str(tmp_path)])
+        assert result.exit_code == 2
+        assert f'No env-config.yaml in {tmp_path} or parents' in result.stderr
+
+
+class TestEnvConfigCache:
+    def test_clear(self, tmp_path):
+        SecretCache(tmp_path).set('op://private/runabout/phasers', 'stun', 60)
+
+        with patch_obj(cli, 'SecretCache') as m_cache_cls:
+            m_cache_cls.side_effect = lambda **kwargs: SecretCache(tmp_path, **kwargs)
+            result = CliRunner(mix_stderr=False).invoke(cli.env_config_cache, ['clear'])
+
+        assert result.exit_code == 0
+        assert result.stderr == 'Deleted 1 cached secret(s).\n'
+
+    def test_gc(self, tmp_path):
+        tmp_path.joinpath('old.bin').write_bytes(b'old')
+        os.utime(tmp_path / 'old.bin', (0, 0))
+
+        with mock.patch.object(utils, 'TMP_DPATH', tmp_path):
+            result = CliRunner(mix_stderr=False).invoke(cli.env_config_cache, ['gc'])
+
+        assert result.exit_code == 0
+        assert result.stderr == 'Deleted 1 expired or evicted cache entries and old file(s).\n'
+        assert not tmp_path.joinpath('old.bin').exists()
+
+
+class TestEnvConfigAWSPrewarm:
+    @mock.patch.dict(environ, {'AWS_CONFIG_FILE': str(configs / 'aws-config')})
+    @patch_obj(aws, 'op_sess_creds')
+    def test_all_profiles(self, m_op_sess_creds):
+        def op_sess_creds(op_ref_base, mfa_serial, duration, profile):
+            if 'dev' in op_ref_base:
+                raise RuntimeError('1Pass is locked')
+            return aws.SessCreds('key-id', 'sec-key', 'token', utils.utc_now_in(minutes=60))
+
+        m_op_sess_creds.side_effect = op_sess_creds
+        result = CliRunner(mix_stderr=False).invoke(cli.env_config_aws_prewarm, ['-j', '2'])
+
+        assert result.exit_code == 1
+        lines = result.stdout.splitlines()
+        assert re.match(r'starfleet      +\d+\.\d\ds  expires \d{4}-', lines[0])
+        assert re.match(r'starfleet-dev +\d+\.\d\ds  error: 1Pass is locked', lines[1])
+        assert lines[2] == '1 of 2 profiles ready'
+
+    @mock.patch.dict(environ, {'AWS_CONFIG_FILE': str(configs / 'aws-config')})
+    def test_unknown_profile(self):
+        result = CliRunner(mix_stderr=False).invoke(cli.env_config_aws_prewarm, ['klingon'])
+        assert result.exit_code == 2
+        assert 'AWS profile not found' in result.stderr
+
+    def test_subcommands_in_sync(self):
+        assert set(entry.AWS_SUBCOMMANDS) == set(cli.aws_subcommands)
+
+
+class TestEnvConfigAWSStats:
+    def test_stats(self, tmp_path):
+        fpath = tmp_path / 'env-config.log'
+        records = [
+            {'event': 'creds', 'profile': 'starfleet', 'cache': 'miss', 'duration_ms': 900.0},
+            {'event': 'generate', 'profile': 'starfleet', 'ahead': False},
+            {'event': 'creds', 'profile': 'starfleet', 'cache': 'hit', 'duration_ms': 10.0},
+        ]
+        fpath.write_text(''.join(json.dumps(record) + '\n' for record in records))
+
+        with mock.patch.object(utils, 'LOG_FPATH', fpath):
+            result = CliRunner(mix_stderr=False).invoke(cli.env_config_aws_stats, [])
+
+        assert result.exit_code == 0
+        lines = result.stdout.splitlines()
+        assert lines[0].split() == [
+            'Profile',
+            'Requests',
+            'Hit',
+            'rate',
+            'Generated',
+            'Ahead',
+            'p50',
+            'p95',
+        ]
+        assert lines[1].split() == ['starfleet', '2', '50.0%', '1', '0', '10.0ms', '900.0ms']
+
+    def test_no_events(self, tmp_path):
+        with mock.patch.object(utils, 'LOG_FPATH', tmp_path / 'env-config.log'):
+            result = CliRunner(mix_stderr=False).invoke(cli.env_config_aws_stats, [])
+
+        assert result.exit_code == 0
+        assert result.stdout == 'No env-config-aws requests logged\n'
@@ -1,9 +1,10 @@
+import os
 from pathlib import Path
 from unittest import mock
 
 import pytest
 
-from env_config import config, core
+from env_config import cli, config, core, model
 
 
 configs = Path(__file__).parent / 'configs'
@@ -15,9 +16,9 @@ def load(fname):
 
 
 class TestConfig:
-    @mock.patch.dict(config.environ, {'DB_PASS': '123'})
+    @mock.patch.dict(model.environ, {'DB_PASS': '123'})
     def test_vars_and_env(self):
-        conf = config.load(configs / 'vars-and-env.yaml')
+        conf = config.load(configs / 'vars-and-env.yaml').view()
         # As dict
         assert conf['profile']['bar']['BAZ1'] == 'b1'
 
@@ -38,8 +39,105 @@ class TestConfig:
 
         assert str(info.value) == 'No env-config.yaml in /tmp or parents'
 
+    def test_reserved_names(self, tmp_path):
+        config_fpath = tmp_path / 'env-config.yaml'
+        config_fpath.write_text('profile:\n  hook: {}\n  tng: {}\ngroup:\n  exec: [tng]\n')
+
+        with pytest.raises(core.UserError, match="can't be named exec, hook, those are"):
+            config.load(config_fpath, tmp_path)
+
+        assert set(cli.subcommands) == config.RESERVED_NAMES
+
     def test_invalid_suffix(self):
         with pytest.raises(core.UserError) as info:
             config.load(Path('/tmp/fake.py'))
 
         assert str(info.value) == '/tmp/fake.py should be a directory or .yaml file'
+
+
+class TestCompiledConfig:
+    @mock.patch.dict(model.environ, {'DB_PASS': '123'})
+    def test_same_as_parsed(self, tmp_path):
+        config_fpath = configs / 'vars-and-env.yaml'
+
+        m_load = mock.Mock(wraps=config.dynamic_yaml.load)
+        with mock.patch.object(config.dynamic_yaml, 'load', m_load):
+            parsed = config.load(config_fpath, compiled_dpath=tmp_path)
+            compiled = config.load(config_fpath, compiled_dpath=tmp_path)
+
+        # Only parsed the first time
+        assert m_load.call_count == 1
+        assert parsed == compiled
+
+        for conf in (parsed.view(), compiled.view()):
+            assert conf.profile.bar.BAZ1 == 'b1'
+            assert conf.profile.aws.key == 'private/key'
+            assert conf.profile.db.password == '123/456'
+
+    def test_templates_pre_rendered(self, tmp_path):
+        config_fpath = configs / 'vars-and-env.yaml'
+        config.load(config_fpath, compiled_dpath=tmp_path)
+
+        compiled = config.CompiledConfig(config_fpath, tmp_path)
+        data, _ = compiled.read(config_fpath.read_bytes())
+        assert data['profile']['aws'] == {'key': 'private/key', 'secret': 'private/secret'}
+        # Depends on the environment so has to be rendered when used
+        assert data['profile']['db'] == {'password': '{env.DB_PASS}/456'}
+
+    def test_env_from_current_environment(self, tmp_path):
+        config_fpath = configs / 'vars-and-env.yaml'
+
+        with mock.patch.dict(model.environ, {'DB_PASS': '123'}):
+            assert config.load(config_fpath, tmp_path).view().profile.db.password == '123/456'
+
+        with mock.patch.dict(model.environ, {'DB_PASS': '789'}):
+            assert config.load(config_fpath, tmp_path).view().profile.db.password == '789/456'
+
+    def test_config_changed(self, tmp_path):
+        config_fpath = tmp_path / 'env-config.yaml'
+        config_fpath.write_text('profile:\n  tng:\n    PICARD: captain\n')
+        assert config.load(config_fpath, tmp_path).view().profile.tng.PICARD == 'captain'
+
+        config_fpath.write_text('profile:\n  tng:\n    PICARD: admiral\n')
+        assert config.load(config_fpath, tmp_path).view().profile.tng.PICARD == 'admiral'
+
+    def test_not_compilable(self, tmp_path):
+        config_fpath = tmp_path / 'env-config.yaml'
+        config_fpath.write_text('profile:\n  tng:\n    STARDATE: 2364-09-26\n')
+
+        conf = config.load(config_fpath, tmp_path).view()
+        assert str(conf.profile.tng.STARDATE) == '2364-09-26'
+        assert not list(tmp_path.glob('*.msgpack'))
+
+    def test_not_private(self, tmp_path):
+        config_fpath = configs / 'vars-and-env.yaml'
+        content = config_fpath.read_bytes()
+        compiled = config.CompiledConfig(config_fpath, tmp_path / 'configs')
+        compiled.save(content, {'profile': {}}, {})
+        assert compiled.read(content) == ({'profile': {}}, {})
+
+        # Writable by others so could have been replaced
+        compiled.fpath.chmod(0o666)
+        assert compiled.read(content) is None
+
+        compiled.fpath.chmod(0o600)
+        with mock.patch.object(config.utils.os, 'getuid', return_value=os.getuid() + 1):
+            assert compiled.read(content) is None
+            # Another user's directory isn't written to
+            compiled.fpath.unlink()
+            compiled.save(content, {'profile': {}}, {})
+            assert not compiled.fpath.exists()
+
+    def test_group_profiles(self, tmp_path):
+        config_fpath = configs / 'nested-groups.yaml'
+        expected = {
+            'deep-space': ('ds9', 'voyager'),
+            'starfleet': ('tng', 'ds9', 'voyager'),
+            'federation': ('tng', 'ds9', 'voyager', 'sfa'),
+        }
+        assert config.load(config_fpath, tmp_path).group_profiles == expected
+
+        # Kept with the compiled config so it isn't computed again
+        with mock.patch.object(config.model, 'group_closure') as m_closure:
+            assert config.load(config_fpath, tmp_path).group_profiles == expected
+        m_closure.assert_not_called()
@@ -1,16 +1,21 @@
 from pathlib import Path
+import threading
+import time
 from unittest import mock
 
+import pytest
+
 from env_config import config, core
+from env_config.cache import SecretCache
 from env_config.libs.testing import patch_obj
 
 
 configs = Path(__file__).parent / 'configs'
 
 
-def load(fname) -> core.EnvConfig:
+def load(fname, **kwargs) -> core.EnvConfig:
     conf = config.load(configs / fname)
-    return core.EnvConfig(conf)
+    return core.EnvConfig(conf, **kwargs)
 
 
 class TestEnvConfig:
@@ -82,6 +87,51 @@ class TestEnvConfig:
                 'SISKO',
             }
 
+    def test_index(self):
+        ec = load('switch.yaml')
+        assert ec.index.profile_vars == {
+            'tng': ('PICARD', 'RIKER', 'DATA'),
+            'tng-movies': ('PICARD', 'RIKER', 'DATA', 'WORF'),
+            'ds9': ('SISKO',),
+        }
+        assert ec.index.var_profiles == {
+            'PICARD': ('tng', 'tng-movies'),
+            'RIKER': ('tng', 'tng-movies'),
+            'DATA': ('tng', 'tng-movies'),
+            'WORF': ('tng-movies',),
+            'SISKO': ('ds9',),
+        }
+        assert load('basics.yaml').index.group_profiles == {'starfleet': ('ds9', 'tng')}
+
+    def test_nested_groups(self):
+        ec = load('nested-groups.yaml')
+        assert ec.index.group_profiles == {
+            'deep-space': ('ds9', 'voyager'),
+            'starfleet': ('tng', 'ds9', 'voyager'),
+            'federation': ('tng', 'ds9', 'voyager', 'sfa'),
+        }
+        assert ec.select(['federation']) == {
+            'PICARD': 'captain',
+            'SISKO': 'captain',
+            'JANEWAY': 'captain',
+            'BOOTHBY': 'groundskeeper',
+        }
+
+    def test_group_cycle(self, tmp_path):
+        fpath = tmp_path / 'env-config.yaml'
+        fpath.write_text(
+            'profile:\n  tng:\n    PICARD: captain\ngroup:\n  a: [tng, b]\n  b: [c]\n  c: [a]\n',
+        )
+        # Checked when the config is loaded, not when a group is selected
+        with pytest.raises(core.UserError, match='Group includes itself: a -> b -> c -> a'):
+            config.load(fpath, tmp_path / 'compiled')
+        assert not list(tmp_path.joinpath('compiled').glob('*.msgpack'))
+
+    def test_selection_keeps_config_order(self):
+        ec = load('switch.yaml')
+        selected = ec.select_profiles(['ds9', 'tng-movies', 'tng'])
+        assert list(selected) == ['tng', 'tng-movies', 'ds9']
+
     @patch_obj(core.OPResolver, attribute='convert', return_value='foo secret')
     def test_resolve_1pass(self, m_convert):
         ec = load('1pass.yaml')
@@ -90,6 +140,240 @@ class TestEnvConfig:
             'RIKER': 'foo secret',
         }
 
+    @patch_obj(core.OPResolver, attribute='convert')
+    def test_resolve_concurrent_keeps_order(self, m_convert):
+        # Later values finish first but output order should match the config
+        delays = {
+            'op://starfleet/ds9/sisko': 0.03,
+            'op://bajor/ds9/kira': 0.02,
+            'op://trill/ds9/dax': 0,
+        }
+
+        def convert(uri):
+            time.sleep(delays[uri])
+            return uri.rsplit('/', 1)[-1]
+
+        m_convert.side_effect = convert
+
+        ec = load('1pass.yaml')
+        result = ec.resolve(['ds9'])
+        assert list(result.items()) == [
+            ('SISKO', 'sisko'),
+            ('KIRA', 'kira'),
+            ('ODO', 'changeling'),
+            ('DAX', 'dax'),
+        ]
+        assert m_convert.call_count == 3
+
+    @patch_obj(core.OPResolver, attribute='convert')
+    def test_resolve_concurrency_limit(self, m_convert):
+        lock = threading.Lock()
+        running = []
+        max_running = []
+
+        def convert(uri):
+            with lock:
+                running.append(uri)
+                max_running.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(uri)
+            return 'secret'
+
+        m_convert.side_effect = convert
+
+        load('1pass.yaml', concurrency=1).resolve(['ds9'])
+        assert max(max_running) == 1
+
+        max_running.clear()
+        load('1pass.yaml', concurrency=3).resolve(['ds9'])
+        assert max(max_running) > 1
+
+    @patch_obj(core.OPResolver, attribute='convert')
+    def test_resolve_timeout(self, m_convert):
+        # The deadline applies to calls made in the resolver threads
+        m_convert.side_effect = lambda uri: str(core.utils.call_timeout())
+
+        env_vars = load('1pass.yaml', timeout=5).resolve(['ds9'])
+        assert 0 < float(env_vars['SISKO']) <= 5
+        assert 0 < float(env_vars['DAX']) <= 5
+
+    @patch_obj(core.OPResolver, attribute='convert')
+    def test_resolve_reports_all_errors(self, m_convert):
+        def convert(uri):
+            if 'kira' in uri:
+                return 'kira'
+            raise RuntimeError(f'no access to {uri}')
+
+        m_convert.side_effect = convert
+
+        ec = load('1pass.yaml')
+        with pytest.raises(core.ResolveError) as info:
+            ec.resolve(['ds9'])
+
+        assert set(info.value.errors) == {'SISKO', 'DAX'}
+        assert str(info.value) == '\n'.join(
+            (
+                'Unable to resolve:',
+                '    SISKO: no access to op://starfleet/ds9/sisko',
+                '    DAX: no access to op://trill/ds9/dax',
+            ),
+        )
+
+    @patch_obj(core.OPResolver, attribute='convert')
+    @patch_obj(core.OPResolver, attribute='convert_batch')
+    def test_resolve_batch(self, m_convert_batch, m_convert):
+        m_convert_batch.side_effect = lambda uris: [uri.rsplit('/', 1)[-1] for uri in uris]
+        m_convert.side_effect = lambda uri: uri.rsplit('/', 1)[-1]
+
+        ec = load('1pass.yaml', batch=True)
+        assert ec.resolve(['voyager']) == {
+            'JANEWAY': 'janeway',
+            'KIM': 'kim',
+            'CHAKOTAY': 'chakotay',
+            'NEELIX': 'talaxian',
+            'SEVEN': 'seven',
+            'PARIS': 'paris',
+        }
+
+        # One batch per account
+        batched = sorted(call.args[0] for call in m_convert_batch.mock_calls)
+        assert batched == [
+            ['op://private/voyager/kim', 'op://private/voyager/paris'],
+            ['op://starfleet/private/voyager/janeway', 'op://starfleet/private/voyager/chakotay'],
+        ]
+        # Batches of one don't need to be batched
+        m_convert.assert_called_once_with('op://borg/collective/voyager/seven')
+
+    @patch_obj(core.OPResolver, attribute='convert')
+    @patch_obj(core.OPResolver, attribute='convert_batch')
+    def test_resolve_batch_failure_reports_each(self, m_convert_batch, m_convert):
+        m_convert_batch.side_effect = RuntimeError('op inject failed')
+
+        def convert(uri):
+            if uri.endswith('paris'):
+                raise RuntimeError('no access')
+            return uri.rsplit('/', 1)[-1]
+
+        m_convert.side_effect = convert
+
+        ec = load('1pass.yaml', batch=True)
+        with pytest.raises(core.ResolveError) as info:
+            ec.resolve(['voyager'])
+
+        assert list(info.value.errors) == ['PARIS']
+        # Every value in a failed batch gets resolved individually
+        assert m_convert.call_count == 5
+
+    @patch_obj(core.OPResolver, attribute='convert')
+    def test_resolve_cached(self, m_convert, tmp_path):
+        m_convert.side_effect = lambda uri: uri.rsplit('/', 1)[-1]
+        cache = SecretCache(tmp_path)
+
+        expected = {'SISKO': 'sisko', 'KIRA': 'kira', 'ODO': 'changeling', 'DAX': 'dax'}
+        assert load('1pass.yaml', cache=cache).resolve(['ds9']) == expected
+        assert m_convert.call_count == 3
+
+        # Second time comes from the cache
+        assert load('1pass.yaml', cache=cache).resolve(['ds9']) == expected
+        assert m_convert.call_count == 3
+
+        # Unless refreshing
+        cache.refresh = True
+        assert load('1pass.yaml', cache=cache).resolve(['ds9']) == expected
+        assert m_convert.call_count == 6
+
+    @patch_obj(core.OPResolver, attribute='convert')
+    @patch_obj(core.OPResolver, attribute='convert_group')
+    def test_resolve_grouped_by_item(self, m_convert_group, m_convert):
+        m_convert_group.side_effect = lambda uris: [uri.rsplit('/', 1)[-1] for uri in uris]
+        m_convert.side_effect = lambda uri: uri.rsplit('/', 1)[-1]
+
+        ec = load('1pass.yaml')
+        assert ec.resolve(['voyager']) == {
+            'JANEWAY': 'janeway',
+            'KIM': 'kim',
+            'CHAKOTAY': 'chakotay',
+            'NEELIX': 'talaxian',
+            'SEVEN': 'seven',
+            'PARIS': 'paris',
+        }
+
+        # One group per account, vault, and item
+        grouped = sorted(call.args[0] for call in m_convert_group.mock_calls)
+        assert grouped == [
+            ['op://private/voyager/kim', 'op://private/voyager/paris'],
+            ['op://starfleet/private/voyager/janeway', 'op://starfleet/private/voyager/chakotay'],
+        ]
+        m_convert.assert_called_once_with('op://borg/collective/voyager/seven')
+
+    @patch_obj(core.OPResolver, attribute='convert')
+    @patch_obj(core.OPResolver, attribute='convert_group')
+    def test_resolve_cache_ttls(self, m_convert_group, m_convert, tmp_path):
+        m_convert_group.side_effect = lambda uris: ['secret'] * len(uris)
+        m_convert.return_value = 'secret'
+        cache = SecretCache(tmp_path)
+
+        # Voyager profile is configured to not be cached
+        ec = load('1pass.yaml', cache=cache)
+        assert ec.cache_ttls(['voyager'])['KIM'] == 0
+        assert ec.cache_ttls(['ds9'])['KIRA'] == 60
+        ec.resolve(['voyager'])
+        assert cache.store.clear() == 0
+
+        # Command line TTL overrides the config's default but not profile specific TTLs
+        ec = load('1pass.yaml', cache=cache, cache_ttl=0)
+        assert ec.cache_ttls(['ds9'])['KIRA'] == 0
+        assert ec.cache_ttls(['voyager'])['KIM'] == 0
+        ec.resolve(['ds9'])
+        assert cache.store.clear() == 0
+
+
+class TestShellEnvConfig:
+    def test_switch_plan(self):
+        ec = core.BashEnvConfig(config.load(configs / 'switch.yaml'))
+        env = {
+            '_ENV_CONFIG_PROFILES': 'tng ds9',
+            'PICARD': 'captain',
+            'RIKER': 'number1',
+            'SISKO': 'captain',
+        }
+        with mock.patch.dict(core.environ, env):
+            assert ec.switch_plan(['tng-movies']) == (
+                ['SISKO'],
+                # RIKER's value changed, DATA isn't present, WORF is new
+                ['RIKER', 'DATA', 'WORF'],
+                ['PICARD'],
+            )
+
+    def test_switch_plan_nothing_active(self):
+        ec = core.BashEnvConfig(config.load(configs / 'switch.yaml'))
+        with mock.patch.dict(core.environ, {'SISKO': 'captain'}):
+            assert ec.switch_plan(['ds9']) == ([], ['SISKO'], [])
+
+    @patch_obj(core.OPResolver, attribute='convert')
+    def test_switch_only_resolves_changes(self, m_convert, capsys):
+        m_convert.side_effect = lambda uri: uri.rsplit('/', 1)[-1]
+        ec = core.BashEnvConfig(config.load(configs / 'switch.yaml'))
+        env = {
+            '_ENV_CONFIG_PROFILES': 'tng',
+            'PICARD': 'captain',
+            'RIKER': 'number1',
+            'DATA': 'data',
+            'SISKO': 'captain',
+        }
+        with mock.patch.dict(core.environ, env):
+            ec.switch(['tng-movies'])
+
+        assert capsys.readouterr().out.splitlines() == [
+            '# BASH SOURCE',
+            'unset SISKO',
+            'export _ENV_CONFIG_PROFILES=tng-movies',
+            'export RIKER=captain',
+            'export WORF=worf',
+        ]
+        m_convert.assert_called_once_with('op://starfleet/crew/worf')
+
 
 class TestOPResolver:
     @patch_obj(core.utils, 'op_read', return_value='Q')
@@ -97,3 +381,112 @@ class TestOPResolver:
         assert core.OPResolver.convert('op://Private/god-like-misanthrope') == 'Q'
 
         m_op_read.assert_called_once_with('op://Private/god-like-misanthrope')
+
+    @patch_obj(core.utils, 'op_inject', return_value=['Q', 'Quinn'])
+    def test_convert_batch(self, m_op_inject):
+        uris = ['op://continuum/Private/q/name', 'op://continuum/Private/quinn/name']
+        assert core.OPResolver.convert_batch(uris) == ['Q', 'Quinn']
+
+        m_op_inject.assert_called_once_with(
+            ['op://private/q/name', 'op://private/quinn/name'],
+            'continuum',
+        )
+
+    def test_group_key(self):
+        key = core.OPResolver.group_key
+        assert key('op://Private/Voyager/kim') == key('op://private/voyager/paris?attribute=otp')
+        assert key('op://starfleet/private/voyager/janeway') == ('starfleet', 'private', 'voyager')
+        assert key('op://private/voyager/kim') != key('op://private/defiant/sisko')
+        assert key('op://private/voyager') is None
+
+
+class BorgResolver(core.Resolver):
+    scheme = 'borg://'
+
+    @staticmethod
+    def convert(uri: str) -> str:
+        return uri.removeprefix('borg://').upper()
+
+
+class TestResolverRegistry:
+    def test_scheme(self):
+        refs = {**core.BUILTIN_RESOLVERS, 'git+ssh': f'{__name__}:BorgResolver'}
+        scheme = core.ResolverRegistry(refs, entry_points=False).scheme
+        assert scheme('op://private/voyager/kim') == 'op'
+        assert scheme('op://') == 'op'
+        assert scheme('git+ssh://host/repo') == 'git+ssh'
+        assert scheme('captain') is None
+        assert scheme('see http://example.com') is None
+        assert scheme(1701) is None
+
+        # Only schemes with a resolver are references, others are literal values
+        assert scheme('https://example.com') is None
+        assert scheme('borg://seven') is None
+
+    def test_builtins(self):
+        registry = core.ResolverRegistry(entry_points=False)
+        assert registry.find('op://private/voyager/kim') is core.OPResolver
+        assert registry.find('captain') is None
+        assert registry.find('https://example.com') is None
+
+    @patch_obj(core.importlib, 'import_module')
+    def test_lazy_import(self, m_import_module):
+        m_import_module.return_value.FileResolver = type('FileResolver', (core.Resolver,), {})
+        registry = core.ResolverRegistry(entry_points=False)
+
+        registry.find('captain')
+        registry.find('https://example.com')
+        assert not m_import_module.called
+
+        registry.find('file:///etc/hostname')
+        registry.find('file:///etc/hosts')
+        m_import_module.assert_called_once_with('env_config.resolvers')
+
+    def test_entry_points(self, tmp_path):
+        entry_point = mock.Mock(value=f'{__name__}:BorgResolver')
+        # `name` is special for mocks
+        entry_point.name = 'borg'
+
+        registry = core.ResolverRegistry(plugins_fpath=tmp_path / 'resolvers' / 'eps.json')
+        with mock.patch('importlib.metadata.entry_points', return_value=[entry_point]) as m_eps:
+            assert registry.find('op://private/voyager/kim') is core.OPResolver
+            assert not m_eps.called
+
+            assert registry.find('borg://seven') is BorgResolver
+            assert registry.find('https://example.com') is None
+            m_eps.assert_called_once_with(group=core.RESOLVERS_ENTRY_POINT)
+
+    def test_entry_points_cached(self, tmp_path):
+        fpath = tmp_path / 'resolvers' / 'eps.json'
+        refs = {'borg': f'{__name__}:BorgResolver'}
+
+        with patch_obj(core.ResolverRegistry, 'plugin_refs_scan', return_value=refs) as m_scan:
+            registry = core.ResolverRegistry(plugins_fpath=fpath)
+            assert registry.find('https://example.com') is None
+            assert registry.find('borg://seven') is BorgResolver
+
+            # Other processes use what was found
+            registry = core.ResolverRegistry(plugins_fpath=fpath)
+            assert registry.find('borg://seven') is BorgResolver
+            assert m_scan.call_count == 1
+
+            # Until packages change
+            key = [*core.ResolverRegistry.packages_key(), 'new-package']
+            with patch_obj(core.ResolverRegistry, 'packages_key', return_value=key):
+                assert core.ResolverRegistry(plugins_fpath=fpath).find('borg://seven')
+            assert m_scan.call_count == 2
+
+            # Only trusted when private to the user
+            fpath.chmod(0o666)
+            assert core.ResolverRegistry(plugins_fpath=fpath).find('borg://seven')
+            assert m_scan.call_count == 3
+
+    def test_invalid(self):
+        registry = core.ResolverRegistry(
+            {'q': f'{__name__}:TestResolverRegistry', 'x': 'env_config.nope:Resolver'},
+            entry_points=False,
+        )
+        with pytest.raises(core.UserError, match='not a Resolver subclass'):
+            registry.find('q://continuum')
+        with pytest.raises(core.UserError, match=r'Unable to load the resolver for x://'):
+            registry.find('x://files')
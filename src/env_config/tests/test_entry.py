@@ -0,0 +1,161 @@
+from os import environ
+from pathlib import Path
+import subprocess
+import sys
+import time
+from unittest import mock
+
+import pytest
+
+from env_config import aws, hook, utils
+
+
+configs = Path(__file__).parent / 'configs'
+
+# What the cached credentials path can add to a bare interpreter.  The target is 50ms, with some
+# headroom so a busy CI machine doesn't flake.  The wall clock also includes reading the cache and
+# process exit.
+IMPORT_BUDGET_MS = 60
+WALL_BUDGET_MS = 75
+
+HEAVY_MODULES = ('boto3', 'botocore', 'click', 'dynamic_yaml', 'furl', 'serde', 'yaml')
+# Imported by the commands that need them, not on the cached credentials path
+LAZY_MODULES = ('logging', 'socket', 'subprocess', 'tempfile', 'uuid')
+
+AWS_CACHE_HIT = """
+import sys
+from env_config.entry import env_config_aws
+
+sys.argv = ['env-config-aws', 'starfleet']
+env_config_aws()
+"""
+
+HOOK_UNCHANGED = """
+import sys
+from env_config.entry import env_config
+
+sys.argv = ['env-config', 'hook']
+env_config()
+"""
+
+
+def run_py(code: str, env: dict, *py_args) -> tuple[subprocess.CompletedProcess, float]:
+    start = time.perf_counter()
+    result = subprocess.run(
+        (sys.executable, *py_args, '-c', code),
+        # Installed packages are compiled so time them with bytecode, written by the first run
+        env=environ | env | {'PYTHONDONTWRITEBYTECODE': ''},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result, (time.perf_counter() - start) * 1000
+
+
+def imported_modules(importtime_stderr: str) -> dict[str, int]:
+    """Parse -X importtime output into module name to cumulative import time in microseconds"""
+    modules = {}
+    for line in importtime_stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.removeprefix('import time:').split('|')
+        modules[name.strip()] = int(cumulative)
+    return modules
+
+
+def import_ms(importtime_stderr: str) -> float:
+    """Total time spent importing, from -X importtime output"""
+    total = 0
+    for line in importtime_stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.removeprefix('import time:').split('|')
+        # Nested imports are indented and already included in their parent's cumulative time
+        if not name.startswith('  '):
+            total += int(cumulative)
+    return total / 1000
+
+
+class TestEnvConfigAWS:
+    @pytest.fixture
+    def cache_hit_env(self, tmp_path: Path):
+        """Environment for a subprocess whose cached credentials are valid"""
+        aws_config_fpath = configs / 'aws-config'
+        config = aws.profile_config('starfleet', config_fpath=aws_config_fpath)
+
+        # utils.TMP_DPATH is based on the OS temp dir
+        cache_dpath = tmp_path / 'env-config'
+        cache_dpath.mkdir()
+        creds = aws.SessCreds('key-id', 'sec-key', 'sess-token', utils.utc_now_in(minutes=30))
+        enc_tmp = aws.sess_creds_cache(config.op_ref_base, config.mfa_serial, cache_dpath)
+        enc_tmp.save(creds.to_msgpack(), creds.expiration.timestamp())
+
+        return {'TMPDIR': str(tmp_path), 'AWS_CONFIG_FILE': str(aws_config_fpath)}
+
+    def test_cache_hit_output(self, cache_hit_env):
+        result, _ = run_py(AWS_CACHE_HIT, cache_hit_env)
+        assert result.stdout.startswith('{"Version": 1, "AccessKeyId": "key-id"')
+
+    def test_cache_hit_timings(self, cache_hit_env):
+        result, _ = run_py(AWS_CACHE_HIT, cache_hit_env | {'ENV_CONFIG_TIMINGS': '1'})
+        assert result.stdout.startswith('{"Version": 1')
+        assert result.stderr.startswith('Timings:\n')
+        assert 'EncryptedTempFile.read' in result.stderr
+
+    def test_cache_hit_imports(self, cache_hit_env):
+        # Best of a few runs to reduce noise, the first also compiles
+        baseline = min(
+            import_ms(run_py('pass', cache_hit_env, '-X', 'importtime')[0].stderr) for _ in range(3)
+        )
+        results = [run_py(AWS_CACHE_HIT, cache_hit_env, '-X', 'importtime')[0] for _ in range(3)]
+        modules = imported_modules(results[-1].stderr)
+
+        assert 'env_config.entry' in modules
+        assert not [name for name in modules if name.split('.')[0] in HEAVY_MODULES]
+        assert not [name for name in modules if name.split('.')[0] in LAZY_MODULES]
+        assert 'env_config.cli' not in modules
+
+        assert min(import_ms(result.stderr) for result in results) - baseline < IMPORT_BUDGET_MS
+
+    def test_cache_hit_wall_clock(self, cache_hit_env):
+        # Best of a few runs to reduce noise.  Compare against a bare interpreter so the budget
+        # is only what env-config-aws adds.
+        baseline = min(run_py('pass', cache_hit_env)[1] for _ in range(3))
+        hit_path = min(run_py(AWS_CACHE_HIT, cache_hit_env)[1] for _ in range(3))
+
+        assert hit_path - baseline < WALL_BUDGET_MS
+
+
+class TestEnvConfigHook:
+    @pytest.fixture
+    def unchanged_env(self, tmp_path: Path) -> dict:
+        """Environment for a subprocess whose directory's hook profiles are already active"""
+        env = {'TMPDIR': str(tmp_path / 'tmp')}
+        project = tmp_path / 'enterprise'
+        project.mkdir()
+        project.joinpath('env-config.yaml').write_text('hook:\n  profiles: [tng]\n')
+
+        with mock.patch.dict(environ, env):
+            config_fpath, stamps = hook.find(str(project))
+            hook.save_cache(str(project), config_fpath, ['tng'], stamps)
+
+        return env | {'PWD': str(project), hook.ENVVAR: config_fpath}
+
+    def test_unchanged_imports(self, unchanged_env):
+        result, _ = run_py(
+            f'import os; os.chdir({unchanged_env["PWD"]!r})\n{HOOK_UNCHANGED}',
+            unchanged_env,
+            '-X',
+            'importtime',
+        )
+        assert result.stdout == ''
+        modules = imported_modules(result.stderr)
+
+        assert 'env_config.hook' in modules
+        env_config_modules = {name for name in modules if name.startswith('env_config')}
+        assert env_config_modules == {
+            'env_config',
+            'env_config.entry',
+            'env_config.hook',
+            'env_config.timings',
+        }
@@ -0,0 +1,109 @@
+import os
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+from env_config import hook
+
+
+@pytest.fixture
+def project(tmp_path: Path, monkeypatch) -> Path:
+    monkeypatch.setenv('TMPDIR', str(tmp_path / 'tmp'))
+    project = tmp_path / 'enterprise'
+    project.joinpath('engineering', 'warp-core').mkdir(parents=True)
+    project.joinpath('env-config.yaml').write_text('hook:\n  profiles: [tng]\n')
+    return project
+
+
+class TestHook:
+    def test_find(self, project: Path):
+        warp_core = project / 'engineering' / 'warp-core'
+        config_fpath, stamps = hook.find(str(warp_core))
+
+        assert config_fpath == str(project / 'env-config.yaml')
+        assert list(stamps) == [
+            str(warp_core),
+            str(project / 'engineering'),
+            str(project),
+            config_fpath,
+        ]
+
+    def test_find_none(self, tmp_path: Path):
+        config_fpath, stamps = hook.find(str(tmp_path))
+        assert config_fpath == ''
+        # All the way up, not including the root
+        assert len(stamps) == len(tmp_path.parts) - 1
+
+    def test_cache(self, project: Path):
+        dpath = str(project / 'engineering')
+        assert hook.read_cache(dpath) is None
+
+        config_fpath, stamps = hook.find(dpath)
+        hook.save_cache(dpath, config_fpath, ['tng', 'ds9'], stamps)
+        assert hook.read_cache(dpath) == (config_fpath, ['tng', 'ds9'])
+
+        # A config closer to the directory makes the cached lookup stale
+        project.joinpath('engineering', 'env-config.yaml').write_text('')
+        assert hook.read_cache(dpath) is None
+
+    def test_cache_config_changed(self, project: Path):
+        dpath = str(project)
+        config_fpath, stamps = hook.find(dpath)
+        hook.save_cache(dpath, config_fpath, ['tng'], stamps)
+
+        project.joinpath('env-config.yaml').write_text('hook:\n  profiles: [tng, ds9]\n')
+        assert hook.read_cache(dpath) is None
+
+    def test_cache_private(self, project: Path):
+        dpath = str(project)
+        config_fpath, stamps = hook.find(dpath)
+        hook.save_cache(dpath, config_fpath, ['tng'], stamps)
+        fpath = Path(hook.cache_fpath(dpath))
+        assert fpath.parent.name == f'hook-{os.getuid()}'
+        assert fpath.parent.stat().st_mode & 0o777 == 0o700
+        assert fpath.stat().st_mode & 0o777 == 0o600
+        assert hook.read_cache(dpath)
+
+        # Could have been written by someone else
+        fpath.chmod(0o666)
+        assert hook.read_cache(dpath) is None
+        fpath.chmod(0o600)
+        fpath.parent.chmod(0o777)
+        assert hook.read_cache(dpath) is None
+        fpath.parent.chmod(0o700)
+        assert hook.read_cache(dpath)
+
+        with mock.patch.object(hook.os, 'getuid', return_value=os.getuid() + 1):
+            assert not hook.is_private(fpath.stat())
+
+    def test_cache_stamps_required(self, project: Path):
+        dpath = str(project)
+        config_fpath, stamps = hook.find(dpath)
+
+        hook.save_cache(dpath, config_fpath, ['tng'], {})
+        assert hook.read_cache(dpath) is None
+
+        # The config found has to be stamped
+        hook.save_cache(dpath, config_fpath, ['tng'], {dpath: stamps[dpath]})
+        assert hook.read_cache(dpath) is None
+
+        hook.save_cache(dpath, config_fpath, ['tng'], stamps)
+        assert hook.read_cache(dpath) == (config_fpath, ['tng'])
+
+    def test_unchanged(self, project: Path, monkeypatch):
+        monkeypatch.chdir(project / 'engineering')
+        assert not hook.unchanged()
+
+        config_fpath, stamps = hook.find(str(Path.cwd()))
+        hook.save_cache(str(Path.cwd()), config_fpath, ['tng'], stamps)
+        assert not hook.unchanged()
+
+        with mock.patch.dict(os.environ, {hook.ENVVAR: config_fpath}):
+            assert hook.unchanged()
+
+        # No hook profiles, nothing to do unless the hook activated something before
+        hook.save_cache(str(Path.cwd()), config_fpath, [], stamps)
+        assert hook.unchanged()
+        with mock.patch.dict(os.environ, {hook.ENVVAR: config_fpath}):
+            assert not hook.unchanged()
@@ -0,0 +1,120 @@
+from unittest import mock
+
+import pytest
+
+from env_config import core, model
+
+
+def build(**data) -> model.Config:
+    return model.Config.build(data)
+
+
+class TestConfig:
+    def test_build(self):
+        conf = build(
+            var={'vault': 'private'},
+            profile={'tng': {'PICARD': 'captain', 'RIKER': '{var.vault}/riker'}, 'empty': None},
+            group={'fleet': ['tng']},
+            env={'ignored': True},
+        )
+
+        assert conf.profiles['tng'] == model.Profile(
+            'tng',
+            {'PICARD': 'captain', 'RIKER': model.Template('{var.vault}/riker')},
+        )
+        assert conf.profiles['empty'] == model.Profile('empty', {})
+        assert conf.groups == {'fleet': model.Group('fleet', ('tng',))}
+        assert 'env' not in conf.data
+
+    def test_group_profiles(self):
+        conf = build(
+            profile={'tng': {}, 'ds9': {}},
+            group={'a': ['tng', 'b'], 'b': ['ds9'], 'c': None},
+        )
+        assert conf.group_profiles == {'a': ('tng', 'ds9'), 'b': ('ds9',), 'c': ()}
+
+        # E.g. from the compiled config
+        conf = model.Config.build({'group': {'a': ['tng']}}, {'a': ['tng']})
+        assert conf.group_profiles == {'a': ('tng',)}
+
+        with pytest.raises(model.GroupCycleError, match='Group includes itself: a -> b -> a'):
+            build(group={'a': ['b'], 'b': ['a']})
+
+    def test_build_empty(self):
+        conf = build()
+        assert conf.profiles == {}
+        assert conf.groups == {}
+        assert conf.view().profile == {}
+
+    def test_compile_data(self):
+        data = {'a': ['{b}', 'c', {'d': 'e{f}g'}], 'h': 1, 'i': '{', 'j': 'k}'}
+        assert model.compile_data(data) == {
+            'a': [model.Template('{b}'), 'c', {'d': model.Template('e{f}g')}],
+            'h': 1,
+            'i': '{',
+            'j': 'k}',
+        }
+
+
+class TestSection:
+    def test_render(self):
+        conf = build(
+            var={'vault': 'private', 'item': '{var.vault}/item'},
+            profile={'tng': {'PICARD': '{var.item}/picard', 'RIKER': '{env.SHIP}', 'DATA': 1}},
+            hook={'profiles': ['{var.vault}']},
+        )
+        values = conf.view({'SHIP': 'enterprise'})
+
+        assert values.profile.tng.PICARD == 'private/item/picard'
+        assert values['profile']['tng']['RIKER'] == 'enterprise'
+        assert values.profile.tng.DATA == 1
+        assert values.hook.profiles == ['private']
+        assert values.profile.tng == {
+            'PICARD': 'private/item/picard',
+            'RIKER': 'enterprise',
+            'DATA': 1,
+        }
+
+    def test_rendered_once(self):
+        conf = build(profile={'tng': {'RIKER': '{env.SHIP}'}})
+        env = {'SHIP': 'enterprise'}
+        values = conf.view(env)
+
+        assert values.profile.tng.RIKER == 'enterprise'
+        env['SHIP'] = 'titan'
+        assert values.profile.tng.RIKER == 'enterprise'
+
+        # A new view renders with the environment at that time
+        assert conf.view(env).profile.tng.RIKER == 'titan'
+
+    def test_current_environment(self):
+        conf = build(profile={'tng': {'RIKER': '{env.SHIP}'}})
+
+        with mock.patch.dict(model.environ, {'SHIP': 'enterprise'}):
+            assert conf.view().profile.tng.RIKER == 'enterprise'
+
+    def test_only_accessed_rendered(self):
+        conf = build(profile={'tng': {'PICARD': 'captain'}, 'ds9': {'SISKO': '{env.MISSING}'}})
+        envconf = core.EnvConfig(conf, env={})
+
+        assert envconf.select(['tng']) == {'PICARD': 'captain'}
+        with pytest.raises(AttributeError):
+            envconf.select(['ds9'])
+
+    def test_missing(self):
+        values = build(var={'vault': 'private'}).view({})
+
+        with pytest.raises(KeyError):
+            values.var['item']
+        assert getattr(values.var, 'item', None) is None
+        assert getattr(values.env, 'HOME', None) is None
+
+    def test_read_only(self):
+        values = build(var={'vault': 'private'}).view({})
+
+        with pytest.raises(AttributeError, match='Section is read-only'):
+            values.var.vault = 'public'
+        with pytest.raises(TypeError):
+            values.var['vault'] = 'public'
+        with pytest.raises(AttributeError, match='Env is read-only'):
+            values.env.HOME = '/'
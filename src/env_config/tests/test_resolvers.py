@@ -0,0 +1,91 @@
+from os import environ
+from pathlib import Path
+import subprocess
+from unittest import mock
+
+import pytest
+
+from env_config import config, core, resolvers, utils
+from env_config.cache import SecretCache
+
+
+configs = Path(__file__).parent / 'configs'
+
+
+class TestFileResolver:
+    def test_convert(self, tmp_path: Path):
+        fpath = tmp_path / 'captain.txt'
+        fpath.write_text('picard\n')
+        assert resolvers.FileResolver.convert(f'file://{fpath}') == 'picard'
+
+    def test_missing(self, tmp_path: Path):
+        with pytest.raises(FileNotFoundError):
+            resolvers.FileResolver.convert(f'file://{tmp_path}/nope.txt')
+
+    def test_caller_cwd(self, tmp_path: Path):
+        tmp_path.joinpath('captain.txt').write_text('picard\n')
+        with utils.for_caller(cwd=str(tmp_path)):
+            assert resolvers.FileResolver.convert('file://captain.txt') == 'picard'
+
+
+class TestEnvResolver:
+    @mock.patch.dict(environ, {'ENTERPRISE_CAPTAIN': 'picard'})
+    def test_convert(self):
+        assert resolvers.EnvResolver.convert('env://ENTERPRISE_CAPTAIN') == 'picard'
+
+    def test_missing(self):
+        with pytest.raises(LookupError, match='Environment variable not set: ENTERPRISE_NOPE'):
+            resolvers.EnvResolver.convert('env://ENTERPRISE_NOPE')
+
+    @mock.patch.dict(environ, {'ENTERPRISE_CAPTAIN': 'picard'})
+    def test_caller_env(self):
+        with utils.for_caller(env={'ENTERPRISE_CAPTAIN': 'kirk'}):
+            assert resolvers.EnvResolver.convert('env://ENTERPRISE_CAPTAIN') == 'kirk'
+
+        with utils.for_caller(env={}), pytest.raises(LookupError):
+            resolvers.EnvResolver.convert('env://ENTERPRISE_CAPTAIN')
+
+
+class TestCmdResolver:
+    def test_convert(self):
+        assert resolvers.CmdResolver.convert('cmd://printf "%s\\n" picard | tr p P') == 'Picard'
+
+    def test_failure(self):
+        with pytest.raises(subprocess.CalledProcessError):
+            resolvers.CmdResolver.convert('cmd://exit 3')
+
+    @mock.patch.dict(environ, {'ENTERPRISE_SHIP': 'ncc-1701-d'})
+    def test_caller(self, tmp_path: Path):
+        with utils.for_caller(env={'ENTERPRISE_CAPTAIN': 'kirk'}, cwd=str(tmp_path)):
+            output = resolvers.CmdResolver.convert(
+                'cmd://echo "$ENTERPRISE_CAPTAIN ${ENTERPRISE_SHIP:-none} $PWD"',
+            )
+        assert output == f'kirk none {tmp_path}'
+
+
+class TestResolve:
+    def test_config(self, tmp_path: Path):
+        tmp_path.joinpath('captain.txt').write_text('picard\n')
+        env = {'ENTERPRISE_DPATH': str(tmp_path), 'ENTERPRISE_FIRST_OFFICER': 'riker'}
+
+        with mock.patch.dict(environ, env):
+            ec = core.EnvConfig(config.load(configs / 'resolvers.yaml'))
+            assert ec.resolve(['enterprise']) == {
+                'PICARD': 'picard',
+                'RIKER': 'riker',
+                'DATA': 'android',
+                # No resolver for https://, left as is
+                'LCARS': 'https://lcars.starfleet.example/',
+            }
+
+    @mock.patch.dict(environ, {'ENTERPRISE_FIRST_OFFICER': 'riker'})
+    def test_not_cached(self, tmp_path: Path):
+        fpath = tmp_path / 'env-config.yaml'
+        fpath.write_text('profile:\n  tng:\n    RIKER: env://ENTERPRISE_FIRST_OFFICER\n')
+        cache = SecretCache(tmp_path / 'cache')
+        ec = core.EnvConfig(config.load(fpath, tmp_path), cache=cache, cache_ttl=60)
+        assert ec.resolve(['tng']) == {'RIKER': 'riker'}
+
+        with mock.patch.dict(environ, {'ENTERPRISE_FIRST_OFFICER': 'shelby'}):
+            assert ec.resolve(['tng']) == {'RIKER': 'shelby'}
+        assert cache.store.clear() == 0
@@ -55,6 +55,30 @@ class TestBash:
         bash.expect('\r\n')
         assert bash.before == ''
 
+    def test_hook(self, bash: pexpect.spawn, tmp_path):
+        project = tmp_path / 'enterprise'
+        project.mkdir()
+        project.joinpath('env-config.yaml').write_text(
+            'profile:\n  tng:\n    PICARD: captain\nhook:\n  profiles: [tng]\n',
+        )
+
+        bash.sendline(f"export TMPDIR='{tmp_path}' XDG_DATA_HOME='{tmp_path / 'data'}'")
+        bash.sendline('ENV_CONFIG_HOOK=1; eval "$(env-config-shell bash)"')
+        bash.sendline('cd enterprise')
+        bash.expect('env-config hook: .*env-config.yaml is not allowed')
+
+        bash.sendline('env-config hook allow')
+        bash.expect('env-config hook: profiles active: tng')
+        bash.sendline('echo $PICARD')
+        bash.expect('captain')
+
+        bash.sendline('cd ..')
+        bash.expect('env-config hook: cleared profiles for .*env-config.yaml\r\n')
+        # Output should be blank
+        bash.sendline('echo $PICARD')
+        bash.expect('\r\n')
+        assert bash.before == ''
+
 
 @pytest.mark.skipif(not fish_installed, reason='fish shell is not installed')
 class TestFish:
@@ -0,0 +1,63 @@
+import io
+from unittest import mock
+
+import pytest
+
+from env_config import timings
+
+
+@pytest.fixture
+def enabled():
+    with (
+        mock.patch.object(timings, 'enabled', True),
+        mock.patch.object(timings, 'recorded', {}),
+    ):
+        yield
+
+
+class TestTimings:
+    @mock.patch.object(timings, 'enabled', False)
+    def test_disabled(self):
+        with mock.patch.object(timings, 'recorded', {}):
+            assert timings.span('config.load') is timings.NULL_SPAN
+            with timings.span('config.load'):
+                pass
+            assert timings.recorded == {}
+
+    def test_spans(self, enabled):
+        with timings.span('config.load'):
+            pass
+        for _ in range(3):
+            with timings.span('OPResolver SISKO'):
+                pass
+
+        assert list(timings.recorded) == ['config.load', 'OPResolver SISKO']
+        assert len(timings.recorded['OPResolver SISKO']) == 3
+
+    def test_span_records_on_error(self, enabled):
+        with pytest.raises(RuntimeError), timings.span('sts_session'):
+            raise RuntimeError('STS is down')
+
+        assert len(timings.recorded['sts_session']) == 1
+
+    def test_report(self, enabled):
+        timings.record('config.load', 0.0123)
+        timings.record('OPResolver SISKO', 0.5)
+        timings.record('OPResolver SISKO', 0.25)
+
+        out = io.StringIO()
+        timings.report(out)
+        assert out.getvalue() == (
+            'Timings:\n'
+            '    config.load            12.3ms\n'
+            '    OPResolver SISKO      750.0ms  (2 calls, max 500.0ms)\n'
+        )
+
+    @mock.patch.object(timings, 'enabled', False)
+    @mock.patch.object(timings.atexit, 'register')
+    def test_enable(self, m_register):
+        timings.enable()
+        timings.enable()
+
+        assert timings.enabled
+        m_register.assert_called_once_with(timings.report)
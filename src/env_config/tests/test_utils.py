@@ -1,3 +1,17 @@
+import base64
+import json
+import logging
+import os
+import re
+import subprocess
+import threading
+import time
+from unittest import mock
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet
+import pytest
+
 from env_config import utils
 from env_config.libs.testing import patch_obj
 
@@ -13,6 +27,7 @@ class TestOPRead:
             '-n',
             'op://private/runabout/phasers',
             capture=True,
+            timeout=utils.CALL_TIMEOUT,
         )
 
     @patch_obj(utils, 'sub_run')
@@ -27,6 +42,7 @@ class TestOPRead:
             '-n',
             'op://private/runabout/phasers',
             capture=True,
+            timeout=utils.CALL_TIMEOUT,
         )
 
     @patch_obj(utils, 'sub_run')
@@ -41,4 +57,580 @@ class TestOPRead:
             '-n',
             'op://private/run about/phasers',
             capture=True,
+            timeout=utils.CALL_TIMEOUT,
+        )
+
+
+class TestOPRefParse:
+    def test_standard(self):
+        assert utils.op_ref_parse('op://private/runabout/phasers') == (
+            None,
+            'op://private/runabout/phasers',
+        )
+
+    def test_extended(self):
+        assert utils.op_ref_parse('op://starfleet/private/run about/phasers?attribute=otp') == (
+            'starfleet',
+            'op://private/run about/phasers?attribute=otp',
+        )
+
+
+class TestOPInject:
+    @staticmethod
+    def fake_inject(*args, input, **kwargs):  # noqa: A002
+        # Replace each template reference with its last path segment, like op would with a value
+        result = mock.Mock()
+        result.stdout = re.sub(r'\{\{ op://[^}]*/(\w+) \}\}', r'\1\n2nd line', input)
+        return result
+
+    @patch_obj(utils, 'sub_run')
+    def test_values_split_in_order(self, m_sub_run):
+        m_sub_run.side_effect = self.fake_inject
+        uris = ['op://private/runabout/phasers', 'op://private/runabout/shields']
+        assert utils.op_inject(uris, 'starfleet') == ['phasers\n2nd line', 'shields\n2nd line']
+
+        args = m_sub_run.call_args.args
+        assert args == ('op', '--account', 'starfleet', 'inject')
+
+    @patch_obj(utils, 'sub_run')
+    def test_value_count_mismatch(self, m_sub_run):
+        m_sub_run.return_value.stdout = 'garbage'
+        with pytest.raises(ValueError, match='op inject returned 1 values for 2 references'):
+            utils.op_inject(['op://private/a/b', 'op://private/a/c'])
+
+
+def op_error(stderr: str) -> subprocess.CalledProcessError:
+    return subprocess.CalledProcessError(1, 'op', stderr=stderr)
+
+
+class TestOPRun:
+    @patch_obj(utils.time, 'sleep')
+    @patch_obj(utils, 'sub_run')
+    def test_retry_throttled(self, m_sub_run, m_sleep):
+        m_sub_run.side_effect = [
+            op_error('[ERROR] (429) Too Many Requests'),
+            op_error('[ERROR] (503) Service Unavailable'),
+            mock.Mock(stdout='ds9'),
+        ]
+        with utils.call_limits(concurrency=8):
+            assert utils.op_run('read', 'op://private/runabout/phasers').stdout == 'ds9'
+            # Throttling halves the concurrency, transient errors don't
+            assert utils.op_limit.get().limit == 4
+
+        assert m_sub_run.call_count == 3
+        assert m_sleep.call_count == 2
+        assert all(0 <= call.args[0] <= utils.OP_BACKOFF_MAX for call in m_sleep.call_args_list)
+
+    @patch_obj(utils.time, 'sleep')
+    @patch_obj(utils, 'sub_run')
+    def test_retries_limited(self, m_sub_run, m_sleep):
+        m_sub_run.side_effect = op_error('rate limit exceeded')
+        with pytest.raises(subprocess.CalledProcessError):
+            utils.op_run('read', 'op://private/runabout/phasers')
+        assert m_sub_run.call_count == utils.OP_RETRIES + 1
+
+    @patch_obj(utils, 'sub_run')
+    def test_no_retry(self, m_sub_run):
+        m_sub_run.side_effect = op_error('[ERROR] "runabout" is not an item in vault "private"')
+        with pytest.raises(subprocess.CalledProcessError):
+            utils.op_run('read', 'op://private/runabout/phasers')
+        assert m_sub_run.call_count == 1
+
+    @patch_obj(utils, 'sub_run')
+    def test_timeout(self, m_sub_run):
+        m_sub_run.side_effect = subprocess.TimeoutExpired('op', 30)
+        with pytest.raises(TimeoutError, match='op timed out after 30s'):
+            utils.op_run('read', 'op://private/runabout/phasers')
+        assert m_sub_run.call_count == 1
+
+    @patch_obj(utils, 'sub_run')
+    def test_deadline(self, m_sub_run):
+        m_sub_run.return_value.stdout = 'ds9'
+        with utils.call_limits(timeout=5):
+            utils.op_run('read', 'op://private/runabout/phasers')
+            assert m_sub_run.call_args.kwargs['timeout'] <= 5
+
+        with utils.call_limits(timeout=0.001):
+            utils.time.sleep(0.002)
+            with pytest.raises(TimeoutError, match='Deadline exceeded'):
+                utils.op_run('read', 'op://private/runabout/phasers')
+        assert m_sub_run.call_count == 1
+
+    @patch_obj(utils, 'sub_run')
+    def test_deadline_includes_slot_wait(self, m_sub_run):
+        m_sub_run.return_value.stdout = 'ds9'
+        with utils.call_limits(timeout=1, concurrency=1):
+            limit = utils.op_limit.get()
+
+            def release():
+                time.sleep(0.3)
+                with limit.cond:
+                    limit.active = 0
+                    limit.cond.notify()
+
+            limit.active = 1
+            threading.Thread(target=release).start()
+            utils.op_run('read', 'op://private/runabout/phasers')
+
+        # The call only gets what's left of the deadline after waiting for a slot
+        assert m_sub_run.call_args.kwargs['timeout'] <= 0.75
+
+    @mock.patch.dict(utils.environ, {'OP_SERVICE_ACCOUNT_TOKEN': 'agent', 'HOME': '/home/agent'})
+    @patch_obj(utils, 'sub_run')
+    def test_caller_env(self, m_sub_run):
+        utils.op_run('whoami')
+        assert 'base_env' not in m_sub_run.call_args.kwargs
+
+        # The caller's account and credentials, not this process's
+        with utils.for_caller(env={'OP_ACCOUNT': 'starfleet', 'HOME': '/home/client'}):
+            utils.op_run('whoami')
+        env = m_sub_run.call_args.kwargs['base_env']
+        assert env['OP_ACCOUNT'] == 'starfleet'
+        assert 'OP_SERVICE_ACCOUNT_TOKEN' not in env
+        assert env['HOME'] == '/home/agent'
+
+    def test_op_identity(self):
+        identity = utils.op_identity({'OP_ACCOUNT': 'starfleet', 'HOME': '/home/picard'})
+        assert identity == utils.op_identity({'OP_ACCOUNT': 'starfleet'})
+        assert identity != utils.op_identity({'OP_ACCOUNT': 'maquis'})
+        assert identity != utils.op_identity({})
+        assert 'starfleet' not in identity
+
+    @mock.patch.dict(utils.environ, {utils.CALL_TIMEOUT_ENVVAR: '3'})
+    def test_call_timeout_env(self):
+        assert utils.call_timeout() == 3
+
+
+class TestAdaptiveLimit:
+    def test_shrink_and_grow(self):
+        limit = utils.AdaptiveLimit(4)
+        limit.throttled()
+        limit.throttled()
+        assert limit.limit == 1
+        limit.throttled()
+        assert limit.limit == 1
+
+        # Grows by one after `limit` successes, up to the maximum
+        for _ in range(1 + 2 + 3 + 10):
+            limit.succeeded()
+        assert limit.limit == 4
+
+    def test_slot(self):
+        limit = utils.AdaptiveLimit(1)
+        with limit.slot():
+            assert limit.active == 1
+            with pytest.raises(TimeoutError), limit.slot(timeout=0.01):
+                pass
+        assert limit.active == 0
+
+
+op_item = {
+    'title': 'runabout',
+    'fields': [
+        {'id': 'username', 'label': 'username', 'value': 'sisko'},
+        {'id': 'password', 'label': 'password'},
+        {
+            'id': 'TOTP_abc',
+            'label': 'one-time password',
+            'section': {'id': 'sec1', 'label': 'Security'},
+            'value': 'otpauth://totp/runabout',
+            'totp': '123456',
+        },
+        {
+            'id': 'abc123',
+            'label': 'phasers',
+            'section': {'id': 'sec2', 'label': 'Weapons'},
+            'value': 'stun',
+        },
+    ],
+}
+
+
+class TestOPItem:
+    def test_ref_split(self):
+        assert utils.op_ref_split('op://Private/run about/phasers') == utils.OPRef(
+            None,
+            'Private',
+            'run about',
+            None,
+            'phasers',
         )
+        assert utils.op_ref_split(
+            'op://starfleet/Private/runabout/Security/one-time%20password?attribute=otp',
+        ) == utils.OPRef('starfleet', 'Private', 'runabout', 'Security', 'one-time password', 'otp')
+
+        with pytest.raises(ValueError, match='Not a 1Pass field reference'):
+            utils.op_ref_split('op://Private/runabout')
+
+    def test_field(self):
+        def field(uri):
+            return utils.op_item_field(op_item, utils.op_ref_split(uri))
+
+        assert field('op://private/runabout/username') == 'sisko'
+        assert field('op://private/runabout/USERNAME') == 'sisko'
+        assert field('op://private/runabout/password') == ''
+        assert field('op://private/runabout/abc123') == 'stun'
+        assert field('op://acct/private/runabout/weapons/phasers') == 'stun'
+        assert field('op://private/runabout/one-time password?attribute=otp') == '123456'
+        assert field('op://private/runabout/one-time password') == 'otpauth://totp/runabout'
+
+        with pytest.raises(KeyError, match='Field not found'):
+            field('op://acct/private/runabout/security/phasers')
+        with pytest.raises(KeyError, match='Not a one-time password'):
+            field('op://private/runabout/username?attribute=otp')
+        with pytest.raises(KeyError, match='Unsupported attribute'):
+            field('op://private/runabout/username?attribute=type')
+
+    @patch_obj(utils, 'sub_run')
+    def test_read_item(self, m_sub_run):
+        m_sub_run.return_value.stdout = json.dumps(op_item)
+        uris = [
+            'op://starfleet/Private/runabout/username',
+            'op://starfleet/private/runabout/abc123',
+        ]
+        assert utils.op_read_item(uris) == ['sisko', 'stun']
+
+        m_sub_run.assert_called_once_with(
+            'op',
+            '--account',
+            'starfleet',
+            'item',
+            'get',
+            'runabout',
+            '--vault',
+            'Private',
+            '--format',
+            'json',
+            capture=True,
+            timeout=utils.CALL_TIMEOUT,
+        )
+
+
+class TestFileLock:
+    def test_exclusive(self, tmp_path):
+        fpath = tmp_path / 'locks' / 'creds.lock'
+        with utils.FileLock(fpath) as lock:
+            assert lock.locked
+            with utils.FileLock(fpath, timeout=0.1) as other:
+                # Timed out, continues without the lock
+                assert not other.locked
+
+        with utils.FileLock(fpath, timeout=0.1) as lock:
+            assert lock.locked
+
+
+class TestPrivate:
+    def test_private_dir(self, tmp_path):
+        dpath = tmp_path / 'private'
+        assert utils.private_dir(dpath)
+        assert dpath.stat().st_mode & 0o777 == 0o700
+
+        dpath.chmod(0o775)
+        assert utils.private_dir(dpath)
+        assert dpath.stat().st_mode & 0o777 == 0o700
+
+        with mock.patch.object(utils.os, 'getuid', return_value=os.getuid() + 1):
+            assert not utils.private_dir(dpath)
+
+    def test_is_private(self, tmp_path):
+        dpath = tmp_path / 'private'
+        utils.private_dir(dpath)
+        fpath = dpath / 'file'
+        assert not utils.is_private(fpath)
+
+        utils.atomic_write(fpath, b'data')
+        assert utils.is_private(fpath)
+
+        dpath.chmod(0o777)
+        assert not utils.is_private(fpath)
+        dpath.chmod(0o700)
+
+        fpath.chmod(0o620)
+        assert not utils.is_private(fpath)
+        fpath.chmod(0o600)
+
+        with mock.patch.object(utils.os, 'getuid', return_value=os.getuid() + 1):
+            assert not utils.is_private(fpath)
+
+
+class TestCacheStore:
+    def test_get_set(self, tmp_path):
+        store = utils.CacheStore(tmp_path)
+        assert store.get('aws:one') is None
+
+        expires_at = time.time() + 60
+        store.set('aws:one', b'one', expires_at)
+        assert store.get('aws:one') == (b'one', expires_at)
+
+        store.set('aws:one', b'two', expires_at)
+        assert store.get('aws:one') == (b'two', expires_at)
+        # Other processes see the entries
+        assert utils.CacheStore(tmp_path).get('aws:one') == (b'two', expires_at)
+        assert store.fpath.stat().st_mode & 0o777 == 0o600
+
+        store.delete('aws:one')
+        assert store.get('aws:one') is None
+
+    def test_not_private(self, tmp_path):
+        dpath = tmp_path / 'env-config'
+        dpath.mkdir(mode=0o777)
+        dpath.chmod(0o777)
+        store = utils.CacheStore(dpath)
+        store.set('aws:one', b'one', time.time() + 60)
+        assert dpath.stat().st_mode & 0o777 == 0o700
+
+        # E.g. planted by another user
+        store.fpath.chmod(0o666)
+        with pytest.raises(PermissionError, match='is not private'):
+            utils.CacheStore(dpath).get('aws:one')
+
+        store.fpath.unlink()
+        store.fpath.symlink_to(tmp_path / 'elsewhere.sqlite3')
+        with pytest.raises(OSError, match='Too many levels of symbolic links'):
+            utils.CacheStore(dpath).get('aws:one')
+        assert not tmp_path.joinpath('elsewhere.sqlite3').exists()
+
+        with (
+            mock.patch.object(utils.os, 'getuid', return_value=utils.os.getuid() + 1),
+            pytest.raises(PermissionError, match='is owned by another user'),
+        ):
+            utils.CacheStore(dpath).get('aws:one')
+
+    def test_evict_expired(self, tmp_path):
+        store = utils.CacheStore(tmp_path)
+        store.set('aws:old', b'old', time.time() - 1)
+        store.set('aws:new', b'new', time.time() + 60)
+        assert store.get('aws:old') is None
+        assert store.get('aws:new')
+
+    def test_evict_least_recently_used(self, tmp_path):
+        store = utils.CacheStore(tmp_path, max_bytes=10)
+        expires_at = time.time() + 60
+        with mock.patch.object(utils.time, 'time', return_value=time.time() - 120):
+            store.set('aws:one', b'1234', expires_at)
+            store.set('aws:two', b'1234', expires_at)
+        # Using it makes "one" more recently used than "two"
+        store.get('aws:one')
+
+        store.set('aws:three', b'1234', expires_at)
+        assert store.get('aws:one')
+        assert store.get('aws:two') is None
+        assert store.get('aws:three')
+
+    def test_clear(self, tmp_path):
+        store = utils.CacheStore(tmp_path)
+        expires_at = time.time() + 60
+        store.set('aws:one', b'one', expires_at)
+        store.set('secret:one', b'one', expires_at)
+        store.set('secret:two', b'two', expires_at)
+
+        assert store.clear('secret:') == 2
+        assert store.get('aws:one')
+        assert store.clear() == 1
+
+    def test_gc(self, tmp_path):
+        store = utils.CacheStore(tmp_path)
+        # Expired since it was saved
+        now = time.time()
+        with mock.patch.object(utils.time, 'time', return_value=now - 120):
+            store.set('aws:one', b'one', now - 60)
+            store.set('aws:two', b'two', now + 60)
+        # Left by older versions
+        tmp_path.joinpath('secrets').mkdir()
+        old = tmp_path / 'secrets/old.bin'
+        old.write_bytes(b'old')
+        os.utime(old, (0, 0))
+        recent = tmp_path / 'recent.bin'
+        recent.write_bytes(b'recent')
+
+        assert store.gc() == 2
+        assert store.get('aws:one') is None
+        assert store.get('aws:two')
+        assert not old.exists()
+        assert recent.exists()
+
+
+class TestEncryptedTempFile:
+    def test_save_read(self, tmp_path):
+        enc_tmp = utils.EncryptedTempFile('starfleet', dpath=tmp_path, enc_key='key')
+        assert enc_tmp.read() is None
+        enc_tmp.save(b'one', time.time() + 60)
+        enc_tmp.save(b'two', time.time() + 60)
+
+        assert enc_tmp.read() == b'two'
+        # Expiring too soon
+        assert enc_tmp.read(fresh_for=120) is None
+        # Everything is in the store
+        assert [fpath.name for fpath in tmp_path.glob('*.bin')] == []
+
+    def test_format(self, tmp_path):
+        enc_tmp = utils.EncryptedTempFile('starfleet', dpath=tmp_path, enc_key='key')
+        enc_tmp.save(b'one', time.time() + 60)
+        blob, _ = enc_tmp.store.get(enc_tmp.store_key)
+        assert blob.startswith(enc_tmp.header)
+        assert b'one' not in blob
+
+        # Changes are detected
+        enc_tmp.store.set(enc_tmp.store_key, blob[:-1] + bytes([blob[-1] ^ 1]), time.time() + 60)
+        with pytest.raises(InvalidTag):
+            enc_tmp.read()
+
+    def test_read_legacy(self, tmp_path):
+        # Saved by older versions, before and after the switch to AES-GCM
+        enc_tmp = utils.EncryptedTempFile('starfleet', dpath=tmp_path, enc_key='key')
+        fernet = Fernet(base64.urlsafe_b64encode(enc_tmp.key))
+        enc_tmp.fpath.write_bytes(fernet.encrypt(b'one'))
+        assert enc_tmp.read() == b'one'
+
+        enc_tmp.save(b'two', time.time() + 60)
+        blob, _ = enc_tmp.store.get(enc_tmp.store_key)
+        assert not enc_tmp.fpath.exists()
+
+        enc_tmp.store.delete(enc_tmp.store_key)
+        enc_tmp.fpath.write_bytes(blob)
+        assert enc_tmp.read() == b'two'
+
+    def test_namespace(self, tmp_path):
+        aws = utils.EncryptedTempFile('starfleet', dpath=tmp_path, enc_key='key', namespace='aws')
+        aws.save(b'aws', time.time() + 60)
+        secret = utils.EncryptedTempFile('starfleet', dpath=tmp_path, enc_key='key')
+        assert secret.read() is None
+
+
+class TestMachineIdent:
+    @mock.patch('uuid.getnode', return_value=1701)
+    def test_machine_node(self, m_getnode, tmp_path):
+        fpath = tmp_path / 'machine-node'
+        assert utils.machine_node('enterprise', fpath) == 1701
+        assert utils.machine_node('enterprise', fpath) == 1701
+        assert m_getnode.call_count == 1
+        assert 'enterprise' not in fpath.read_text()
+
+        # Cache from a different machine
+        m_getnode.return_value = 74656
+        assert utils.machine_node('voyager', fpath) == 74656
+        assert m_getnode.call_count == 2
+
+        # Cache someone else could have written
+        fpath.chmod(0o666)
+        assert utils.machine_node('voyager', fpath) == 74656
+        assert m_getnode.call_count == 3
+        assert fpath.stat().st_mode & 0o777 == 0o600
+
+    @patch_obj(utils, 'machine_node', return_value=1701)
+    def test_cached(self, m_machine_node):
+        utils.machine_ident.cache_clear()
+        try:
+            ident = utils.machine_ident()
+            assert ident.startswith('1701')
+            assert utils.machine_ident() == ident
+            assert m_machine_node.call_count == 1
+        finally:
+            utils.machine_ident.cache_clear()
+
+
+class TestLogs:
+    def test_json_formatter(self):
+        record = logging.LogRecord(
+            'env_config.aws',
+            logging.INFO,
+            'aws.py',
+            1,
+            'creds %s',
+            ('a',),
+            None,
+        )
+        record.event = 'creds'
+        record.duration_ms = 1.5
+
+        entry = json.loads(utils.JsonFormatter().format(record))
+        assert entry['msg'] == 'creds a'
+        assert entry['level'] == 'INFO'
+        assert entry['event'] == 'creds'
+        assert entry['duration_ms'] == 1.5
+        assert 'profile' not in entry
+
+    def test_deferred(self, tmp_path):
+        fpath = tmp_path / 'env-config.log'
+        with (
+            mock.patch.object(utils, 'LOG_FPATH', fpath),
+            mock.patch.object(utils, 'logs_deferred', False),
+            patch_obj(utils, 'rotate_logs') as m_rotate,
+            patch_obj(utils, 'init_logs') as m_init,
+        ):
+            utils.defer_logs()
+            m_rotate.assert_called_once_with()
+            assert utils.logs_deferred
+
+            # Events are written without logging
+            utils.write_log('aws', 'log_event', 'creds a', event='creds', cache='hit')
+            m_init.assert_not_called()
+
+            # Logging is initialized once something is logged
+            utils.Log('env_config.aws').info('Logged')
+            m_init.assert_called_once_with()
+
+        (entry,) = utils.read_logs(fpath)
+        assert entry['msg'] == 'creds a'
+        assert entry['level'] == 'INFO'
+        assert entry['module'] == 'aws'
+        assert entry['event'] == 'creds'
+        assert entry['cache'] == 'hit'
+
+    def test_rotate_and_read(self, tmp_path):
+        fpath = tmp_path / 'env-config.log'
+
+        for num in range(4):
+            fpath.write_text(json.dumps({'num': num}) + '\nnot json\n')
+            utils.rotate_logs(fpath, max_bytes=10, backups=2)
+
+        assert not fpath.exists()
+        assert sorted(p.name for p in tmp_path.iterdir()) == [
+            'env-config.log.1',
+            'env-config.log.2',
+            'env-config.log.lock',
+        ]
+
+        # Small enough to not be rotated
+        fpath.write_text(json.dumps({'num': 4}) + '\n')
+        utils.rotate_logs(fpath, max_bytes=1000, backups=2)
+
+        assert [entry['num'] for entry in utils.read_logs(fpath, backups=2)] == [2, 3, 4]
+
+    def test_rotate_concurrently(self, tmp_path):
+        fpath = tmp_path / 'env-config.log'
+        fpath.write_text(json.dumps({'num': 1}) + '\n')
+        fpath.with_name('env-config.log.1').write_text(json.dumps({'num': 0}) + '\n')
+
+        # E.g. several credential_process calls starting at once
+        barrier = threading.Barrier(8)
+
+        def rotate():
+            barrier.wait()
+            utils.rotate_logs(fpath, max_bytes=10, backups=3)
+
+        threads = [threading.Thread(target=rotate) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Rotated once, nothing lost
+        assert not fpath.exists()
+        assert [entry['num'] for entry in utils.read_logs(fpath, backups=3)] == [0, 1]
+        assert not fpath.with_name('env-config.log.3').exists()
+
+    def test_unwritable(self, tmp_path):
+        # The temp dir can't be created so nothing can be logged, but commands still work
+        tmp_dpath = tmp_path / 'env-config'
+        tmp_dpath.write_text('')
+        fpath = tmp_dpath / 'env-config.log'
+
+        with (
+            mock.patch.object(utils, 'TMP_DPATH', tmp_dpath),
+            mock.patch.object(utils, 'LOG_FPATH', fpath),
+            mock.patch.object(utils, 'logs_deferred', False),
+        ):
+            utils.defer_logs()
+            assert not utils.logs_deferred
+            utils.write_log('aws', 'log_event', 'creds a', event='creds', cache='hit')
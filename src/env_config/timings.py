@@ -0,0 +1,85 @@
+"""
+Lightweight timing of the phases on the hot paths (loading the config, resolving secrets, reading
+cached credentials, etc.) so it's possible to tell where the time goes.
+
+Enabled with `env-config --timings` or ENV_CONFIG_TIMINGS=1 (e.g. for env-config-aws) and reported
+to stderr when the process exits.  When disabled, a span is a function call that returns a shared
+no-op context manager.
+
+This module is imported on hot paths (e.g. entry.py) so should only import what it needs.
+"""
+
+import atexit
+from os import environ
+import sys
+import time
+
+
+ENVVAR = 'ENV_CONFIG_TIMINGS'
+
+enabled = False
+# Span name -> durations in seconds.  Dicts keep insertion order so the report is in the order
+# the phases first happened.
+recorded: dict[str, list[float]] = {}
+
+
+class Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, time.perf_counter() - self.start)
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(name: str) -> Span | NullSpan:
+    return Span(name) if enabled else NULL_SPAN
+
+
+def record(name: str, seconds: float) -> None:
+    # setdefault() and append() are atomic so spans from resolver threads don't need a lock
+    recorded.setdefault(name, []).append(seconds)
+
+
+def enable() -> None:
+    global enabled
+
+    if not enabled:
+        enabled = True
+        atexit.register(report)
+
+
+def report(file=None) -> None:
+    file = file or sys.stderr
+    if not recorded:
+        return
+
+    width = max(len(name) for name in recorded)
+    print('Timings:', file=file)
+    for name, durations in list(recorded.items()):
+        line = f'    {name:<{width}}  {sum(durations) * 1000:9.1f}ms'
+        if len(durations) > 1:
+            line += f'  ({len(durations)} calls, max {max(durations) * 1000:.1f}ms)'
+        print(line, file=file)
+
+
+if environ.get(ENVVAR, '').lower() in ('1', 'true', 'yes', 'on'):
+    enable()
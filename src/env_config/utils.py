@@ -1,20 +1,232 @@
-import base64
-from collections.abc import Iterable
+from collections.abc import Iterable, Iterator, Mapping
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
 import datetime as dt
+import fcntl
+from functools import cache
 import hashlib
+import os
 from os import environ
 from pathlib import Path
-import subprocess
 import sys
-import tempfile
-from urllib.parse import unquote
-import uuid
+import time
+from typing import TYPE_CHECKING, NamedTuple
 
-from cryptography.fernet import Fernet
-from furl import furl
+from . import timings
 
 
-TMP_DPATH = Path(tempfile.gettempdir()) / 'env-config'
+# NOTE: modules only some commands need (e.g. subprocess, json, threading, uuid) are imported in
+# the functions that use them.  This module is on the env-config-aws cached credentials path, see
+# entry.py.
+if TYPE_CHECKING:
+    import logging
+    import sqlite3
+    import subprocess
+
+
+class Log:
+    """
+    Stands in for logging.getLogger(name) in modules on the hot paths.  logging is relatively slow
+    to import so it's only imported once something is logged, and initialized then when
+    defer_logs() was called.
+    """
+
+    __slots__ = ('name',)
+
+    def __init__(self, name: str):
+        self.name: str = name
+
+    def __getattr__(self, attr: str):
+        if logs_deferred:
+            init_logs()
+
+        import logging
+
+        return getattr(logging.getLogger(self.name), attr)
+
+
+log = Log(__name__)
+
+
+def tmp_dpath() -> Path:
+    """
+    Like tempfile.gettempdir(), without importing tempfile which is slow to import.  Keep
+    hook.cache_dpath() in sync.
+    """
+    return Path(environ.get('TMPDIR') or environ.get('TEMP') or environ.get('TMP') or '/tmp')
+
+
+TMP_DPATH = tmp_dpath().absolute() / 'env-config'
+
+
+# Entries saved by EncryptedTempFile, see CacheStore
+CACHE_FNAME = 'cache.sqlite3'
+# Least recently used entries are evicted once the store is bigger than this
+CACHE_MAX_BYTES = 5_000_000
+# Seconds to wait on another process writing to the store
+CACHE_BUSY_TIMEOUT = 5
+# An entry's last use is only updated when it's older than this many seconds
+CACHE_TOUCH_INTERVAL = 60
+# Files older versions saved each entry to, relative to TMP_DPATH.  Deleted by `env-config cache
+# gc` once they haven't been updated for the longest an AWS session lasts.
+CACHE_LEGACY_GLOBS = ('*.bin', 'secrets/*.bin')
+CACHE_LEGACY_MAX_AGE = 129600
+
+# uuid.getnode() result, see machine_node()
+MACHINE_NODE_FPATH = TMP_DPATH / 'machine-node'
+
+LOG_FPATH = TMP_DPATH / 'env-config.log'
+# Logs are rotated once they're bigger than this, keeping LOG_BACKUPS old files
+LOG_MAX_BYTES = 1_000_000
+LOG_BACKUPS = 3
+# Values given to a log call with `extra=` that are included in the log record
+LOG_FIELDS = ('event', 'profile', 'cache', 'duration_ms', 'ahead')
+
+
+# True from defer_logs() until logging is initialized, see Log
+logs_deferred = False
+
+
+class JsonFormatter:
+    """
+    Formats log records as JSON lines so they can be analyzed, e.g. by `env-config-aws stats`.  Has
+    what logging needs from a Formatter, without subclassing it, so logging is only imported when
+    used.
+    """
+
+    def format(self, record: 'logging.LogRecord') -> str:
+        import json
+
+        entry = {
+            'ts': dt.datetime.fromtimestamp(record.created, dt.UTC).isoformat(),
+            'level': record.levelname,
+            'module': record.module,
+            'func': record.funcName,
+            'msg': record.getMessage(),
+        }
+        for field in LOG_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            import logging
+
+            entry['exc'] = logging.Formatter().formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def rotate_logs(
+    fpath: Path = LOG_FPATH,
+    max_bytes: int = LOG_MAX_BYTES,
+    backups: int = LOG_BACKUPS,
+):
+    """
+    Rotate the log file if it's too big.  Most processes are short lived so this is done when
+    logging is initialized instead of checking the size on every write.
+
+    Processes starting at the same time could all see a big log file.  Only the one holding the
+    lock rotates it, the others skip rotating rather than wait.
+    """
+    try:
+        if fpath.stat().st_size < max_bytes:
+            return
+        fd = os.open(fpath.with_name(f'{fpath.name}.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+    except OSError:
+        return
+
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # Another process may have rotated it since it was checked
+        if fpath.stat().st_size < max_bytes:
+            return
+
+        for num in range(backups - 1, 0, -1):
+            backup = fpath.with_name(f'{fpath.name}.{num}')
+            if backup.exists():
+                backup.replace(fpath.with_name(f'{fpath.name}.{num + 1}'))
+        fpath.replace(fpath.with_name(f'{fpath.name}.1'))
+    except OSError:
+        # Locked by another process rotating it, or a file changed by someone not locking.  Logs
+        # are never worth failing the command over.
+        pass
+    finally:
+        # Also releases the lock
+        os.close(fd)
+
+
+def init_logs():
+    global logs_deferred
+
+    import logging
+
+    logs_deferred = False
+    # Like basicConfig(), do nothing when logging is already configured
+    if logging.root.handlers:
+        return
+
+    try:
+        TMP_DPATH.mkdir(exist_ok=True)
+        rotate_logs()
+        handler = logging.FileHandler(LOG_FPATH, encoding='utf-8')
+    except OSError:
+        # E.g. the temp dir is full or not writable.  The command still works, unlogged.
+        return
+
+    handler.setFormatter(JsonFormatter())
+    logging.basicConfig(level=logging.INFO, handlers=[handler])
+
+
+def defer_logs():
+    """
+    Like init_logs(), for hot paths that rarely log.  logging is imported and initialized once
+    something is logged, see Log.  Events are written with write_log() until then.
+    """
+    global logs_deferred
+
+    try:
+        TMP_DPATH.mkdir(exist_ok=True)
+        rotate_logs()
+    except OSError:
+        # Like init_logs(), credentials are still printed when the log can't be written
+        return
+    logs_deferred = True
+
+
+def write_log(module: str, func: str, msg: str, **fields) -> None:
+    """Append an INFO entry to the log file, as JsonFormatter formats it, without logging"""
+    import json
+
+    entry = {
+        'ts': utc_now().isoformat(),
+        'level': 'INFO',
+        'module': module,
+        'func': func,
+        'msg': msg,
+        **fields,
+    }
+    try:
+        with LOG_FPATH.open('a', encoding='utf-8') as fo:
+            fo.write(json.dumps(entry) + '\n')
+    except OSError:
+        # Like logging, which reports write errors to stderr and carries on
+        sys.stderr.write(f'Unable to write {LOG_FPATH}\n')
+
+
+def read_logs(fpath: Path | None = None, backups: int = LOG_BACKUPS) -> Iterator[dict]:
+    """Yield log records, oldest first, including rotated files.  Non-JSON lines are skipped."""
+    import json
+
+    fpath = fpath or LOG_FPATH
+    fpaths = [fpath.with_name(f'{fpath.name}.{num}') for num in range(backups, 0, -1)]
+    for log_fpath in [*fpaths, fpath]:
+        if not log_fpath.exists():
+            continue
+        with log_fpath.open(encoding='utf-8', errors='replace') as fo:
+            for line in fo:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # E.g. written in the text format used by older versions
+                    continue
 
 
 def print_err(*args, **kwargs):
@@ -27,13 +239,17 @@ def sub_run(
     capture=False,
     returns: None | Iterable[int] = None,
     **kwargs,
-) -> subprocess.CompletedProcess:
+) -> 'subprocess.CompletedProcess':
+    import subprocess
+
     kwargs.setdefault('check', not bool(returns))
     capture = kwargs.setdefault('capture_output', capture)
     args = args + kwargs.pop('args', ())
     env = kwargs.pop('env', None)
-    if env:
-        kwargs['env'] = environ | env
+    # Environment `env` is added to, this process's by default
+    base_env = kwargs.pop('base_env', None)
+    if env or base_env is not None:
+        kwargs['env'] = {**(environ if base_env is None else base_env), **(env or {})}
     if capture:
         kwargs.setdefault('text', True)
 
@@ -49,21 +265,370 @@ def sub_run(
         raise
 
 
-def op_read(uri: str):
+# Seconds a single `op` (or cmd://) call can take before it's killed.  ENV_CONFIG_CALL_TIMEOUT
+# overrides it.
+CALL_TIMEOUT: float = 30
+CALL_TIMEOUT_ENVVAR = 'ENV_CONFIG_CALL_TIMEOUT'
+# `op` errors that are likely to go away when retried, matched against its lowercased stderr
+OP_THROTTLED_ERRORS = ('too many requests', 'rate limit', '(429)')
+OP_TRANSIENT_ERRORS = (
+    '(500)',
+    '(502)',
+    '(503)',
+    '(504)',
+    'timeout',
+    'connection reset',
+    'temporarily unavailable',
+)
+OP_RETRIES = 3
+# Environment variables `op` reads its account and credentials from, e.g. OP_ACCOUNT,
+# OP_SERVICE_ACCOUNT_TOKEN, OP_SESSION_<account>
+OP_ENVVAR_PREFIX = 'OP_'
+# Retries wait a random time up to OP_BACKOFF * 2**attempt seconds, capped at OP_BACKOFF_MAX
+OP_BACKOFF: float = 0.5
+OP_BACKOFF_MAX: float = 8
+
+
+class Deadline:
+    """Point in time shared calls have to finish by, e.g. everything resolved for one command"""
+
+    def __init__(self, seconds: float | None):
+        self.expires: float | None = None if seconds is None else time.monotonic() + seconds
+
+    def remaining(self) -> float | None:
+        return None if self.expires is None else self.expires - time.monotonic()
+
+    def timeout(self, limit: float) -> float:
+        """Return `limit`, shortened to what's left.  Raises TimeoutError once expired."""
+        remaining = self.remaining()
+        if remaining is None:
+            return limit
+        if remaining <= 0:
+            raise TimeoutError('Deadline exceeded')
+        return min(limit, remaining)
+
+
+class AdaptiveLimit:
+    """
+    Limits how many `op` calls run at once.  The limit is halved when `op` reports throttling and
+    grows back by one after as many successful calls as the current limit, never beyond `maximum`.
+    """
+
+    def __init__(self, maximum: int):
+        import threading
+
+        self.maximum: int = maximum
+        self.limit: int = maximum
+        self.active: int = 0
+        self.successes: int = 0
+        self.cond = threading.Condition()
+
+    @contextmanager
+    def slot(self, timeout: float | None = None):
+        """Wait, at most `timeout` seconds, until fewer than `limit` calls are running"""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.active < self.limit, timeout):
+                raise TimeoutError('Deadline exceeded waiting to run op')
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.active -= 1
+                self.cond.notify()
+
+    def throttled(self):
+        with self.cond:
+            self.limit = max(1, self.limit // 2)
+            self.successes = 0
+            log.info('op throttled, concurrency limit now %s', self.limit)
+
+    def succeeded(self):
+        with self.cond:
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self.successes = 0
+                self.cond.notify()
+
+
+# Set by call_limits() for the calls made while resolving.  Copied into resolver threads with the
+# rest of the context.
+deadline: ContextVar[Deadline | None] = ContextVar('deadline', default=None)
+op_limit: ContextVar[AdaptiveLimit | None] = ContextVar('op_limit', default=None)
+
+
+@contextmanager
+def call_limits(timeout: float | None = None, concurrency: int | None = None):
+    """Limit the total time and `op` concurrency of the calls made in the context"""
+    deadline_token = deadline.set(Deadline(timeout))
+    limit_token = op_limit.set(AdaptiveLimit(concurrency) if concurrency else None)
+    try:
+        yield
+    finally:
+        op_limit.reset(limit_token)
+        deadline.reset(deadline_token)
+
+
+class Caller(NamedTuple):
+    """
+    Environment and current directory values are resolved for, e.g. the agent's client.  None means
+    this process's.
+    """
+
+    env: Mapping[str, str] | None = None
+    cwd: str | None = None
+
+    def environ(self) -> Mapping[str, str]:
+        return environ if self.env is None else self.env
+
+    def path(self, path: str) -> Path:
+        """Return the path with `~` expanded and relative to the current directory"""
+        fpath = Path(path).expanduser()
+        return Path(self.cwd, fpath) if self.cwd else fpath
+
+
+# Set by for_caller() for resolvers that depend on the environment or current directory, e.g.
+# env://.  Copied into resolver threads with the rest of the context.
+caller: ContextVar[Caller | None] = ContextVar('caller', default=None)
+
+
+def current_caller() -> Caller:
+    return caller.get() or Caller()
+
+
+@contextmanager
+def for_caller(env: Mapping[str, str] | None = None, cwd: str | None = None):
+    """Resolve values in the context for the given environment and current directory"""
+    token = caller.set(Caller(env, cwd))
+    try:
+        yield
+    finally:
+        caller.reset(token)
+
+
+def call_timeout() -> float:
+    """Timeout for the next call: CALL_TIMEOUT shortened to what's left of the deadline, if any"""
+    limit = float(environ.get(CALL_TIMEOUT_ENVVAR) or CALL_TIMEOUT)
+    current = deadline.get()
+    return current.timeout(limit) if current else limit
+
+
+def op_env() -> Mapping[str, str] | None:
+    """
+    Environment for `op` when resolving for a caller with its own environment, e.g. the agent's
+    client: this process's environment with the caller's `op` variables instead of its own.  None
+    when resolving for this process.
+    """
+    env = current_caller().env
+    if env is None:
+        return None
+    return {
+        **{name: value for name, value in environ.items() if not name.startswith(OP_ENVVAR_PREFIX)},
+        **{name: value for name, value in env.items() if name.startswith(OP_ENVVAR_PREFIX)},
+    }
+
+
+def op_identity(env: Mapping[str, str]) -> str:
+    """Hash of the `op` variables in `env`, which decide the account secrets are read from"""
+    op_vars = sorted(
+        (name, value) for name, value in env.items() if name.startswith(OP_ENVVAR_PREFIX)
+    )
+    return hashlib.sha256(repr(op_vars).encode()).hexdigest()
+
+
+def op_error_kind(stderr: str | None) -> str | None:
+    """Return 'throttled' or 'transient' for `op` errors worth retrying, None otherwise"""
+    stderr = (stderr or '').lower()
+    if any(error in stderr for error in OP_THROTTLED_ERRORS):
+        return 'throttled'
+    if any(error in stderr for error in OP_TRANSIENT_ERRORS):
+        return 'transient'
+    return None
+
+
+def backoff(attempt: int) -> float:
+    # Imported here to keep it off the env-config-aws cached credentials path
+    import random
+
+    # "Full jitter" so concurrent callers that failed together don't retry together
+    return random.uniform(0, min(OP_BACKOFF_MAX, OP_BACKOFF * 2**attempt))
+
+
+def op_run(*args, **kwargs) -> 'subprocess.CompletedProcess':
+    """
+    Run `op` with its output captured.  Each call is limited to call_timeout() and throttling or
+    transient errors are retried with backoff, as long as the deadline allows.  A call that times
+    out isn't retried, the deadline would likely be used up waiting on it again.
+    """
+    import subprocess
+
+    if (env := op_env()) is not None:
+        kwargs['base_env'] = env
+
+    limit = op_limit.get()
+    attempt = 0
+    while True:
+        try:
+            with limit.slot(call_timeout()) if limit else nullcontext():
+                # Waiting for a slot used up some of the deadline, the call only gets what's left
+                result = sub_run('op', *args, capture=True, timeout=call_timeout(), **kwargs)
+        except subprocess.TimeoutExpired as e:
+            raise TimeoutError(f'op timed out after {e.timeout:.0f}s') from e
+        except subprocess.CalledProcessError as e:
+            kind = op_error_kind(e.stderr)
+            if kind is None or attempt >= OP_RETRIES:
+                raise
+            if kind == 'throttled' and limit:
+                limit.throttled()
+            delay = backoff(attempt)
+            current = deadline.get()
+            remaining = current.remaining() if current else None
+            if remaining is not None and delay >= remaining:
+                raise
+            log.info('op %s error, retrying in %.2fs', kind, delay)
+            time.sleep(delay)
+            attempt += 1
+            continue
+
+        if limit:
+            limit.succeeded()
+        return result
+
+
+def op_ref_parse(uri: str) -> tuple[str | None, str]:
+    """
+    Split a secret reference into the 1Pass account and a reference `op` understands.  Extended
+    references (op://account/vault/item/field) have their account removed.
+    """
+    # Imported here to keep it off the env-config-aws cached credentials path
+    from urllib.parse import unquote
+
+    from furl import furl
+
     parts = furl(uri)
     segments = parts.path.segments
     if len(segments) > 2:
-        acct_args = ('--account', parts.host)
         vault = segments[0]
-        uri = unquote(parts.set(host=vault, path=segments[1:]).url)
-    else:
-        acct_args = ()
-    return sub_run('op', *acct_args, 'read', '-n', uri, capture=True).stdout
+        return parts.host, unquote(parts.set(host=vault, path=segments[1:]).url)
+    return None, uri
+
+
+def op_acct_args(account: str | None) -> tuple[str, ...]:
+    return ('--account', account) if account else ()
+
 
+def op_read(uri: str):
+    account, uri = op_ref_parse(uri)
+    return op_run(*op_acct_args(account), 'read', '-n', uri).stdout
+
+
+def op_inject(uris: list[str], account: str | None = None) -> list[str]:
+    """
+    Resolve multiple secret references with a single `op inject` call.  References should be
+    standard (not extended) and all belong to the given account.  Values are returned in the same
+    order as the references.
+    """
+    import uuid
+
+    # Values are separated by a boundary that can't reasonably occur in a secret.
+    boundary = f'--env-config-{uuid.uuid4().hex}--'
+    sep = f'\n{boundary}\n'
+    template = boundary + sep.join('{{ ' + uri + ' }}' for uri in uris) + boundary
+    result = op_run(*op_acct_args(account), 'inject', input=template)
+
+    values = result.stdout.removeprefix(boundary).removesuffix(boundary).split(sep)
+    if len(values) != len(uris):
+        raise ValueError(f'op inject returned {len(values)} values for {len(uris)} references')
+    return values
 
-def machine_ident():
+
+class OPRef(NamedTuple):
+    """A (possibly extended) 1Pass secret reference split into its parts"""
+
+    account: str | None
+    vault: str
+    item: str
+    section: str | None
+    field: str
+    attribute: str | None = None
+
+
+def op_ref_split(uri: str) -> OPRef:
     """
-    Return a deterministic value based on the current machine's hardware and OS.
+    Split a secret reference like op_ref_parse() does: references with more than three path parts
+    are extended references that start with the account.  Raises ValueError for references that
+    don't point at a field.
+    """
+    from urllib.parse import parse_qs, unquote, urlsplit
+
+    parts = urlsplit(uri)
+    segments = [unquote(segment) for segment in parts.path.split('/')[1:]]
+    account = None
+    vault = unquote(parts.netloc)
+    if len(segments) > 2:
+        account, vault, *segments = [vault, *segments]
+    if len(segments) not in (2, 3) or not all(segments):
+        raise ValueError(f'Not a 1Pass field reference: {uri}')
+
+    item, *section, field = segments
+    attribute = parse_qs(parts.query).get('attribute', [None])[0]
+    return OPRef(account, vault, item, section[0] if section else None, field, attribute)
+
+
+def op_item_get(ref: OPRef) -> dict:
+    """Fetch the item the reference points at, with all its fields, in one `op` call"""
+    import json
+
+    args = ('item', 'get', ref.item, '--vault', ref.vault, '--format', 'json')
+    result = op_run(*op_acct_args(ref.account), *args)
+    return json.loads(result.stdout)
+
+
+def op_item_field(item: dict, ref: OPRef) -> str:
+    """
+    Return the value of the referenced field from an item fetched with op_item_get().  Fields and
+    sections match by label or id, ignoring case, like `op read` does.  Only the value and OTP
+    attributes are supported, KeyError is raised for anything that isn't found or supported.
+    """
+
+    def matches(obj: dict | None, name: str) -> bool:
+        name = name.casefold()
+        return bool(obj) and name in (obj.get('label', '').casefold(), obj.get('id', '').casefold())
+
+    attribute = (ref.attribute or 'value').casefold()
+    if attribute not in ('value', 'otp', 'totp'):
+        raise KeyError(f'Unsupported attribute: {ref.attribute}')
+
+    for field in item.get('fields', ()):
+        if not matches(field, ref.field):
+            continue
+        if ref.section is not None and not matches(field.get('section'), ref.section):
+            continue
+        if attribute == 'value':
+            return field.get('value', '')
+        if 'totp' not in field:
+            raise KeyError(f'Not a one-time password field: {ref.field}')
+        return field['totp']
+
+    raise KeyError(f'Field not found: {ref.field}')
+
+
+def op_read_item(uris: list[str]) -> list[str]:
+    """
+    Resolve references to fields of the same item by fetching the item once instead of calling
+    `op read` for each field.  Values are returned in the same order as the references.
+    """
+    refs = [op_ref_split(uri) for uri in uris]
+    item = op_item_get(refs[0])
+    return [op_item_field(item, ref) for ref in refs]
+
+
+@cache
+def machine_ident() -> str:
+    """
+    Return a deterministic value based on the current machine's hardware and OS.  Computed once per
+    process.
 
     Intended to be used to encrypt AWS session details that will be stored on the file system.
     Predictible but just trying to keep a rogue app on the dev's system from scraping creds
@@ -73,7 +638,272 @@ def machine_ident():
     dbus_mid = Path('/var/lib/dbus/machine-id')
     machine_id = etc_mid.read_text() if etc_mid.exists() else dbus_mid.read_text()
 
-    return str(uuid.getnode()) + machine_id
+    return str(machine_node(machine_id)) + machine_id
+
+
+def machine_node(machine_id: str, fpath: Path | None = None) -> int:
+    """
+    Return uuid.getnode(), cached in a file across processes.  getnode() can be slow, e.g. when it
+    has to run `ip link` to find a MAC address.  The node isn't a secret, and the cache is only used
+    when its fingerprint of the machine id matches so a cache copied from another machine is
+    ignored.
+    """
+    fpath = fpath or MACHINE_NODE_FPATH
+    fingerprint = hashlib.sha256(machine_id.encode()).hexdigest()
+    # The node is part of the encryption keys, a cache someone else wrote isn't used
+    if is_private(fpath):
+        try:
+            cached_fingerprint, node = fpath.read_text().split()
+            if cached_fingerprint == fingerprint:
+                return int(node)
+        except (OSError, ValueError):
+            pass
+
+    import uuid
+
+    # When no MAC address is found, getnode() returns a random value.  Caching it keeps the
+    # encryption keys the same from one process to the next.
+    node = uuid.getnode()
+    try:
+        if private_dir(fpath.parent):
+            atomic_write(fpath, f'{fingerprint} {node}\n'.encode())
+        else:
+            log.warning('Not caching machine node, %s is owned by another user', fpath.parent)
+    except OSError:
+        log.warning('Unable to cache machine node in %s', fpath)
+    return node
+
+
+def atomic_write(fpath: Path, data: bytes) -> None:
+    """
+    Write to a temp file and rename it over `fpath` so concurrent readers see either the old or the
+    new content, never a partial write.  The file is only readable by the current user.
+    """
+    import tempfile
+
+    fd, tmp_fpath = tempfile.mkstemp(dir=fpath.parent, prefix=f'.{fpath.name}.')
+    try:
+        with os.fdopen(fd, 'wb') as fo:
+            fo.write(data)
+        Path(tmp_fpath).replace(fpath)
+    except BaseException:
+        Path(tmp_fpath).unlink(missing_ok=True)
+        raise
+
+
+def private_dir(dpath: Path) -> bool:
+    """
+    Create the directory, only accessible by the current user.  Returns False when someone else
+    owns it (e.g. they created it first in the shared temp directory) so it shouldn't be used.
+    """
+    dpath.mkdir(mode=0o700, parents=True, exist_ok=True)
+    stat = os.lstat(dpath)
+    if stat.st_uid != os.getuid():
+        return False
+    if stat.st_mode & 0o077:
+        dpath.chmod(0o700)
+    return True
+
+
+def is_private(fpath: Path) -> bool:
+    """
+    True when the file and its directory are owned by the current user and no one else can write to
+    them.  The temp directory is shared by all users so what's read from it is only trusted when
+    this is true.
+    """
+    for path in (fpath, fpath.parent):
+        try:
+            stat = os.lstat(path)
+        except OSError:
+            return False
+        if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+            return False
+    return True
+
+
+class FileLock:
+    """
+    Exclusive lock shared across processes, e.g. so only one process regenerates credentials while
+    the others wait and then use what it cached.
+
+    Uses flock() so the lock is released when the holder exits, even if it crashes.  If the lock
+    isn't acquired within `timeout` seconds, continue without it rather than fail.
+    """
+
+    poll_interval: float = 0.05
+
+    def __init__(self, fpath: Path, timeout: float = 120):
+        self.fpath: Path = fpath
+        self.timeout: float = timeout
+        self.fd: int | None = None
+        self.locked: bool = False
+
+    def __enter__(self) -> 'FileLock':
+        self.fpath.parent.mkdir(parents=True, exist_ok=True)
+        self.fd = os.open(self.fpath, os.O_RDWR | os.O_CREAT, 0o600)
+
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.locked = True
+                return self
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    log.warning('Timed out waiting for lock %s', self.fpath)
+                    return self
+                time.sleep(self.poll_interval)
+
+    def __exit__(self, *exc_info):
+        if self.locked:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self.locked = False
+        os.close(self.fd)
+        self.fd = None
+
+
+class CacheStore:
+    """
+    Cached entries (e.g. AWS session credentials, resolved secrets) in a single SQLite database.
+
+    WAL mode lets any number of processes read while one writes.  Each entry's expiry is kept in
+    plain text next to its data, which is usually encrypted, so stale entries can be skipped and
+    evicted without decrypting anything.  Saving an entry evicts expired entries and then, when
+    the store is bigger than `max_bytes`, the least recently used ones.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS entry (
+            key TEXT PRIMARY KEY,
+            expires_at REAL NOT NULL,
+            used_at REAL NOT NULL,
+            size INTEGER NOT NULL,
+            data BLOB NOT NULL
+        );
+        PRAGMA user_version = 1;
+    """
+
+    def __init__(self, dpath: Path | None = None, max_bytes: int = CACHE_MAX_BYTES):
+        import threading
+
+        self.dpath: Path = dpath or TMP_DPATH
+        self.fpath: Path = self.dpath / CACHE_FNAME
+        self.max_bytes: int = max_bytes
+        self.conn: sqlite3.Connection | None = None
+        # The connection is shared by the threads using this store
+        self.lock = threading.Lock()
+
+    def connect(self) -> 'sqlite3.Connection':
+        if self.conn is not None:
+            return self.conn
+
+        # Imported here so only processes that use the cache pay for it
+        import sqlite3
+
+        # The temp directory is shared, don't use a store someone else could read or replace
+        if not private_dir(self.dpath):
+            raise PermissionError(f'{self.dpath} is owned by another user')
+        # Only readable by the current user.  SQLite gives the WAL files the same permissions.
+        os.close(os.open(self.fpath, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600))
+        if not is_private(self.fpath):
+            raise PermissionError(f'{self.fpath} is not private to the user')
+        conn = sqlite3.connect(
+            self.fpath,
+            timeout=CACHE_BUSY_TIMEOUT,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        if conn.execute('PRAGMA user_version').fetchone()[0] == 0:
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.executescript(self.schema)
+        # Committed entries survive a crash of the process, a power loss could lose the latest
+        conn.execute('PRAGMA synchronous = NORMAL')
+        self.conn = conn
+        return conn
+
+    def get(self, key: str) -> tuple[bytes, float] | None:
+        """Return the entry's data and expiry (a timestamp), even if it has expired"""
+        now = time.time()
+        with self.lock:
+            conn = self.connect()
+            row = conn.execute(
+                'SELECT data, expires_at, used_at FROM entry WHERE key = ?',
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+
+            data, expires_at, used_at = row
+            # Recording every use would make every read a write
+            if used_at < now - CACHE_TOUCH_INTERVAL:
+                conn.execute('UPDATE entry SET used_at = ? WHERE key = ?', (now, key))
+        return data, expires_at
+
+    def set(self, key: str, data: bytes, expires_at: float) -> None:
+        now = time.time()
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                conn.execute(
+                    'INSERT OR REPLACE INTO entry VALUES (?, ?, ?, ?, ?)',
+                    (key, expires_at, now, len(data), data),
+                )
+                self.evict(conn, now)
+
+    def delete(self, key: str) -> None:
+        with self.lock:
+            self.connect().execute('DELETE FROM entry WHERE key = ?', (key,))
+
+    def clear(self, prefix: str = '') -> int:
+        """Delete entries whose keys start with `prefix` and return how many there were"""
+        with self.lock:
+            cursor = self.connect().execute(
+                'DELETE FROM entry WHERE substr(key, 1, length(?)) = ?',
+                (prefix, prefix),
+            )
+        return cursor.rowcount
+
+    def evict(self, conn: 'sqlite3.Connection', now: float) -> int:
+        """Delete expired entries, then the least recently used until within `max_bytes`"""
+        expired = conn.execute('DELETE FROM entry WHERE expires_at <= ?', (now,)).rowcount
+        # Keep the most recently used entries that fit
+        evicted = conn.execute(
+            """
+            DELETE FROM entry WHERE key IN (
+                SELECT key FROM (
+                    SELECT key, SUM(size) OVER (ORDER BY used_at DESC, key) AS kept FROM entry
+                ) WHERE kept > ?
+            )
+            """,
+            (self.max_bytes,),
+        ).rowcount
+        return expired + evicted
+
+    def gc(self, legacy_max_age: float = CACHE_LEGACY_MAX_AGE) -> int:
+        """
+        Evict expired and least recently used entries, delete files left by older versions that
+        haven't been updated in `legacy_max_age` seconds, and reclaim the space.  Returns how many
+        entries and files were deleted.
+        """
+        now = time.time()
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                count = self.evict(conn, now)
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            conn.execute('VACUUM')
+
+        for pattern in CACHE_LEGACY_GLOBS:
+            for fpath in self.dpath.glob(pattern):
+                try:
+                    if fpath.stat().st_mtime < now - legacy_max_age:
+                        fpath.unlink()
+                        count += 1
+                except FileNotFoundError:
+                    continue
+        return count
 
 
 class EncryptedTempFile:
@@ -81,37 +911,86 @@ class EncryptedTempFile:
     NOT ROBUST against determined attacker!
 
     Just a small step up from security through obscurity.
+
+    Data is encrypted with AES-256-GCM and saved to a CacheStore entry after a header with the
+    format version and the nonce.  Older versions saved each entry to its own file, `fpath`, which
+    is still read until the entry is saved again.  Those files start with the same header or, if
+    older still, are encrypted with Fernet.  AES-GCM is several times faster than Fernet and its
+    module is quicker to import.
     """
 
+    header: bytes = b'env-config:2\n'
+    nonce_size: int = 12
+
     def __init__(
         self,
         identifier: str,
         dpath: Path | None = None,
         enc_key: str | None = None,
+        store: CacheStore | None = None,
+        namespace: str = '',
     ):
         dpath = dpath or TMP_DPATH
         fname = hashlib.sha256(identifier.encode()).hexdigest()
+        # Where older versions saved the data.  Also the base name of related files, e.g. the lock.
         self.fpath: Path = (dpath / fname).with_suffix('.bin')
+        self.store: CacheStore = store or CacheStore(dpath)
+        self.store_key: str = f'{namespace}:{fname}'
 
         enc_key = enc_key or (machine_ident() + identifier)
-        # sha256 gives us 32 bytes, which is what fernet needs
-        id_hash: bytes = hashlib.sha256(enc_key.encode()).digest()
-        # b64encode b/c that's how Fernet.generate_key() does it
-        self.fernet_key: str = base64.urlsafe_b64encode(id_hash)
+        # sha256 gives us 32 bytes, which is what AES-256 (and fernet) needs
+        self.key: bytes = hashlib.sha256(enc_key.encode()).digest()
+
+    def save(self, data: bytes, expires_at: float) -> None:
+        """Save the data until `expires_at`, a timestamp"""
+        # Imported here so only processes that use the cache pay for importing cryptography
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        with timings.span('EncryptedTempFile.save'):
+            nonce = os.urandom(self.nonce_size)
+            # The header is authenticated so it can't be altered to change how data is read
+            encrypted_data = AESGCM(self.key).encrypt(nonce, data, self.header)
+            self.store.set(self.store_key, self.header + nonce + encrypted_data, expires_at)
+            self.fpath.unlink(missing_ok=True)
 
-    def save(self, data: bytes) -> None:
-        cipher_suite = Fernet(self.fernet_key)
-        encrypted_data = cipher_suite.encrypt(data)
-        self.fpath.write_bytes(encrypted_data)
+    def read(self, fresh_for: float = 0) -> bytes | None:
+        """
+        Return the decrypted data, or None when there isn't any or it expires within `fresh_for`
+        seconds.  Data from a file saved by an older version is returned regardless, its expiry
+        isn't known without decrypting it.
+        """
+        with timings.span('EncryptedTempFile.read'):
+            entry = self.store.get(self.store_key)
+            if entry is None:
+                return self.decrypt(self.fpath.read_bytes()) if self.fpath.exists() else None
 
-    def read(self) -> bytes:
-        blob: bytes = self.fpath.read_bytes()
+            blob, expires_at = entry
+            if expires_at <= time.time() + fresh_for:
+                return None
+            return self.decrypt(blob)
 
-        cipher_suite = Fernet(self.fernet_key)
-        return cipher_suite.decrypt(blob)
+    def decrypt(self, blob: bytes) -> bytes:
+        if not blob.startswith(self.header):
+            return self.decrypt_fernet(blob)
+
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        nonce_at = len(self.header)
+        nonce = blob[nonce_at : nonce_at + self.nonce_size]
+        return AESGCM(self.key).decrypt(nonce, blob[nonce_at + self.nonce_size :], self.header)
+
+    def decrypt_fernet(self, blob: bytes) -> bytes:
+        """Decrypt data saved by an older version"""
+        import base64
+
+        from cryptography.fernet import Fernet
+
+        # b64encode b/c that's how Fernet.generate_key() does it
+        return Fernet(base64.urlsafe_b64encode(self.key)).decrypt(blob)
 
-    def exists(self) -> bool:
-        return self.fpath.exists()
+    def lock(self, timeout: float = 120) -> FileLock:
+        """Lock for coordinating updates to this entry across processes"""
+        return FileLock(self.fpath.with_suffix('.lock'), timeout)
 
 
 def utc_now():